@@ -0,0 +1,333 @@
+from SocketServer import BaseRequestHandler, TCPServer, ThreadingMixIn
+from StratumServer import parse_address
+from json import dumps, loads
+from log import say_exception, say_line
+import log
+from threading import Thread
+from time import time
+from util import if_else
+import socket
+import struct
+
+
+API_VERSION = '1.0'
+
+#longest request read, commands and their parameters are short
+MAX_REQUEST = 4096
+REQUEST_TIMEOUT = 5
+
+
+class APIError(Exception):
+	def __init__(self, code, message):
+		super(APIError, self).__init__(message)
+		self.code = code
+
+class APIServer(object):
+	"""cgminer style API. A client connects, sends one command, either as JSON
+	{"command": ..., "parameter": ...} or as plain text command|parameter,
+	and gets the reply in the same form, terminated by a NUL byte, before the
+	connection is closed. Commands that change anything are only accepted
+	from the addresses in --api-allow."""
+	def __init__(self, switch, address, allow):
+		self.switch = switch
+		self.allow = [parse_network(network) for network in allow]
+		self.started = time()
+
+		self.commands = {
+			'version': (self.version, False),
+			'summary': (self.summary, False),
+			'devs': (self.devs, False),
+			'pools': (self.pools, False),
+			'stats': (self.stats, False),
+			'pause': (self.pause, True),
+			'resume': (self.resume, True),
+			'switchpool': (self.switchpool, True)
+		}
+
+		self.server = ThreadedTCPServer(parse_address(address), Handler)
+		self.server.api_server = self
+		thread = Thread(target=self.server.serve_forever, name='api server')
+		thread.daemon = True
+		thread.start()
+		say_line('Serving API on %s:%d', self.server.server_address)
+		log.event('listening', service='api', host=self.server.server_address[0], port=self.server.server_address[1])
+
+	def allowed(self, host):
+		try:
+			address, = struct.unpack('!I', socket.inet_aton(host))
+		except (socket.error, struct.error):
+			return False
+		for network, mask in self.allow:
+			if address & mask == network:
+				return True
+		return False
+
+	def execute(self, command, parameter, host):
+		"""Runs a command, returns the reply as a dict of the STATUS section and
+		the section of the command if it succeeded."""
+		try:
+			command = command.strip().lower()
+			setting = self.settings().get(command)
+			if setting:
+				handler, privileged = lambda parameter: self.configure(setting, parameter), True
+			elif command in self.commands:
+				handler, privileged = self.commands[command]
+			else:
+				raise APIError(14, 'Invalid command')
+			if privileged and not self.allowed(host):
+				raise APIError(45, 'Access denied to %s command' % command)
+			code, message, section, items = handler(parameter)
+			reply = self.status('S', code, message)
+			if section:
+				reply[section] = items
+			return reply
+		except APIError, e:
+			return self.status('E', e.code, str(e))
+		except Exception, e:
+			say_exception()
+			return self.status('E', 1, 'Command failed: %s' % e)
+
+	def status(self, status, code, message):
+		return {'STATUS': [{'STATUS': status, 'When': int(time()), 'Code': code, 'Msg': message, 'Description': self.switch.user_agent}]}
+
+	#setting commands are the lower case names of the miner settings
+	def settings(self):
+		names = {}
+		for miner in self.switch.miners:
+			for name in miner.SETTINGS:
+				names[name.lower()] = name
+		return names
+
+	def miner(self, parameter):
+		try:
+			index = int(parameter.split(',', 1)[0])
+		except (AttributeError, ValueError):
+			raise APIError(15, 'Missing or invalid device id')
+		if not 0 <= index < len(self.switch.miners):
+			raise APIError(16, 'Invalid device id %d - range is 0 - %d' % (index, len(self.switch.miners) - 1))
+		return index, self.switch.miners[index]
+
+	def version(self, parameter):
+		return 22, 'poclbm versions', 'VERSION', [{'poclbm': self.switch.options.version, 'API': API_VERSION}]
+
+	def summary(self, parameter):
+		now = time()
+		total = self.switch.registry.total()
+		item = {
+			'Elapsed': int(now - self.started),
+			'MHS 5s': total['rate'],
+			'Estimated MHS': total['estimated_rate'],
+			'Accepted': total['accepted'],
+			'Rejected': total['rejected'],
+			'Hardware Errors': total['hw_errors'],
+			'Utility': total['accepted'] * 60.0 / max(now - self.started, 1),
+			'Work Queue': sum(miner.work_queue.qsize() for miner in self.switch.miners),
+			'Stale': 0,
+			'Discarded': 0
+		}
+		for miner in self.switch.miners:
+			for key, value in horizon_rates(miner).iteritems():
+				item[key] = item.get(key, 0) + value
+		for server in list(self.switch.servers):
+			pool_stats = self.switch.stats(server)
+			item['Stale'] += pool_stats.stale.count()
+			item['Discarded'] += pool_stats.discarded.count()
+		#average over the longest horizon, the miners share their horizons
+		if self.switch.miners:
+			item['MHS av'] = item['MHS %s' % horizon_name(max(self.switch.miners[0].horizons))]
+		return 11, 'Summary', 'SUMMARY', [item]
+
+	def devs(self, parameter):
+		items = []
+		for i, miner in enumerate(self.switch.miners):
+			figures = self.switch.registry.get(miner)
+			item = {
+				'ID': i,
+				'Name': miner.id(),
+				'Kind': type(miner).__name__.replace('Miner', ''),
+				'Enabled': 'Y',
+				'Status': if_else(miner.paused, 'Paused', 'Alive'),
+				'Temperature': miner.temperature or 0,
+				'MHS 5s': figures['rate'],
+				'Estimated MHS': figures['estimated_rate'],
+				'Accepted': figures['accepted'],
+				'Rejected': figures['rejected'],
+				'Hardware Errors': figures['hw_errors'],
+				'Utility': figures['accepted'] * 60.0 / max(time() - miner.start_time, 1) if hasattr(miner, 'start_time') else 0,
+				'Work Queue': miner.work_queue.qsize()
+			}
+			item.update(horizon_rates(miner))
+			if hasattr(miner, 'idle_seconds'):
+				item['Idle Seconds'] = miner.idle_seconds()
+			for name in miner.SETTINGS:
+				item[name] = getattr(miner, name)
+			items.append(item)
+		return 9, '%d device(s)' % len(items), 'DEVS', items
+
+	def pools(self, parameter):
+		switch = self.switch
+		items = []
+		for i, server in enumerate(list(switch.servers)):
+			pool_stats = switch.stats(server)
+			source = getattr(server, 'source', None)
+			latency = pool_stats.latency()
+			items.append({
+				'POOL': i,
+				'URL': '%s://%s' % (server.proto or 'http', server.host),
+				'Name': server.name,
+				'User': server.user,
+				'Status': 'Alive' if source and source.healthy() else 'Dead' if source else 'Unknown',
+				'Priority': i,
+				'Active': i == switch.server_index,
+				'Accepted': pool_stats.accepted.count(),
+				'Rejected': pool_stats.rejected.count(),
+				'Stale': pool_stats.stale.count(),
+				'Discarded': pool_stats.discarded.count(),
+				'Connections': pool_stats.connections,
+				'Reconnects': pool_stats.reconnects.count(),
+				'Latency': latency * 1000 if latency is not None else None,
+				'Result Queue': source.result_queue.qsize() if source else 0
+			})
+		return 7, '%d Pool(s)' % len(items), 'POOLS', items
+
+	def stats(self, parameter):
+		items = []
+		for i, miner in enumerate(self.switch.miners):
+			total, calls = miner.kernel_time.snapshot()[1:]
+			items.append({
+				'STATS': i,
+				'ID': miner.id(),
+				'Elapsed': int(time() - miner.start_time) if hasattr(miner, 'start_time') else 0,
+				'Calls': calls,
+				'Wait': total / calls if calls else 0,
+				'Rates': miner.rates()
+			})
+		for i, summary in enumerate(self.switch.pool_stats()):
+			summary['STATS'] = len(items)
+			summary['ID'] = 'POOL%d' % i
+			items.append(summary)
+		return 70, 'poclbm stats', 'STATS', items
+
+	def pause(self, parameter):
+		index, miner = self.miner(parameter)
+		if miner.paused:
+			raise APIError(39, 'Device %d already paused' % index)
+		miner.paused = True
+		return 40, 'Device %d paused' % index, None, None
+
+	def resume(self, parameter):
+		index, miner = self.miner(parameter)
+		if not miner.paused:
+			raise APIError(41, 'Device %d is not paused' % index)
+		miner.paused = False
+		return 42, 'Device %d resumed' % index, None, None
+
+	def configure(self, setting, parameter):
+		index, miner = self.miner(parameter)
+		try:
+			value = parameter.split(',', 1)[1]
+		except IndexError:
+			raise APIError(15, 'Missing %s value' % setting)
+		try:
+			miner.configure(setting, value)
+		except ValueError, e:
+			raise APIError(17, 'Invalid %s for device %d: %s' % (setting, index, e))
+		return 44, 'Device %d %s set to %s' % (index, setting, getattr(miner, setting)), None, None
+
+	def switchpool(self, parameter):
+		try:
+			index = int(parameter)
+		except (TypeError, ValueError):
+			raise APIError(15, 'Missing or invalid pool id')
+		try:
+			self.switch.switch_pool(index)
+		except ValueError:
+			raise APIError(16, 'Invalid pool id %d - range is 0 - %d' % (index, len(self.switch.servers) - 1))
+		return 27, 'Switching to pool %d' % index, None, None
+
+def horizon_name(horizon):
+	if horizon % 60 == 0:
+		return '%dm' % (horizon / 60)
+	return '%ds' % horizon
+
+def horizon_rates(miner):
+	hashrate = miner.rates()['hashrate']
+	return dict(('MHS %s' % horizon_name(horizon), hashrate[horizon]) for horizon in miner.horizons)
+
+def parse_network(network):
+	"""address[/bits] to the (network, mask) pair of an IPv4 network."""
+	address, bits = network, 32
+	if '/' in network:
+		address, bits = network.split('/', 1)
+		bits = int(bits)
+	mask = (0xffffffff << (32 - bits)) & 0xffffffff
+	address, = struct.unpack('!I', socket.inet_aton(address))
+	return address & mask, mask
+
+def format_text(reply):
+	"""cgminer plain text replies, sections and items separated by |, fields
+	by commas."""
+	def escape(value):
+		if isinstance(value, (dict, list)):
+			value = dumps(value)
+		return unicode(value).replace('\\', '\\\\').replace(',', '\\,').replace('|', '\\|').replace('=', '\\=')
+	def fields(item):
+		return ','.join('%s=%s' % (key, escape(item[key])) for key in sorted(item, key=lambda key: (key != 'STATUS', key)))
+	parts = [fields(reply['STATUS'][0])]
+	for section, items in reply.iteritems():
+		if section != 'STATUS':
+			for item in items:
+				parts.append(fields(item))
+	return '|'.join(parts) + '|'
+
+class ThreadedTCPServer(ThreadingMixIn, TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class Handler(BaseRequestHandler):
+	def handle(self):
+		self.request.settimeout(REQUEST_TIMEOUT)
+		data = ''
+		try:
+			while len(data) < MAX_REQUEST:
+				chunk = self.request.recv(MAX_REQUEST)
+				if not chunk:
+					break
+				data += chunk
+				#plain text clients send a single packet and wait, JSON is read until it parses
+				if not data.lstrip().startswith('{') or parse_json(data) is not None:
+					break
+		except socket.error:
+			pass
+		data = data.strip(' \r\n\t\x00')
+		if not data:
+			return
+
+		api_server = self.server.api_server
+		host = self.client_address[0]
+		if data.startswith('{'):
+			request = parse_json(data)
+			if not isinstance(request, dict):
+				reply = api_server.status('E', 23, 'Invalid JSON')
+			else:
+				parameter = request.get('parameter')
+				if parameter is not None:
+					parameter = unicode(parameter)
+				reply = api_server.execute(unicode(request.get('command', '')), parameter, host)
+				if 'id' in request:
+					reply['id'] = request['id']
+			response = dumps(reply)
+		else:
+			command, _, parameter = data.partition('|')
+			response = format_text(api_server.execute(command, parameter or None, host))
+
+		try:
+			self.request.sendall(response.encode('utf-8') + '\x00')
+		except socket.error:
+			pass
+
+def parse_json(data):
+	try:
+		return loads(data)
+	except ValueError:
+		return None
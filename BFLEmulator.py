@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+from binascii import hexlify, unhexlify
+from optparse import OptionParser
+from struct import pack, unpack
+from threading import Lock, Thread
+from time import time, sleep
+from util import if_else
+import os
+import pty
+import random
+import select
+import tty
+
+
+#the first blocks of the chain as serialized headers, their nonces are real difficulty 1 results
+KNOWN_HEADERS = [unhexlify(header) for header in (
+	'0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c',
+	'010000006fe28c0ab6f1b372c1a6a246ae63f74f931e8365e15a089c68d6190000000000982051fd1e4ba744bbbe680e1fee14677ba1a3c3540bf7b1cdb606e857233e0e61bc6649ffff001d01e36299',
+	'010000004860eb18bf1b1620e37e9490fc8a427514416fd75159ab86688e9a8300000000d5fdcc541e25de1c7a5addedf24858b8bb665c9f36ef744ee42c316022c90f9bb0bc6649ffff001d08d2bd61',
+	'01000000bddd99ccfda39da1b108ce1a5d70038d0a967bacb68b6b63065f626a0000000044f672226090d85db9a9f2fbfe5f0f9609b387af7be5b7fbb7a1767c831c9e995dbe6649ffff001d05e0ed6d'
+)]
+
+#getwork target of difficulty 1
+DIFF1_TARGET = 'ff' * 28 + '00' * 4
+
+JOB_FRAME = b'>>>>>>>>'
+JOB_SIZE = 60
+QUEUE_SIZE = 20
+MAX_COMMAND = 0x100
+
+
+#getwork data has every 32 bit word of the header byte swapped
+def getwork_data(header):
+	return ''.join(header[i:i + 4][::-1] for i in xrange(0, len(header), 4))
+
+#the 12 bytes after the midstate as BFLMiner sends them, and the nonce as a device reports it
+def job_tail(header):
+	return getwork_data(header[64:76])
+
+def nonce_hex(header):
+	return hexlify(header[76:80])
+
+KNOWN_NONCES = dict((job_tail(header), nonce_hex(header)) for header in KNOWN_HEADERS)
+
+
+class Job(object):
+	def __init__(self, payload, nonce):
+		self.midstate = hexlify(payload[8:40])
+		self.data = hexlify(payload[40:52])
+		self.nonce = nonce
+		self.started = None
+		self.done = None
+
+	#as listed by ZOX
+	def result(self):
+		if self.nonce:
+			return b','.join([self.midstate, self.data, b'1', self.nonce])
+		return b','.join([self.midstate, self.data, b'0'])
+
+class EmulatedDevice(object):
+	"""A BitFORCE board behind a pseudo terminal. Jobs take `job_time`
+	seconds give or take `jitter` of that, back to back when queued, and
+	report the real nonce with probability `hit_rate` if the work is one of
+	the known headers. The state is brought up to date whenever a command
+	comes in, the emulator needs no timers."""
+	def __init__(self, index, options):
+		self.index = index
+		self.options = options
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		self.port = os.ttyname(self.slave)
+
+		self.buffer = b''
+		self.upload = None
+		self.current = None
+		self.last = None
+		self.queue = []
+		self.finished = []
+		self.free_since = time()
+
+		self.jobs = 0
+		self.hits = 0
+		self.commands = 0
+		self.idle_time = 0.0
+		self.pickup = []
+
+	def fileno(self):
+		return self.master
+
+	def close(self):
+		for fd in (self.master, self.slave):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+	def job_time(self):
+		jitter = self.options.jitter * self.options.job_time
+		return max(self.options.job_time + random.uniform(-jitter, jitter), 0.001)
+
+	def start(self, job, now):
+		job.started = max(now, self.current.done if self.current else now)
+		job.done = job.started + self.job_time()
+		if self.free_since is not None:
+			self.idle_time += max(job.started - self.free_since, 0)
+			self.free_since = None
+		if job.nonce and random.random() >= self.options.hit_rate:
+			job.nonce = None
+		self.current = job
+
+	def advance(self, now):
+		while self.current and self.current.done <= now:
+			job = self.current
+			self.current = None
+			self.jobs += 1
+			if self.queue:
+				self.start(self.queue.pop(0), job.done)
+			else:
+				self.free_since = job.done
+			if self.options.queue:
+				self.finished.append(job)
+			else:
+				self.last = job
+
+	def picked_up(self, job, now):
+		self.pickup.append(now - job.done)
+		if job.nonce:
+			self.hits += 1
+
+	def handle_read(self):
+		self.buffer += os.read(self.master, 4096)
+		now = time()
+		self.advance(now)
+		out = []
+		while True:
+			if self.upload:
+				if len(self.buffer) < JOB_SIZE:
+					break
+				payload, self.buffer = self.buffer[:JOB_SIZE], self.buffer[JOB_SIZE:]
+				out.append(self.job(self.upload, payload, now))
+				self.upload = None
+			else:
+				if len(self.buffer) < 3:
+					break
+				command, self.buffer = self.buffer[:3], self.buffer[3:]
+				self.commands += 1
+				out.append(self.command(command, now))
+		if len(self.buffer) > MAX_COMMAND:
+			self.buffer = b''
+		if out:
+			os.write(self.master, b''.join(out))
+
+	def command(self, command, now):
+		queue = self.options.queue
+		if command == b'ZGX':
+			return b'>>>ID: BitFORCE SHA256 %s1.0>>>\n' % if_else(queue, b'SC ', b'Version ')
+		if command == b'ZLX':
+			return b'Temperature (celcius): %.1f\n' % self.options.temperature
+		if command == b'ZDX' and not queue:
+			if self.current:
+				return b'BUSY\n'
+			self.upload = command
+			return b'OK\n'
+		if command == b'ZFX' and not queue:
+			if self.current:
+				return b'BUSY\n'
+			job, self.last = self.last, None
+			if not job:
+				return b'NO-NONCE\n'
+			self.picked_up(job, now)
+			if job.nonce:
+				return b'NONCE-FOUND:%s\n' % job.nonce
+			return b'NO-NONCE\n'
+		if command == b'ZNX' and queue:
+			self.upload = command
+			return b'OK\n'
+		if command == b'ZQX' and queue:
+			flushed = len(self.queue)
+			self.queue = []
+			return b'OK:FLUSHED %d\n' % flushed
+		if command == b'ZOX' and queue:
+			lines = [b'INPROCESS:%d' % (len(self.queue) + bool(self.current)), b'COUNT:%d' % len(self.finished)]
+			for job in self.finished:
+				self.picked_up(job, now)
+				lines.append(job.result())
+			self.finished = []
+			return b'\n'.join(lines + [b'OK']) + b'\n'
+		return b'ERR:UNKNOWN COMMAND\n'
+
+	def job(self, command, payload, now):
+		if payload[:8] != JOB_FRAME or payload[-8:] != JOB_FRAME:
+			return b'ERR:INVALID DATA\n'
+		job = Job(payload, KNOWN_NONCES.get(payload[40:52]))
+		if command == b'ZDX':
+			self.start(job, now)
+			return b'OK\n'
+		if len(self.queue) >= QUEUE_SIZE:
+			return b'ERR:QUEUE FULL\n'
+		if self.current:
+			self.queue.append(job)
+		else:
+			self.start(job, now)
+		return b'OK:QUEUED\n'
+
+	def idle_seconds(self, now):
+		self.advance(now)
+		if self.free_since is None:
+			return self.idle_time
+		return self.idle_time + max(now - self.free_since, 0)
+
+class Emulator(object):
+	"""Any number of emulated devices served from one select() thread."""
+	def __init__(self, options):
+		self.devices = [EmulatedDevice(i, options) for i in xrange(options.devices)]
+		self.lock = Lock()
+		self.should_stop = False
+		thread = Thread(target=self.loop, name='bfl emulator')
+		thread.daemon = True
+		thread.start()
+
+	def ports(self):
+		return [device.port for device in self.devices]
+
+	def loop(self):
+		while not self.should_stop:
+			try:
+				readable = select.select(self.devices, [], [], 0.1)[0]
+			except (select.error, ValueError):
+				#closed by stop()
+				return
+			with self.lock:
+				#stop() may have closed the devices since select returned them
+				if self.should_stop:
+					return
+				for device in readable:
+					device.handle_read()
+
+	def stop(self):
+		self.should_stop = True
+		with self.lock:
+			for device in self.devices:
+				device.close()
+
+	def report(self, elapsed):
+		now = time()
+		with self.lock:
+			for device in self.devices:
+				pickup = sorted(device.pickup) or [0]
+				print '%s: %d jobs (%.1f/s), %d nonces, %.1f commands per job, idle %.1f%%, pickup %.1f/%.1f ms (p50/p90)' % (
+					device.port, device.jobs, device.jobs / elapsed, device.hits, float(device.commands) / max(device.jobs, 1),
+					device.idle_seconds(now) * 100 / elapsed, pickup[len(pickup) / 2] * 1000, pickup[len(pickup) * 9 / 10] * 1000)
+			jobs = sum(device.jobs for device in self.devices)
+			print 'total: %d jobs (%.1f/s) on %d devices, %.1f%% idle' % (jobs, jobs / elapsed, len(self.devices),
+				sum(device.idle_seconds(now) for device in self.devices) * 100 / elapsed / len(self.devices))
+
+def benchmark(emulator, options):
+	"""Mines the known headers on the emulated devices with the real BFLMiner
+	and verifies the results like Switch does for a pool. A new block comes
+	every --block-interval seconds, in between the work differs in ntime and
+	has no nonce to find."""
+	from Switch import Switch
+	from util import Object
+	import BFLMiner
+
+	switch_options = Object()
+	switch_options.version = 'benchmark'
+	switch_options.verbose = False
+	switch_options.servers = []
+	switch_options.proxy = switch_options.serve_stratum = switch_options.serve_getwork = switch_options.metrics = switch_options.api = ''
+	switch_options.max_update_time = 60
+	switch_options.rate = 1
+	switch_options.estimate = 900
+	switch_options.no_bfl_queue = False
+
+	class BenchmarkSwitch(Switch):
+		def put(self, result):
+			self.send(result, self.accept)
+
+		def accept(self, result, nonce):
+			self.report(result.miner, nonce, True)
+			return True
+
+	switch = BenchmarkSwitch(switch_options)
+	switch.update_time = False
+	for i, port in enumerate(emulator.ports()):
+		miner = BFLMiner.BFLMiner(i, port, switch_options)
+		miner.cutoff_temp = 95
+		miner.cutoff_interval = 0.01
+		switch.add_miner(miner)
+
+	started = time()
+	for miner in switch.miners:
+		miner.start()
+
+	#the block each miner works on and how often its ntime was rolled
+	rolled = [(None, 0)] * len(switch.miners)
+	while time() - started < options.benchmark:
+		block = int((time() - started) / options.block_interval)
+		header = KNOWN_HEADERS[block % len(KNOWN_HEADERS)]
+		for i, miner in enumerate(switch.miners):
+			if miner.work_queue.empty():
+				seconds = if_else(rolled[i][0] == block, rolled[i][1], 0)
+				rolled[i] = (block, seconds + 1)
+				data = header[:68] + pack('<I', unpack('<I', header[68:72])[0] + seconds) + header[72:]
+				miner.work_queue.put(switch.decode(None, hexlify(getwork_data(data)), DIFF1_TARGET))
+		sleep(0.001)
+	elapsed = time() - started
+
+	for miner in switch.miners:
+		miner.stop()
+	emulator.report(elapsed)
+	for miner in switch.miners:
+		print '%s: %d accepted, %d hardware errors, %.1f s idle by its own account' % (miner.id(), miner.share_count[1], miner.hw_errors, miner.idle_seconds())
+
+def main():
+	parser = OptionParser(usage='usage: %prog [OPTION]...\nEmulates BitFORCE SHA256 devices on pseudo terminals, mine on them with poclbm --bfl-ports')
+	parser.add_option('-n', '--devices',     dest='devices',     default=1,    help='number of devices, default 1', type='int')
+	parser.add_option('--job-time',          dest='job_time',    default=1.0,  help='seconds a job takes, default 1', type='float')
+	parser.add_option('--jitter',            dest='jitter',      default=0.05, help='jobs take up to this fraction of --job-time more or less, default 0.05', type='float')
+	parser.add_option('--hit-rate',          dest='hit_rate',    default=1.0,  help='probability that a job on a known header reports its nonce, default 1', type='float')
+	parser.add_option('--temperature',       dest='temperature', default=45.0, help='temperature reported, in C, default 45', type='float')
+	parser.add_option('--queue',             dest='queue',       action='store_true', help='identify as a single chip device and take queued work (ZNX, ZOX, ZQX) instead of ZDX, ZFX')
+	parser.add_option('--benchmark',         dest='benchmark',   default=0,    help='mine on the devices for N seconds and report throughput and latency', type='float')
+	parser.add_option('--block-interval',    dest='block_interval', default=5.0, help='seconds between new blocks in the benchmark, default 5', type='float')
+	options = parser.parse_args()[0]
+
+	emulator = Emulator(options)
+	try:
+		if options.benchmark:
+			benchmark(emulator, options)
+		else:
+			print '--bfl-ports=%s' % ','.join(emulator.ports())
+			while True:
+				sleep(1)
+	except KeyboardInterrupt:
+		print '\nbye'
+	finally:
+		emulator.stop()
+	sleep(0.1)
+	os._exit(0)
+
+if __name__ == '__main__':
+	main()
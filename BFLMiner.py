@@ -1,23 +1,60 @@
 from Miner import Miner
 from Queue import Empty
-from binascii import unhexlify
+from binascii import hexlify, unhexlify
+from detect import WINDOWS
 from ioutil import find_udev, find_serial_by_id, find_com_ports
 from log import say_line, say_exception
+from reactor import Channel, Reactor
 from serial.serialutil import SerialException
-from sys import maxint
+from stats import DurationModel
+from threading import Lock
 from time import time, sleep
-from util import Object
+from util import Object, if_else
 import numpy as np
 import serial
 
 CHECK_INTERVAL = 0.01
+#polls for a result that is late are spaced this much further apart each time
+CHECK_BACKOFF = 1.5
+MAX_CHECK_INTERVAL = 1
 
+#jobs kept loaded on devices that have a work queue
+QUEUE_DEPTH = 2
+#how often a device with a work queue is asked for finished jobs
+QUEUE_POLL_INTERVAL = 0.05
+#devices with a work queue are not asked for the temperature before every job
+TEMPERATURE_INTERVAL = 1
 
-def open_device(port):
-	return serial.Serial(port, 115200, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, 1, False, False, 5, False, None)
+#how long a device may take to answer a command, in seconds
+RESPONSE_TIMEOUT = 1
+#wait before reopening a device that failed
+RETRY_INTERVAL = 1
+#how often an idle device looks for work
+WORK_POLL_INTERVAL = 0.1
+#how often a paused miner looks for being resumed, in seconds
+PAUSE_INTERVAL = 0.1
+MAX_RESPONSE = 0x1000
+
+#serial ports can be selected on everywhere but on Windows, there every device gets a thread
+MULTIPLEX = not WINDOWS
+
+controller = None
+controller_lock = Lock()
+
+
+def open_device(port, timeout=1):
+	return serial.Serial(port, 115200, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout, False, False, 5, False, None)
 
 def is_good_init(response):
-	return response and response[:31] == b'>>>ID: BitFORCE SHA256 Version ' and response[-4:] == b'>>>\n'
+	return response and response[:23] == b'>>>ID: BitFORCE SHA256 ' and response[-4:] == b'>>>\n'
+
+#firmware of the single chip devices takes queued work
+def can_queue(response):
+	return response[:26] == b'>>>ID: BitFORCE SHA256 SC '
+
+#queued jobs are named by their midstate and data in hex
+def job_key(job):
+	return b','.join([hexlify(job.state.tostring()), hexlify(b''.join([job.merkle_end.tostring(), job.time.tostring(), job.difficulty.tostring()]))])
 
 def init_device(device):
 	return request(device, b'ZGX')
@@ -45,7 +82,10 @@ def check(port, likely=True):
 	return result
 
 def initialize(options):
-	ports = find_udev(check, 'BitFORCE*SHA256') or find_serial_by_id(check, 'BitFORCE_SHA256') or find_com_ports(check)
+	if options.bfl_ports:
+		ports = [port for port in options.bfl_ports if check(port)]
+	else:
+		ports = find_udev(check, 'BitFORCE*SHA256') or find_serial_by_id(check, 'BitFORCE_SHA256') or find_com_ports(check)
 
 	if not options.device and ports:
 		print '\nBFL devices on ports:\n'
@@ -66,6 +106,27 @@ def initialize(options):
 		miners[i].cutoff_interval = options.cutoff_interval[min(i, len(options.cutoff_interval) - 1)]
 	return miners
 
+#one thread drives all devices
+def get_controller():
+	global controller
+	with controller_lock:
+		if not controller:
+			controller = Reactor('bfl')
+		return controller
+
+def parse_temperature(response):
+	if not response or response[0] != b'T' or len(response) < 23 or response[-1:] != b'\n':
+		return None
+	return float(response[23:-1])
+
+#False while busy, the response if there is no nonce, the nonces otherwise and None for anything else
+def parse_result(response):
+	if response[0] == b'B': return False
+	if response == b'NO-NONCE\n': return response
+	if response[:12] != 'NONCE-FOUND:' or response[-1:] != '\n':
+		return None
+	return response[12:-1]
+
 class BFLMiner(Miner):
 	def __init__(self, device_index, port, options):
 		super(BFLMiner, self).__init__(device_index, options)
@@ -74,7 +135,10 @@ class BFLMiner(Miner):
 
 		self.check_interval = CHECK_INTERVAL
 		self.last_job = None
-		self.min_interval = maxint
+		self.job_durations = DurationModel()
+		self.queued_work = False
+		self.idle_time = 0
+		self.idle_since = None
 
 	def id(self):
 		return self.device_name
@@ -82,59 +146,12 @@ class BFLMiner(Miner):
 	def is_ok(self, response):
 		return response and response == b'OK\n'
 
-	def put_job(self):
-		if self.busy: return
-
-		temperature = self.get_temperature()
-		if temperature < self.cutoff_temp:
-			response = request(self.device, b'ZDX')
-			if self.is_ok(response):
-				if self.switch.update_time:
-					self.job.time = (np.uint32(time()) - self.job.time_delta).byteswap()
-				data = b''.join([self.job.state.tostring(), self.job.merkle_end.tostring(), self.job.time.tostring(), self.job.difficulty.tostring()])
-				response = request(self.device, b''.join([b'>>>>>>>>', data, b'>>>>>>>>']))
-				if self.is_ok(response):
-					self.busy = True
-					self.job_started = time()
-
-					self.last_job = Object()
-					self.last_job.header = self.job.header
-					self.last_job.merkle_end = self.job.merkle_end
-					self.last_job.time = self.job.time
-					self.last_job.difficulty = self.job.difficulty
-					self.last_job.target = self.job.target
-					self.last_job.state = self.job.state
-					self.last_job.job_id = self.job.job_id
-					self.last_job.extranonce2 = self.job.extranonce2
-					self.last_job.server = self.job.server
-					self.last_job.miner = self
-
-					self.check_interval = CHECK_INTERVAL
-					if not self.switch.update_time or self.job.time.byteswap() - self.job.original_time.byteswap() > 55:
-						self.update = True
-						self.job = None
-				else:
-					say_line('%s: bad response when sending block data: %s', (self.id(), response))
-			else:
-				say_line('%s: bad response when submitting job (ZDX): %s', (self.id(), response))
+	def start_mining(self):
+		if MULTIPLEX:
+			say_line('started miner on %s', (self.id()))
+			get_controller().add(DeviceChannel(self))
 		else:
-			say_line('%s: temperature exceeds cutoff, waiting...', self.id())
-
-	def get_temperature(self):
-		response = request(self.device, b'ZLX')
-		if response[0] != b'T' or len(response) < 23 or response[-1:] != b'\n':
-			say_line('%s: bad response for temperature: %s', (self.id(), response))
-			return 0
-		return float(response[23:-1])
-
-	def check_result(self):
-		response = request(self.device, b'ZFX')
-		if response[0] == b'B': return False
-		if response == b'NO-NONCE\n': return response
-		if response[:12] != 'NONCE-FOUND:' or response[-1:] != '\n':
-			say_line('%s: bad response checking result: %s', (self.id(), response))
-			return None
-		return response[12:-1]
+			super(BFLMiner, self).start_mining()
 
 	def nonce_generator(self, nonces):
 		for nonce in nonces.split(b','):
@@ -144,72 +161,410 @@ class BFLMiner(Miner):
 			except TypeError:
 				pass
 
-	def mining_thread(self):
-		say_line('started miner on %s', (self.id()))
+	def session(self):
+		"""The conversation with an open device as a generator, so that the
+		same code runs on a thread of its own or on the shared controller.
+		It yields a command and is sent the line the device answers, yields
+		an empty command to be sent the next line of a longer answer, or
+		yields the number of seconds to wait and is sent None. It returns
+		when the miner stops or the device does not initialize."""
+		response = yield b'ZGX'
+		if not is_good_init(response):
+			say_line('Failed to initialize %s (response: %s), retrying...', (self.id(), response))
+			return
 
-		while not self.should_stop:
+		self.queued_work = False
+		if can_queue(response) and not self.options.no_bfl_queue:
+			#also drops anything an earlier session left queued
+			response = yield b'ZQX'
+			self.queued_work = response[:2] == b'OK'
+			if not self.queued_work:
+				say_line('%s: no work queue (response: %s), sending one job at a time', (self.id(), response))
+
+		self.job = None
+		self.busy = False
+		self.start_idle(time())
+		steps = if_else(self.queued_work, self.queued_session(), self.single_session())
+		response = None
+		while True:
 			try:
-				self.device = open_device(self.port)
-				response = init_device(self.device)
-				if not is_good_init(response):
-					say_line('Failed to initialize %s (response: %s), retrying...', (self.id(), response))
-					self.device.close()
-					self.device = None
-					sleep(1)
+				step = steps.send(response)
+			except StopIteration:
+				return
+			response = yield step
+
+	#picks up new work if there is any, the current job is kept otherwise
+	def take_work(self):
+		try:
+			job = self.work_queue.get(False)
+		except Empty:
+			return False
+		self.job = job
+		if job:
+			self.switch.work_started(job)
+			job.original_time = job.time
+			job.time_delta = np.uint32(time()) - job.time.byteswap()
+			job.sent = False
+		return True
+
+	#the job as the device takes it, the time is rolled forward if the pool allows it
+	def job_data(self):
+		job = self.job
+		if self.switch.update_time:
+			rolled = np.uint32(time()) - job.time_delta
+			if job.sent:
+				rolled = np.uint32(max(rolled, job.time.byteswap() + 1))
+			job.time = rolled.byteswap()
+		return b''.join([b'>>>>>>>>', job.state.tostring(), job.merkle_end.tostring(), job.time.tostring(), job.difficulty.tostring(), b'>>>>>>>>'])
+
+	#what is needed to submit the results of the job just sent, the job is dropped once it cannot be rolled further
+	def job_sent(self):
+		job = self.job
+		job.sent = True
+
+		sent = Object()
+		sent.header = job.header
+		sent.merkle_end = job.merkle_end
+		sent.time = job.time
+		sent.difficulty = job.difficulty
+		sent.target = job.target
+		sent.targetQ = job.targetQ
+		sent.state = job.state
+		sent.job_id = job.job_id
+		sent.extranonce2 = job.extranonce2
+		sent.server = job.server
+		sent.miner = self
+
+		if not self.switch.update_time or job.time.byteswap() - job.original_time.byteswap() > 55:
+			self.update = True
+			self.job = None
+		return sent
+
+	def check_temperature(self, response):
+		temperature = parse_temperature(response)
+		if temperature is None:
+			say_line('%s: bad response for temperature: %s', (self.id(), response))
+			temperature = 0
+		self.temperature = temperature
+		return temperature < self.cutoff_temp
+
+	def start_idle(self, now):
+		if self.idle_since is None:
+			self.idle_since = now
+
+	def end_idle(self, now):
+		if self.idle_since is not None:
+			self.idle_time += max(now - self.idle_since, 0)
+			self.idle_since = None
+
+	#a job is done somewhere between the last poll that found the device busy and
+	#the one that found it done, the modeled duration places it in between
+	def estimated_finish(self, started, busy_until, now):
+		if started is None or self.job_durations.mean is None:
+			return (busy_until + now) / 2
+		return min(max(started + self.job_durations.mean, busy_until), now)
+
+	#seconds the device spent without a job to work on, the current wait included
+	def idle_seconds(self):
+		idle_since = self.idle_since
+		if idle_since is None:
+			return self.idle_time
+		return self.idle_time + max(time() - idle_since, 0)
+
+	def single_session(self):
+		"""One job at a time, the next is sent once the device reports the
+		result of the last. The first poll (ZFX) is timed to come just before
+		the job is expected to be done, later ones back off a little."""
+		last_rated = time()
+		iterations = 0
+
+		while not self.should_stop:
+			if (not self.job) or (not self.work_queue.empty()):
+				self.take_work()
+				if not self.job and not self.busy:
+					yield WORK_POLL_INTERVAL
 					continue
 
-				last_rated = time()
-				iterations = 0
-		
-				self.job = None
-				self.busy = False
-				while not self.should_stop:
-					if (not self.job) or (not self.work_queue.empty()):
-						try:
-							self.job = self.work_queue.get(True, 1)
-						except Empty:
-							if not self.busy:
+			if not self.busy:
+				if self.paused:
+					self.set_state('paused')
+					yield PAUSE_INTERVAL
+					continue
+				else:
+					response = yield b'ZLX'
+					if self.check_temperature(response):
+						response = yield b'ZDX'
+						if self.is_ok(response):
+							response = yield self.job_data()
+							if self.is_ok(response):
+								self.set_state('mining')
+								self.busy = True
+								self.job_started = busy_until = time()
+								self.end_idle(self.job_started)
+								self.last_job = self.job_sent()
+								self.check_interval = CHECK_INTERVAL
+								yield max(self.job_started + self.job_durations.early() - time(), 0)
 								continue
+							else:
+								say_line('%s: bad response when sending block data: %s', (self.id(), response))
 						else:
-							if not self.job and not self.busy:
-								continue
-							targetQ = self.job.targetQ
-							self.job.original_time = self.job.time
-							self.job.time_delta = np.uint32(time()) - self.job.time.byteswap()
-		
-					if not self.busy:
-						self.put_job()
+							say_line('%s: bad response when submitting job (ZDX): %s', (self.id(), response))
 					else:
-						result = self.check_result()
-						if result:
+						self.set_state('overheated')
+						say_line('%s: temperature exceeds cutoff, waiting...', self.id())
+			else:
+				response = yield b'ZFX'
+				result = parse_result(response)
+				if result:
+					now = time()
+
+					self.busy = False
+					#the midpoint of the interval the job finished in keeps the model unbiased
+					job_duration = (busy_until + now) / 2 - self.job_started
+					self.start_idle(self.estimated_finish(self.job_started, busy_until, now))
+					r = self.last_job
+					self.kernel_time.add(job_duration)
+					self.job_durations.add(job_duration)
+
+					iterations += 4294967296
+					t = now - last_rated
+					if t > self.options.rate:
+						self.update_rate(now, iterations, t, r.targetQ)
+						last_rated = now; iterations = 0
+
+					if result != b'NO-NONCE\n':
+						r.nonces = result
+						self.switch.put(r)
+					continue
+				elif result is None:
+					say_line('%s: bad response checking result: %s', (self.id(), response))
+					self.check_interval = min(self.check_interval * 2, MAX_CHECK_INTERVAL)
+				else:
+					busy_until = time()
+					self.check_interval = min(self.check_interval * CHECK_BACKOFF, max(self.job_durations.deviation(), CHECK_INTERVAL), MAX_CHECK_INTERVAL)
+
+			yield self.check_interval
+
+	def queued_session(self):
+		"""Keeps up to QUEUE_DEPTH jobs loaded (ZNX) so that the device goes on
+		with the next as soon as one is done. Finished jobs are collected in
+		batches (ZOX) and found again by their midstate and data. Queued jobs
+		of an older block are flushed (ZQX) when work for a new one comes."""
+		queued = {}
+		last_rated = time()
+		last_finished = busy_until = time()
+		iterations = 0
+		temperature_checked = 0
+		full = False
+
+		while not self.should_stop:
+			now = time()
+			if now - temperature_checked >= TEMPERATURE_INTERVAL:
+				response = yield b'ZLX'
+				cool = self.check_temperature(response)
+				temperature_checked = now
+
+			if self.paused:
+				self.set_state('paused')
+			elif not cool:
+				if self.state != 'overheated':
+					say_line('%s: temperature exceeds cutoff, waiting...', self.id())
+				self.set_state('overheated')
+			elif len(queued) < QUEUE_DEPTH and not full:
+				if (not self.job) or (not self.work_queue.empty()):
+					if self.take_work() and self.job and queued and self.job.header[4:36] != self.last_job.header[4:36]:
+						response = yield b'ZQX'
+						if response[:2] == b'OK':
+							queued.clear()
+						else:
+							say_line('%s: bad response when flushing the queue: %s', (self.id(), response))
+				if self.job:
+					response = yield b'ZNX'
+					if self.is_ok(response):
+						response = yield self.job_data()
+						if response[:9] == b'OK:QUEUED':
 							now = time()
-							
-							self.busy = False
-							r = self.last_job
-							job_duration = now - self.job_started
-							self.put_job()
-	
-							self.min_interval = min(self.min_interval, job_duration)
-	
-							iterations += 4294967296
-							t = now - last_rated
-							if t > self.options.rate:
-								self.update_rate(now, iterations, t, targetQ)
-								last_rated = now; iterations = 0
-
-							if result != b'NO-NONCE\n':
-								r.nonces = result
-								self.switch.put(r)
-	
-							sleep(self.min_interval - (CHECK_INTERVAL * 2))
+							self.set_state('mining')
+							if not queued:
+								last_finished = now
+							self.end_idle(now)
+							busy_until = now
+							self.last_job = self.job_sent()
+							queued[job_key(self.last_job)] = self.last_job
+							continue
+						elif response[:14] == b'ERR:QUEUE FULL':
+							full = True
 						else:
-							if result is None:
-								self.check_interval = min(self.check_interval * 2, 1)
-	
-					sleep(self.check_interval)
+							say_line('%s: bad response when queueing block data: %s', (self.id(), response))
+					else:
+						say_line('%s: bad response when queueing job (ZNX): %s', (self.id(), response))
+
+			if queued:
+				response = yield b'ZOX'
+				if response[:10] != b'INPROCESS:' and response[:6] != b'COUNT:':
+					say_line('%s: bad response checking results: %s', (self.id(), response))
+					yield QUEUE_POLL_INTERVAL
+					continue
+				in_process = None
+				finished = []
+				while response != b'OK\n':
+					if response[:10] == b'INPROCESS:':
+						in_process = int(response[10:])
+					elif response[:6] != b'COUNT:':
+						fields = response.strip().split(b',')
+						job = queued.pop(b','.join(fields[:2]).lower(), None)
+						if job:
+							job.nonces = b','.join(fields[3:])
+							finished.append(job)
+					response = yield b''
+
+				if finished:
+					now = time()
+					full = False
+					#a batch only tells when the last of its jobs was done at the latest
+					job_duration = (now - last_finished) / len(finished)
+					last_finished = now
+					for job in finished:
+						self.kernel_time.add(job_duration)
+						iterations += 4294967296
+						if job.nonces:
+							self.switch.put(job)
+					t = now - last_rated
+					if t > self.options.rate:
+						self.update_rate(now, iterations, t, finished[-1].targetQ)
+						last_rated = now; iterations = 0
+				#jobs run back to back, only polls tell when the last one was done
+				if not queued or in_process == 0:
+					self.start_idle(self.estimated_finish(None, busy_until, time()))
+				else:
+					busy_until = time()
+
+			yield if_else(self.paused and not queued, PAUSE_INTERVAL, QUEUE_POLL_INTERVAL)
+
+	#drives the session when the device has a thread of its own
+	def mining_thread(self):
+		say_line('started miner on %s', (self.id()))
+
+		while not self.should_stop:
+			self.device = None
+			try:
+				self.device = open_device(self.port)
+				session = self.session()
+				response = None
+				while True:
+					try:
+						step = session.send(response)
+					except StopIteration:
+						break
+					if isinstance(step, str):
+						if step:
+							response = request(self.device, step)
+						else:
+							response = self.device.readline()
+						if not response:
+							raise IOError('%s: no response to %s' % (self.id(), step[:3] or 'the rest of an answer'))
+					else:
+						sleep(step)
+						response = None
 			except Exception:
 				say_exception()
-				if self.device:
-					self.device.close()
-					self.device = None
-				sleep(1)
\ No newline at end of file
+			if self.device:
+				self.device.close()
+				self.device = None
+			if not self.should_stop:
+				sleep(RETRY_INTERVAL)
+
+class DeviceChannel(Channel):
+	"""Drives the session of a BFLMiner from the controller thread. Commands
+	are written as the session yields them, the answer is read without
+	blocking when select reports it and waits become deadlines."""
+	def __init__(self, miner):
+		super(DeviceChannel, self).__init__()
+		self.miner = miner
+		self.sock = None
+		self.session = None
+		self.response = ''
+		self.command = None
+		self.due = time()
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def readable(self):
+		return self.command is not None
+
+	def deadline(self):
+		return self.due
+
+	def open(self):
+		self.sock = open_device(self.miner.port, 0)
+		self.session = self.miner.session()
+		self.advance(None)
+
+	def advance(self, response):
+		while True:
+			try:
+				step = self.session.send(response)
+			except StopIteration:
+				self.reset()
+				return
+			if not isinstance(step, str):
+				self.command = None
+				self.due = time() + step
+				return
+			#an empty command asks for the next line of the same answer
+			if step:
+				self.sock.flushInput()
+				self.sock.write(step)
+				self.response = ''
+				self.command = step
+			self.due = time() + RESPONSE_TIMEOUT
+			response = self.next_line()
+			if response is None:
+				return
+
+	def next_line(self):
+		end = self.response.find(b'\n')
+		if end == -1:
+			return None
+		line = self.response[:end + 1]
+		self.response = self.response[end + 1:]
+		return line
+
+	def reset(self):
+		if self.sock:
+			try:
+				self.sock.close()
+			except EnvironmentError:
+				pass
+		self.sock = None
+		self.session = None
+		self.command = None
+		self.due = time() + RETRY_INTERVAL
+
+	def handle_read(self):
+		if self.command is None: return
+		data = self.sock.read(self.sock.inWaiting() or 1)
+		if not data:
+			raise IOError('%s: device went away' % self.miner.id())
+		self.response += data
+		response = self.next_line()
+		if response is not None:
+			self.advance(response)
+		elif len(self.response) > MAX_RESPONSE:
+			raise IOError('%s: response exceeds %d bytes' % (self.miner.id(), MAX_RESPONSE))
+
+	def handle_timeout(self):
+		if self.miner.should_stop:
+			self.close()
+		elif not self.sock:
+			self.open()
+		elif self.command is not None:
+			raise IOError('%s: no response to %s' % (self.miner.id(), self.command[:3]))
+		else:
+			self.advance(None)
+
+	#the device is reopened, the channel only goes when the miner stops
+	def handle_error(self):
+		say_exception()
+		self.reset()
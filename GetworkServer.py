@@ -0,0 +1,141 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StratumServer import parse_address
+from StratumSource import StratumSource
+from collections import OrderedDict
+from json import dumps, loads
+from log import say_line
+from threading import Condition, Event, Thread
+from util import if_else
+
+
+PADDING = '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'
+HASH1 = '00000000000000000000000000000000000000000000000000000000000000000000008000000000000000000000000000000000000000000000000000010000'
+
+LONG_POLL_PATH = '/LP'
+LONG_POLL_TIMEOUT = 600
+SUBMIT_TIMEOUT = 10
+MAX_WORKS = 0x4000
+
+
+class GetworkServer(object):
+	"""Getwork with long polling for miners that do not speak stratum. Work is
+	cut from the jobs of the active StratumSource, submitted data is turned
+	back into mining.submit."""
+	def __init__(self, switch, address):
+		self.switch = switch
+		self.works = OrderedDict()
+		self.block_changed = Condition()
+		self.block = 0
+		self.prevhash = None
+
+		self.httpd = ThreadedHTTPServer(parse_address(address), Handler)
+		self.httpd.getwork_server = self
+		thread = Thread(target=self.httpd.serve_forever, name='getwork server')
+		thread.daemon = True
+		thread.start()
+		say_line('Serving getwork on %s:%d', self.httpd.server_address)
+
+	def source(self):
+		if self.switch.server_index == -1:
+			return None
+		source = getattr(self.switch.server(), 'source', None)
+		if isinstance(source, StratumSource) and source.current_job:
+			return source
+
+	def notify(self, job, clear_jobs):
+		with self.block_changed:
+			if clear_jobs or job.prevhash != self.prevhash:
+				self.prevhash = job.prevhash
+				self.works.clear()
+				self.block += 1
+				self.block_changed.notify_all()
+
+	def wait_for_block(self):
+		with self.block_changed:
+			block = self.block
+			self.block_changed.wait(LONG_POLL_TIMEOUT)
+			return block != self.block
+
+	def getwork(self):
+		source = self.source()
+		job = source and source.next_job()
+		if not job:
+			return None
+
+		data = job.block_header + '00000000'
+		target = source.target(job.link.server_difficulty)
+		with self.block_changed:
+			#version, previous hash and merkle root identify the work on submit
+			self.works[data[:136]] = (source, job)
+			while len(self.works) > MAX_WORKS:
+				self.works.popitem(False)
+
+		midstate = self.switch.decode(source, data, target).state.tostring().encode('hex')
+		return {'data': data + PADDING, 'target': target, 'midstate': midstate, 'hash1': HASH1}
+
+	def submit(self, data):
+		with self.block_changed:
+			work = self.works.get(data[:136])
+		if not work:
+			return False
+		source, job = work
+
+		params = [None, job.job_id, job.extranonce2_prefix + job.extranonce2, data[136:144], data[152:160]]
+		if job.version_mask:
+			params.append('%08x' % (long(data[:8], 16) & job.version_mask))
+
+		answered = Event(); answer = []
+		def callback(result, error):
+			answer.append(result)
+			answered.set()
+		if not source.forward_submit(params, callback, job) or not answered.wait(SUBMIT_TIMEOUT):
+			return False
+		accepted = bool(answer[0])
+		if self.switch.options.verbose:
+			say_line('getwork %s %s', (data[152:160], if_else(accepted, 'accepted', '_rejected_')))
+		return accepted
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		self.answer({'id': 'json', 'params': []})
+
+	def do_POST(self):
+		try:
+			request = loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+		except ValueError:
+			self.send_error(400)
+			return
+		self.answer(request)
+
+	def answer(self, request):
+		server = self.server.getwork_server
+		if self.path.startswith(LONG_POLL_PATH):
+			server.wait_for_block()
+
+		params = request.get('params') or []
+		if params:
+			result = server.submit(params[0])
+		else:
+			result = server.getwork()
+
+		error = None
+		if result is None:
+			error = {'code': -1, 'message': 'No stratum work available'}
+		body = dumps({'id': request.get('id'), 'result': result, 'error': error})
+
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('X-Long-Polling', LONG_POLL_PATH)
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format_, *args):
+		pass
@@ -9,8 +9,10 @@ from time import sleep, time
 from urlparse import urlsplit
 from util import if_else
 import httplib
+import netutil
 import socket
 import socks
+import ssl
 
 
 
@@ -30,6 +32,7 @@ class GetworkSource(Source):
 		self.postdata = {'method': 'getwork', 'id': 'json'}
 		self.headers = {"User-Agent": self.switch.user_agent, "Authorization": 'Basic ' + b64encode('%s:%s' % (self.server().user, self.server().pwd)), "X-Mining-Extensions": 'hostlist midstate rollntime'}
 		self.long_poll_url = ''
+		self.reject_reason = ''
 
 		self.long_poll_active = False
 
@@ -70,32 +73,26 @@ class GetworkSource(Source):
 		if proto == 'https': connector = httplib.HTTPSConnection
 		else: connector = httplib.HTTPConnection
 
-		if not self.options.proxy:
-			return connector(host, strict=True), True
-
-		host, port = host.split(':')
-
-		proxy_proto, user, pwd, proxy_host = self.options.proxy[:4]
-		proxy_port = 9050
-		proxy_host = proxy_host.split(':')
-		if len(proxy_host) > 1:
-			proxy_port = int(proxy_host[1]); proxy_host = proxy_host[0]
-
 		connection = connector(host, strict=True)
-		connection.sock = socks.socksocket()
-
-		proxy_type = socks.PROXY_TYPE_SOCKS5
-		if proxy_proto == 'http':
-			proxy_type = socks.PROXY_TYPE_HTTP
-		elif proxy_proto == 'socks4':
-			proxy_type = socks.PROXY_TYPE_SOCKS4
-
-		connection.sock.setproxy(proxy_type, proxy_host, proxy_port, True, user, pwd)
-		try:
-			connection.sock.connect((host, int(port)))
-		except socks.Socks5AuthError:
-			say_exception('Proxy error:')
-			self.stop()
+		if not self.options.proxy:
+			connection.sock = netutil.connect(connection.host, connection.port)
+		else:
+			connection.sock = self.switch.standby.take(connection.host, connection.port)
+			if not connection.sock:
+				try:
+					connection.sock = netutil.proxy_connect(self.options.proxy, connection.host, connection.port)
+				except socks.Socks5AuthError:
+					say_exception('Proxy error:')
+					self.stop()
+					raise
+		if proto == 'https':
+			#the same checks HTTPSConnection.connect does, certificate, host name and SNI
+			context = getattr(connection, '_context', None)
+			if context:
+				connection.sock = context.wrap_socket(connection.sock, server_hostname=connection.host)
+			else:
+				#Python before 2.7.9 has no certificate checks to keep
+				connection.sock = ssl.wrap_socket(connection.sock, connection.key_file, connection.cert_file)
 		return connection, True
 
 	def request(self, connection, url, headers, data=None, timeout=0):
@@ -122,6 +119,7 @@ class GetworkSource(Source):
 			self.switch.update_time = bool(response.getheader('X-Roll-NTime', ''))
 			hostList = response.getheader('X-Host-List', '')
 			self.stratum_header = response.getheader('x-stratum', '')
+			if data: self.reject_reason = response.getheader('X-Reject-Reason', '')
 			if (not self.options.nsf) and hostList: self.switch.add_servers(loads(hostList))
 			result = loads(response.read())
 			if result['error']:
@@ -165,9 +163,11 @@ class GetworkSource(Source):
 
 	def send_internal(self, result, nonce):
 		data = ''.join([result.header.encode('hex'), pack('III', long(result.time), long(result.difficulty), long(nonce)).encode('hex'), '000000800000000000000000000000000000000000000000000000000000000000000000000000000000000080020000'])
+		sent = time()
 		accepted = self.getwork(data)
 		if accepted != None:
 			self.switch.report(result.miner, nonce, accepted)
+			self.switch.stats(self.server()).submitted(time() - sent, accepted, 'stale' in self.reject_reason.lower())
 			return True
 
 	def long_poll_thread(self):
@@ -192,6 +192,7 @@ class GetworkSource(Source):
 					self.lp_connection, changed = self.ensure_connected(self.lp_connection, proto, host)
 					if changed:
 						say_line("LP connected to %s", self.server().name)
+						self.switch.stats(self.server()).connected()
 						last_host = host
 
 					self.long_poll_active = True
@@ -1,44 +1,98 @@
 from Queue import Queue
-from decimal import Decimal
+from stats import Histogram, KERNEL_BUCKETS, RateWindows
 from threading import Thread
 from time import time
+import log
+
+
+#horizons of the windowed rates in seconds, the --estimate window is added to them
+RATE_HORIZONS = (60, 300, 900)
 
 
 class Miner(object):
+	#settings that can be changed while mining, by name with their types
+	SETTINGS = {}
+
 	def __init__(self, device_index, options):
 		self.device_index = device_index
 		self.options = options
 
 		self.update_time_counter = 1
 		self.share_count = [0, 0]
+		self.hw_errors = 0
 		self.work_queue = Queue()
 
 		self.update = True
+		self.paused = False
+		self.state = None
+		self.reconfigure = False
+		self.temperature = None
 
-		self.accept_hist = []
 		self.rate = self.estimated_rate = 0
+		self.horizons = sorted(set(RATE_HORIZONS + (options.estimate,)))
+		self.hash_rates = RateWindows(self.horizons)
+		#rejected, accepted like share_count, then hardware errors
+		self.event_rates = [RateWindows(self.horizons) for _ in xrange(3)]
+		self.counted = [0, 0, 0]
+		self.kernel_time = Histogram(KERNEL_BUCKETS)
 
 	def start(self):
 		self.should_stop = False
-		Thread(target=self.mining_thread).start()
+		self.start_mining()
 		self.start_time = time()
+		self.hash_rates.add(0, self.start_time)
+		for rates in self.event_rates:
+			rates.add(0, self.start_time)
+
+	def start_mining(self):
+		Thread(target=self.mining_thread).start()
 
 	def stop(self, message = None):
 		if message: print '\n%s' % message
 		self.should_stop = True
+		self.set_state('stopped')
 
+	#mining, paused, overheated, idle or stopped, changes are reported as events
+	def set_state(self, state):
+		if state != self.state:
+			self.state = state
+			log.event('device', device=self.id(), state=state)
+
+	def configure(self, name, value):
+		"""Changes a setting while mining, raises ValueError for settings the
+		miner does not have or values it cannot use."""
+		if name not in self.SETTINGS:
+			raise ValueError('%s has no setting %s' % (self.id(), name))
+		value = self.SETTINGS[name](value)
+		self.check_setting(name, value)
+		setattr(self, name, value)
+		self.reconfigure = True
+
+	def check_setting(self, name, value):
+		pass
+
+	#each iteration is 1000 / rate_divisor hashes
 	def update_rate(self, now, iterations, t, targetQ, rate_divisor=1000):
-		self.rate = int((iterations / t) / rate_divisor)
-		self.rate = Decimal(self.rate) / 1000
-		if self.accept_hist:
-			LAH = self.accept_hist.pop()
-			if LAH[1] != self.share_count[1]:
-				self.accept_hist.append(LAH)
-		self.accept_hist.append((now, self.share_count[1]))
-		while (self.accept_hist[0][0] < now - self.options.estimate):
-			self.accept_hist.pop(0)
-		new_accept = self.share_count[1] - self.accept_hist[0][1]
-		self.estimated_rate = Decimal(new_accept) * (targetQ) / min(int(now - self.start_time), self.options.estimate) / 1000
-		self.estimated_rate = Decimal(self.estimated_rate) / 1000
-
-		self.switch.status_updated(self)
\ No newline at end of file
+		self.rate = float(iterations) / t / rate_divisor / 1000
+		self.hash_rates.add(float(iterations) * 1000 / rate_divisor, now)
+		counts = self.share_count + [self.hw_errors]
+		for i, rates in enumerate(self.event_rates):
+			rates.add(counts[i] - self.counted[i], now)
+		self.counted = counts
+		self.estimated_rate = self.event_rates[1].rate(self.options.estimate) * targetQ / 1000000
+
+		self.switch.registry.set(self, rate=self.rate, estimated_rate=self.estimated_rate)
+
+	def rates(self):
+		"""Hash rate in MH/s and shares and hardware errors per minute, as the
+		moving average and over each horizon."""
+		def per(rates, factor):
+			result = dict((horizon, rates.rate(horizon) * factor) for horizon in self.horizons)
+			result['ewma'] = (rates.ewma or 0) * factor
+			return result
+		return {
+			'hashrate': per(self.hash_rates, 1e-6),
+			'rejected': per(self.event_rates[0], 60),
+			'accepted': per(self.event_rates[1], 60),
+			'hw_errors': per(self.event_rates[2], 60)
+		}
\ No newline at end of file
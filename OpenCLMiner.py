@@ -15,6 +15,9 @@ PYOPENCL = False
 OPENCL = False
 ADL = False
 
+#how often a paused miner looks for being resumed, in seconds
+PAUSE_INTERVAL = 0.1
+
 
 try:
 	import pyopencl as cl
@@ -117,6 +120,8 @@ def initialize(options):
 
 
 class OpenCLMiner(Miner):
+	SETTINGS = {'frames': int, 'worksize': int, 'frameSleep': float}
+
 	def __init__(self, device_index, options):
 		super(OpenCLMiner, self).__init__(device_index, options)
 		self.output_size = 0x100
@@ -126,6 +131,7 @@ class OpenCLMiner(Miner):
 		self.frames = 30
 
 		self.worksize = self.frameSleep= self.rate = self.estimated_rate = 0
+		self.max_worksize = None
 		self.vectors = False
 
 		self.adapterIndex = None
@@ -138,6 +144,14 @@ class OpenCLMiner(Miner):
 	def id(self):
 		return str(self.options.platform) + ':' + str(self.device_index) + ':' + self.device_name
 
+	def check_setting(self, name, value):
+		if name == 'frames' and value < 1:
+			raise ValueError('frames must be at least 1')
+		if name == 'frameSleep' and value < 0:
+			raise ValueError('frameSleep must not be negative')
+		if name == 'worksize' and (value < 1 or (self.max_worksize and value > self.max_worksize)):
+			raise ValueError('worksize must be between 1 and %s' % (self.max_worksize or 'the maximum of the device'))
+
 	def nonce_generator(self, nonces):
 		for i in xrange(self.output_size):
 			if nonces[i]:
@@ -152,8 +166,10 @@ class OpenCLMiner(Miner):
 		self.defines += (' -DOUTPUT_MASK=' + str(self.output_size - 1))
 
 		self.load_kernel()
-		frame = 1.0 / max(self.frames, 3)
-		unit = self.worksize * 256
+		#the API thread may change the settings any time, the loop only uses what it read here or on reconfigure
+		frames, worksize, frame_sleep = self.frames, self.worksize, self.frameSleep
+		frame = 1.0 / max(frames, 3)
+		unit = worksize * 256
 		global_threads = unit * 10
 
 		queue = cl.CommandQueue(self.context)
@@ -169,7 +185,15 @@ class OpenCLMiner(Miner):
 		while True:
 			if self.should_stop: return
 
-			sleep(self.frameSleep)
+			if self.reconfigure:
+				self.reconfigure = False
+				frames, worksize, frame_sleep = self.frames, self.worksize, self.frameSleep
+				frame = 1.0 / max(frames, 3)
+				unit = worksize * 256
+				global_threads = max(unit * int(global_threads / unit), unit)
+				last_hash_rate = 0
+
+			sleep(frame_sleep)
 
 			if (not work) or (not self.work_queue.empty()):
 				try:
@@ -177,6 +201,7 @@ class OpenCLMiner(Miner):
 				except Empty: continue
 				else:
 					if not work: continue
+					self.switch.work_started(work)
 					nonces_left = hashspace
 					state = work.state
 					state2 = work.state2
@@ -204,18 +229,22 @@ class OpenCLMiner(Miner):
 					self.kernel.set_arg(18, f[3])
 					self.kernel.set_arg(19, f[4])
 
-			if temperature < self.cutoff_temp:
+			if temperature < self.cutoff_temp and not self.paused:
+				self.set_state('mining')
 				self.kernel.set_arg(14, pack('I', base))
-				cl.enqueue_nd_range_kernel(queue, self.kernel, (global_threads,), (self.worksize,))
+				kernel_started = time()
+				cl.enqueue_nd_range_kernel(queue, self.kernel, (global_threads,), (worksize,))
 
 				nonces_left -= global_threads
 				threads_run_pace += global_threads
 				threads_run += global_threads
 				base = uint32(base + global_threads)
 			else:
+				self.set_state(if_else(self.paused, 'paused', 'overheated'))
+				kernel_started = None
 				threads_run_pace = 0
 				last_rated_pace = time()
-				sleep(self.cutoff_interval)
+				sleep(if_else(self.paused, PAUSE_INTERVAL, self.cutoff_interval))
 
 			now = time()
 			if self.adapterIndex != None:
@@ -223,7 +252,7 @@ class OpenCLMiner(Miner):
 				if temperature >= self.cutoff_temp or t > 1:
 					last_temperature = now
 					with adl_lock:
-						temperature = self.get_temperature()
+						temperature = self.temperature = self.get_temperature()
 
 			t = now - last_rated_pace
 			if t > 1:
@@ -240,6 +269,8 @@ class OpenCLMiner(Miner):
 				last_rated = now; threads_run = 0
 
 			queue.finish()
+			if kernel_started:
+				self.kernel_time.add(time() - kernel_started)
 			cl.enqueue_read_buffer(queue, output_buffer, output)
 			queue.finish()
 
@@ -261,11 +292,12 @@ class OpenCLMiner(Miner):
 				cl.enqueue_write_buffer(queue, output_buffer, output)
 
 			if not self.switch.update_time:
-				if nonces_left < 3 * global_threads * self.frames:
+				if nonces_left < 3 * global_threads * frames:
 					self.update = True
 					nonces_left += 0xFFFFFFFFFFFF
 				elif 0xFFFFFFFFFFF < nonces_left < 0xFFFFFFFFFFFF:
 					say_line('warning: job finished, %s is idle', self.id()) 
+					self.set_state('idle')
 					work = None
 			elif now - last_n_time > 1:
 				work.time = bytereverse(bytereverse(work.time) + 1)
@@ -330,8 +362,9 @@ class OpenCLMiner(Miner):
 
 		self.kernel = self.program.search
 
+		self.max_worksize = self.kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, self.device)
 		if not self.worksize:
-			self.worksize = self.kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, self.device)
+			self.worksize = self.max_worksize
 
 	def get_temperature(self):
 		temperature = ADLTemperature()
@@ -15,6 +15,9 @@ class Source(object):
 		self.should_stop = False
 		self.last_failback = time()
 
+	def healthy(self):
+		return not getattr(self, 'should_stop', True) and not self.switch.errors
+
 	def check_failback(self):
 		if self.switch.server_index != 0 and time() - self.last_failback > self.options.failback:
 			self.stop()
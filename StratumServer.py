@@ -0,0 +1,240 @@
+from itertools import count
+from json import dumps, loads
+from log import say_exception, say_line
+from reactor import Channel, LineChannel, Reactor
+from threading import Lock
+from util import if_else
+import socket
+import struct
+
+
+DISCOVERY_GROUP = '239.3.3.3'
+DISCOVERY_PORT = 3333
+
+#bytes of the upstream extranonce2 that tell downstream miners apart, 0 is ours
+PREFIX_SIZE = 2
+
+
+def parse_address(address, default_host='0.0.0.0'):
+	host, port = default_host, address
+	if ':' in address:
+		host, port = address.rsplit(':', 1)
+	return host, int(port)
+
+
+class StratumServer(object):
+	"""Serves stratum to downstream miners on the LAN from the single upstream
+	connection of the active StratumSource. Each downstream miner gets its own
+	slice of the upstream extranonce2 space, their submits are forwarded with
+	our upstream credentials."""
+	def __init__(self, switch, address):
+		self.switch = switch
+		self.address = parse_address(address)
+		self.reactor = Reactor('stratum server')
+
+		#clients come and go on the reactor thread while the source broadcasts from its own
+		self.lock = Lock()
+		self.clients = set()
+		self.prefixes = {}
+		self.source = None
+		self.extranonce = None
+		self.extranonce2_size = 0
+		self.difficulty = None
+		self.notify_params = None
+		self.session_ids = count(1)
+
+		self.listener = Listener(self, self.address)
+		self.port = self.listener.sock.getsockname()[1]
+		self.reactor.add(self.listener)
+		say_line('Serving stratum on %s:%d', (self.address[0], self.port))
+
+		try:
+			self.reactor.add(Discovery(self))
+		except socket.error:
+			say_exception('Stratum proxy discovery disabled:')
+
+	def upstream_host(self):
+		if self.source:
+			host, port = self.source.server().host.split(':', 1)
+			return host, int(port)
+
+	def subscribed(self, source):
+		"""Called by the source after a new upstream subscription, returns the
+		extranonce2 prefix the local miners have to use."""
+		if (source, source.extranonce, source.extranonce2_size) != (self.source, self.extranonce, self.extranonce2_size):
+			self.disconnect_clients()
+		self.source = source
+		self.extranonce = source.extranonce
+		self.extranonce2_size = source.extranonce2_size
+		if self.extranonce2_size <= PREFIX_SIZE:
+			say_line('extranonce2 of %s is too short to be shared', source.server().name)
+			return ''
+		return '00' * PREFIX_SIZE
+
+	def disconnect_clients(self):
+		with self.lock:
+			clients = list(self.clients)
+		for client in clients:
+			client.close()
+
+	def set_difficulty(self, difficulty):
+		with self.lock:
+			self.difficulty = difficulty
+			self.broadcast({'id': None, 'method': 'mining.set_difficulty', 'params': [difficulty]})
+
+	def notify(self, params):
+		with self.lock:
+			self.notify_params = params
+			self.broadcast({'id': None, 'method': 'mining.notify', 'params': params})
+
+	#callers hold the lock, client sends never wait
+	def broadcast(self, message):
+		data = dumps(message) + '\n'
+		for client in self.clients:
+			if client.subscribed:
+				client.send(data)
+
+	def add_client(self, client):
+		with self.lock:
+			self.clients.add(client)
+
+	def allocate_prefix(self, client):
+		with self.lock:
+			for prefix in xrange(1, 256 ** PREFIX_SIZE):
+				if prefix not in self.prefixes:
+					self.prefixes[prefix] = client
+					return ('%0' + str(PREFIX_SIZE * 2) + 'x') % prefix
+
+	def release(self, client):
+		with self.lock:
+			self.clients.discard(client)
+			if client.prefix:
+				self.prefixes.pop(long(client.prefix, 16), None)
+
+class Listener(Channel):
+	def __init__(self, server, address):
+		super(Listener, self).__init__()
+		self.server = server
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(address)
+		self.sock.listen(16)
+		self.sock.setblocking(0)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def handle_read(self):
+		try:
+			sock, address = self.sock.accept()
+		except socket.error:
+			return
+		client = Client(sock, address, self.server)
+		self.server.add_client(client)
+		self.server.reactor.add(client)
+
+class Discovery(Channel):
+	"""Answers the mining.get_upstream multicast query of detect_stratum_proxy."""
+	def __init__(self, server):
+		super(Discovery, self).__init__()
+		self.server = server
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('', DISCOVERY_PORT))
+		membership = struct.pack('4sl', socket.inet_aton(DISCOVERY_GROUP), socket.INADDR_ANY)
+		self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+		self.sock.setblocking(0)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def handle_read(self):
+		try:
+			data, address = self.sock.recvfrom(1024)
+			request = loads(data)
+		except (socket.error, ValueError):
+			return
+		upstream = self.server.upstream_host()
+		if request.get('method') != 'mining.get_upstream' or not upstream:
+			return
+		response = {'id': request.get('id'), 'result': [list(upstream), self.server.port], 'error': None}
+		try:
+			self.sock.sendto(dumps(response, separators=(',', ':')), address)
+		except socket.error:
+			pass
+
+class Client(LineChannel):
+	def __init__(self, sock, address, server):
+		super(Client, self).__init__(sock)
+		self.server = server
+		self.name = '%s:%d' % address
+		self.prefix = None
+		self.subscribed = False
+		self.accepted = self.rejected = 0
+
+	#never wait for a slow client, it is dropped once its buffer is full
+	def send(self, data):
+		if not super(Client, self).send(data, timeout=0):
+			self.close()
+
+	def respond(self, id_, result, error=None):
+		self.send(dumps({'id': id_, 'result': result, 'error': error}) + '\n')
+
+	def handle_close(self):
+		self.server.release(self)
+		if self.subscribed:
+			say_line('Stratum client %s disconnected', self.name)
+
+	def handle_line(self, line):
+		message = loads(line)
+		method = message.get('method')
+		id_ = message.get('id')
+		params = message.get('params') or []
+		server = self.server
+		source = server.source
+
+		if method == 'mining.subscribe':
+			if not source or not server.extranonce or server.extranonce2_size <= PREFIX_SIZE:
+				self.respond(id_, None, [20, 'No upstream', None])
+				return
+			if not self.prefix:
+				self.prefix = server.allocate_prefix(self)
+			if not self.prefix:
+				self.respond(id_, None, [20, 'Too many clients', None])
+				return
+			session_id = 'poclbm%d' % server.session_ids.next()
+			#no broadcast may fall between the current job and the subscription
+			with server.lock:
+				self.respond(id_, [[['mining.set_difficulty', session_id], ['mining.notify', session_id]], server.extranonce + self.prefix, server.extranonce2_size - PREFIX_SIZE])
+				self.subscribed = True
+				if server.difficulty:
+					self.send(dumps({'id': None, 'method': 'mining.set_difficulty', 'params': [server.difficulty]}) + '\n')
+				if server.notify_params:
+					self.send(dumps({'id': None, 'method': 'mining.notify', 'params': server.notify_params[:8] + [True]}) + '\n')
+			say_line('Stratum client %s subscribed', self.name)
+
+		elif method == 'mining.authorize':
+			self.respond(id_, True)
+
+		elif method == 'mining.configure':
+			mask = if_else(source, source and source.version_mask, 0)
+			if mask:
+				self.respond(id_, {'version-rolling': True, 'version-rolling.mask': '%08x' % mask})
+			else:
+				self.respond(id_, {'version-rolling': False})
+
+		elif method == 'mining.submit':
+			if not self.subscribed or not source or len(params) < 5:
+				self.respond(id_, None, [25, 'Not subscribed', None])
+				return
+			def answer(result, error):
+				if result: self.accepted += 1
+				else: self.rejected += 1
+				self.respond(id_, result, error)
+			upstream_params = list(params)
+			upstream_params[2] = self.prefix + params[2]
+			if not source.forward_submit(upstream_params, answer):
+				self.respond(id_, None, [20, 'Upstream unavailable', None])
+
+		elif id_ is not None and method:
+			self.respond(id_, None, [20, 'Unsupported method', None])
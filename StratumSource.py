@@ -1,14 +1,17 @@
 from Source import Source
+from collections import deque
 from binascii import hexlify, unhexlify
 from hashlib import sha256
 from json import dumps, loads
 from log import say_exception, say_line
+from reactor import LineChannel, Reactor
 from struct import pack
-from threading import Thread, Lock, Timer
+from copy import copy
+from threading import Event, Lock, Thread, Timer
 from time import sleep, time
-from util import chunks, Object
-import asynchat
-import asyncore
+from itertools import count
+from util import chunks, if_else, Object
+import netutil
 import socket
 import socks
 
@@ -17,6 +20,19 @@ import socks
 
 
 BASE_DIFFICULTY = 0x00000000FFFF0000000000000000000000000000000000000000000000000000
+HANDSHAKE_TIMEOUT = 10
+VERSION_ROLLING_MASK = 0x1fffe000
+SUGGEST_INTERVAL = 60
+PASSWORD_SUGGEST_INTERVAL = 600
+LINK_RETRY = 30
+
+#pools answer shares of replaced jobs with error 21 (job not found) or a message about staleness
+def is_stale(error):
+	if isinstance(error, (list, tuple)) and error:
+		if error[0] == 21:
+			return True
+		error = error[1:2] and error[1]
+	return 'stale' in unicode(error or '').lower()
 
 def detect_stratum_proxy(host):
 	s = None
@@ -53,17 +69,33 @@ class StratumSource(Source):
 		super(StratumSource, self).__init__(switch)
 		self.handler = None
 		self.socket = None
-		self.channel_map = {}
-		self.subscribed = False
+		self.reactor = Reactor('stratum')
+		self.subscribed = Event()
 		self.authorized = None
+		self.authorize_sent = 0
 		self.submits = {}
 		self.last_submits_cleanup = time()
 		self.server_difficulty = BASE_DIFFICULTY
 		self.jobs = {}
 		self.current_job = None
+		self.job_lock = Lock()
 		self.extranonce = ''
 		self.extranonce2_size = 4
-		self.send_lock = Lock()
+		self.extranonce2_prefix = ''
+		self.forwarded = {}
+		self.forward_ids = count()
+		self.session_id = None
+		self.resumed = False
+		self.version_mask = 0
+		self.difficulty = 1
+		self.difficulty_controller = None
+		if self.options.share_rate:
+			self.difficulty_controller = DifficultyController(self, *self.options.share_rate)
+		self.rtt = None
+		self.links = []
+		self.job_link = None
+		self.prevhash = None
+		self.prevhashes = deque(maxlen=16)
 
 	def loop(self):
 		super(StratumSource, self).loop()
@@ -76,75 +108,131 @@ class StratumSource(Source):
 			if self.current_job:
 				miner = self.switch.updatable_miner()
 				while miner:
-					self.current_job = self.refresh_job(self.current_job)
-					self.queue_work(self.current_job, miner)
+					job = self.next_job()
+					if not job:
+						miner.update = True
+						break
+					self.queue_work(job, miner)
 					miner = self.switch.updatable_miner()
 
 			if self.check_failback():
 				return True
 
+			if self.handler and self.authorized is None and time() - self.authorize_sent > HANDSHAKE_TIMEOUT:
+				say_line('No authorization response from %s', self.server().name)
+				self.stop()
+				continue
+
+			if self.handler and self.difficulty_controller:
+				self.difficulty_controller.check(time())
+
 			if not self.handler:
 				try:
-					#socket = ssl.wrap_socket(socket)
-					address, port = self.server().host.split(':', 1)
-
-
-					if not self.options.proxy:
-						self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-						self.socket.connect((address, int(port)))
-					else:
-						proxy_proto, user, pwd, proxy_host = self.options.proxy[:4]
-						proxy_port = 9050
-						proxy_host = proxy_host.split(':')
-						if len(proxy_host) > 1:
-							proxy_port = int(proxy_host[1]); proxy_host = proxy_host[0]
-
-						self.socket = socks.socksocket()
-				
-						proxy_type = socks.PROXY_TYPE_SOCKS5
-						if proxy_proto == 'http':
-							proxy_type = socks.PROXY_TYPE_HTTP
-						elif proxy_proto == 'socks4':
-							proxy_type = socks.PROXY_TYPE_SOCKS4
-				
-						self.socket.setproxy(proxy_type, proxy_host, proxy_port, True, user, pwd)
-						try:
-							self.socket.connect((address, int(port)))
-						except socks.Socks5AuthError:
-							say_exception('Proxy error:')
-							self.stop()
-
-					self.handler = Handler(self.socket, self.channel_map, self)
-					thread = Thread(target=self.asyncore_thread)
-					thread.daemon = True
-					thread.start()
-
-					if not self.subscribe():
+					started = time()
+					self.socket = self.connect(self.server().host)
+					if not self.socket:
+						continue
+					self.switch.stats(self.server()).connected(time() - started)
+
+					self.handler = Handler(self.socket, self)
+					self.reactor.add(self.handler)
+
+					if not self.handshake():
 						say_line('Failed to subscribe')
 						self.stop()
-					elif not self.authorize():
-						self.stop()
 
-				except socket.error:
+				except (socket.error, socks.ProxyError):
 					say_exception()
 					self.stop()
 					continue
 
-			with self.send_lock:
-				self.process_result_queue()
+			if self.handler and self.options.stratum_links > 1:
+				self.maintain_links()
+
+			self.process_result_queue()
 			sleep(1)
 
-	def asyncore_thread(self):
-		asyncore.loop(map=self.channel_map)
+	def connect(self, host):
+		#socket = ssl.wrap_socket(socket)
+		try:
+			return self.open_connection(host)
+		except socks.Socks5AuthError:
+			say_exception('Proxy error:')
+			self.stop()
+			return None
+
+	#raises socket.error or socks.ProxyError
+	def open_connection(self, host):
+		address, port = host.split(':', 1)
+
+		if not self.options.proxy:
+			return netutil.connect(address, int(port))
+
+		sock = self.switch.standby.take(address, int(port))
+		if sock:
+			return sock
+		return netutil.proxy_connect(self.options.proxy, address, int(port))
+
+	#extra connections to other endpoints of the same pool account
+	def maintain_links(self):
+		linked = [link.server().host for link in self.links]
+		for server in self.switch.servers:
+			if len(self.links) >= self.options.stratum_links - 1:
+				break
+			if server.user == self.server().user and server.host != self.server().host and server.host not in linked and server.proto in ('stratum', self.server().proto):
+				self.links.append(Link(self, server))
+				linked.append(server.host)
+
+		now = time()
+		for link in self.links:
+			if not link.handler and not link.connecting and now - link.last_attempt > LINK_RETRY:
+				link.connect()
+
+	def healthy(self):
+		return bool(self.handler and self.authorized and self.subscribed.is_set())
+
+	def sample_rtt(self, rtt):
+		if self.rtt is None:
+			self.rtt = rtt
+		else:
+			self.rtt = (self.rtt * 4 + rtt) / 5
+
+	#healthy connections able to submit for the job, fastest first
+	def routes(self, job):
+		routes = [link for link in [self] + self.links if link.healthy() and link.extranonce == job.extranonce1]
+		routes.sort(key=lambda link: if_else(link.rtt is None, HANDSHAKE_TIMEOUT, link.rtt))
+		return routes
 
 	def stop(self):
 		self.should_stop = True
 		if self.handler:
 			self.handler.close()
-
+			self.handler = None
+		for link in self.links:
+			link.stop()
+		self.links = []
+		self.reactor.stop()
+		self.job_link = self.prevhash = None
+		self.prevhashes.clear()
+
+	#unique work from the current job, safe to call from other threads
+	def next_job(self):
+		with self.job_lock:
+			j = self.current_job
+			if j:
+				self.refresh_job(j)
+				return copy(j)
+
+	#with version rolling a job first runs through the allowed version bits
+	#and only then needs a new extranonce2 and merkle root
 	def refresh_job(self, j):
+		if j.version_mask and j.merkle_root:
+			j.version_bits = ((j.version_bits | ~j.version_mask) + 1) & j.version_mask
+			if j.version_bits:
+				return self.build_header(j)
+
 		j.extranonce2 = self.increment_nonce(j.extranonce2)
-		coinbase = j.coinbase1 + self.extranonce + j.extranonce2 + j.coinbase2
+		coinbase = j.coinbase1 + j.extranonce1 + j.extranonce2_prefix + j.extranonce2 + j.coinbase2
 		coinbase_hash = sha256(sha256(unhexlify(coinbase)).digest()).digest()
 
 		merkle_root = coinbase_hash
@@ -153,18 +241,90 @@ class StratumSource(Source):
 		merkle_root_reversed = ''
 		for word in chunks(merkle_root, 4):
 			merkle_root_reversed += word[::-1]
-		merkle_root = hexlify(merkle_root_reversed)
+		j.merkle_root = hexlify(merkle_root_reversed)
+		j.version_bits = 0
 
-		j.block_header = ''.join([j.version, j.prevhash, merkle_root, j.ntime, j.nbits])
+		return self.build_header(j)
+
+	def build_header(self, j):
+		version = '%08x' % (long(j.version, 16) ^ j.version_bits)
+		j.block_header = ''.join([version, j.prevhash, j.merkle_root, j.ntime, j.nbits])
 		j.time = time()
 		return j
 		
 
 	def increment_nonce(self, nonce):
 		next_nonce = long(nonce, 16) + 1
-		if len('%x' % next_nonce) > (self.extranonce2_size * 2):
-			return '00' * self.extranonce2_size
-		return ('%0' + str(self.extranonce2_size * 2) +'x') % next_nonce
+		if len('%x' % next_nonce) > len(nonce):
+			return '00' * (len(nonce) / 2)
+		return ('%0' + str(len(nonce)) +'x') % next_nonce
+
+	#with several links the first notify of a new block wins, later
+	#notifies only count if they come from the link that won the block
+	def accept_notify(self, link, prevhash):
+		if prevhash != self.prevhash:
+			if self.links and prevhash in self.prevhashes:
+				return False
+			self.prevhashes.append(prevhash)
+			self.prevhash = prevhash
+			if self.links and link is not self.job_link and self.options.verbose:
+				say_line('new block first seen on %s', link.server().name)
+			self.job_link = link
+			return True
+		if link is self.job_link or not self.job_link or not self.job_link.healthy():
+			self.job_link = link
+			return True
+		return False
+
+	#jobs are changed under job_lock only, miners get a copy of the job
+	def notify(self, link, params):
+		with self.job_lock:
+			work = self.add_job(link, params)
+		if not work:
+			return
+
+		self.queue_work(work)
+		self.switch.connection_ok()
+
+		if self.switch.getwork_server:
+			self.switch.getwork_server.notify(work, params[8])
+
+	def add_job(self, link, params):
+		if not self.accept_notify(link, params[1]):
+			return None
+
+		j = Object()
+
+		j.job_id = params[0]
+		j.prevhash = params[1]
+		j.coinbase1 = params[2]
+		j.coinbase2 = params[3]
+		j.merkle_branch = params[4]
+		j.version = params[5]
+		j.nbits = params[6]
+		j.ntime = params[7]
+		clear_jobs = params[8]
+		if clear_jobs:
+			#jobs of the same block survive the reconnect of a resumed session
+			#and stay usable on the other links until they see the new block
+			for key, job in self.jobs.items():
+				if job.prevhash != j.prevhash or (key[0] is link and not self.resumed):
+					del self.jobs[key]
+		self.resumed = False
+		#the prefix is the part of extranonce2 shared with stratum clients
+		j.link = link
+		j.extranonce1 = link.extranonce
+		j.extranonce2_prefix = link.extranonce2_prefix
+		j.extranonce2 = (link.extranonce2_size - len(link.extranonce2_prefix) / 2) * '00'
+		j.version_mask = link.version_mask
+		j.merkle_root = None
+
+		j = self.refresh_job(j)
+
+		#job ids are only unique per connection
+		self.jobs[(link, j.job_id)] = j
+		self.current_job = j
+		return copy(j)
 
 	def handle_message(self, message):
 
@@ -173,40 +333,25 @@ class StratumSource(Source):
 
 			#mining.notify
 			if message['method'] == 'mining.notify':
-				params = message['params']
-
-				j = Object()
-
-				j.job_id = params[0]
-				j.prevhash = params[1]
-				j.coinbase1 = params[2]
-				j.coinbase2 = params[3]
-				j.merkle_branch = params[4]
-				j.version = params[5]
-				j.nbits = params[6]
-				j.ntime = params[7]
-				clear_jobs = params[8]
-				if clear_jobs:
-					self.jobs.clear()
-				j.extranonce2 = self.extranonce2_size * '00'
-
-				j = self.refresh_job(j)
-
-				self.jobs[j.job_id] = j
-				self.current_job = j
-
-				self.queue_work(j)
-				self.switch.connection_ok()
+				if self.switch.stratum_server:
+					self.switch.stratum_server.notify(message['params'])
+				self.notify(self, message['params'])
 
 			#mining.get_version
 			if message['method'] == 'mining.get_version':
-				with self.send_lock:
-					self.send_message({"error": None, "id": message['id'], "result": self.user_agent})
+				self.send_message({"error": None, "id": message['id'], "result": self.switch.user_agent})
 
 			#mining.set_difficulty
 			elif message['method'] == 'mining.set_difficulty':
 				say_line("Setting new difficulty: %s", message['params'][0])
+				self.difficulty = message['params'][0]
 				self.server_difficulty = BASE_DIFFICULTY / message['params'][0]
+				if self.switch.stratum_server:
+					self.switch.stratum_server.set_difficulty(self.difficulty)
+
+			#mining.set_version_mask
+			elif message['method'] == 'mining.set_version_mask':
+				self.set_version_mask(message['params'][0])
 
 			#client.reconnect
 			elif message['method'] == 'client.reconnect':
@@ -226,77 +371,221 @@ class StratumSource(Source):
 		#responses to server API requests
 		elif 'result' in message:
 
+			#response to mining.configure
+			if message['id'] == 'c':
+				result = message['result'] or {}
+				if result.get('version-rolling'):
+					self.set_version_mask(result.get('version-rolling.mask', '0'))
+				else:
+					say_line('%s does not support version rolling', self.server().name)
+					self.version_mask = 0
+
 			#response to mining.subscribe
 			#store extranonce and extranonce2_size
-			if message['id'] == 's':
-				self.extranonce = message['result'][1]
-				self.extranonce2_size = message['result'][2]
-				self.subscribed = True
+			elif message['id'] == 's' and (not message['result'] or message.get('error')):
+				#a pool that does not know the session any more may refuse the subscription instead of starting a new one
+				if self.session_id:
+					say_line('%s refused to resume the session, subscribing anew', self.server().name)
+					self.session_id = None
+					self.extranonce = ''
+					self.forget(self)
+					self.send_message({'id': 's', 'method': 'mining.subscribe', 'params': [self.switch.user_agent]})
+				else:
+					say_line('%s refused the subscription: %s', (self.server().name, message.get('error')))
+
+			elif message['id'] == 's':
+				session_id = self.subscription_id(message['result'][0])
+				extranonce = message['result'][1]
+				extranonce2_size = message['result'][2]
+				if self.extranonce and (extranonce, extranonce2_size) == (self.extranonce, self.extranonce2_size):
+					say_line('Resumed session with %s', self.server().name)
+					self.resumed = True
+					self.subscribed.set()
+					self.resubmit()
+				else:
+					if self.extranonce:
+						self.forget(self)
+					self.resumed = False
+					self.extranonce = extranonce
+					self.extranonce2_size = extranonce2_size
+					if self.switch.stratum_server:
+						self.extranonce2_prefix = self.switch.stratum_server.subscribed(self)
+					self.subscribed.set()
+				self.session_id = session_id
 
-			#check if this is submit confirmation (message id should be in submits dictionary)
-			#cleanup if necessary
 			elif message['id'] in self.submits:
-				miner, nonce = self.submits[message['id']][:2]
-				accepted = message['result']
-				self.switch.report(miner, nonce, accepted)
-				del self.submits[message['id']]
-				if time() - self.last_submits_cleanup > 3600:
-					now = time()
-					for key, value in self.submits.items():
-						if now - value[2] > 3600:
-							del self.submits[key]
-					self.last_submits_cleanup = now
+				self.sample_rtt(time() - self.submits[message['id']][2])
+				self.handle_reply(message, self)
+
+			elif message['id'] in self.forwarded:
+				self.handle_reply(message, self)
 
 			#response to mining.authorize
 			elif message['id'] == self.server().user:
 				if not message['result']:
 					say_line('authorization failed with %s:%s@%s', (self.server().user, self.server().pwd, self.server().host))
 					self.authorized = False
+					self.stop()
 				else:
 					self.authorized = True
 
+	#answers to submits, whichever link carried them
+	def handle_reply(self, message, link):
+		#check if this is submit confirmation (message id should be in submits dictionary)
+		#cleanup if necessary
+		if message['id'] in self.submits:
+			miner, nonce, sent = self.submits[message['id']][:3]
+			accepted = message['result']
+			self.switch.report(miner, nonce, accepted)
+			self.switch.stats(link.server()).submitted(time() - sent, accepted, is_stale(message.get('error')))
+			del self.submits[message['id']]
+			if time() - self.last_submits_cleanup > 3600:
+				now = time()
+				for key, value in self.submits.items():
+					if now - value[2] > 3600:
+						del self.submits[key]
+				for key, value in self.forwarded.items():
+					if now - value[1] > 3600:
+						del self.forwarded[key]
+				self.last_submits_cleanup = now
+
+		#answer to a submit of a stratum client
+		elif message['id'] in self.forwarded:
+			callback = self.forwarded.pop(message['id'])[0]
+			callback(message['result'], message.get('error'))
+
 	def reconnect(self):
 		say_line("%s reconnecting to %s", (self.server().name, self.server().host))
-		self.handler.close()
-
-	def subscribe(self):
-		self.send_message({'id': 's', 'method': 'mining.subscribe', 'params': []})
-		for i in xrange(10):
-			sleep(1)
-			if self.subscribed: break
-		return self.subscribed
-
-	def authorize(self):
-		self.send_message({'id': self.server().user, 'method': 'mining.authorize', 'params': [self.server().user, self.server().pwd]})
-		for i in xrange(10):
-			sleep(1)
-			if self.authorized != None: break
-		return self.authorized
-
+		handler = self.handler
+		if handler:
+			handler.close()
+
+	#subscribe and authorize go out together, only the subscription is waited for
+	#jobs are used as soon as they are notified, a failed authorization drops the connection later
+	def handshake(self):
+		self.subscribed.clear()
+		self.authorized = None
+		self.authorize_sent = time()
+		if self.options.version_rolling:
+			self.send_message({'id': 'c', 'method': 'mining.configure', 'params': [['version-rolling'], {'version-rolling.mask': '%08x' % VERSION_ROLLING_MASK, 'version-rolling.min-bit-count': 2}]})
+		params = [self.switch.user_agent]
+		if self.session_id:
+			params.append(self.session_id)
+		self.send_message({'id': 's', 'method': 'mining.subscribe', 'params': params})
+		self.send_message({'id': self.server().user, 'method': 'mining.authorize', 'params': [self.server().user, self.password()]})
+		if self.difficulty_controller and self.difficulty_controller.suggested and self.options.suggest_difficulty == 'method':
+			self.send_message({'id': 'd', 'method': 'mining.suggest_difficulty', 'params': [self.difficulty_controller.suggested]})
+		return self.subscribed.wait(HANDSHAKE_TIMEOUT)
+
+	#the d=N password convention, replaces a difficulty already given by the user
+	def password(self):
+		pwd = self.server().pwd
+		if not self.difficulty_controller or not self.difficulty_controller.suggested or self.options.suggest_difficulty != 'password':
+			return pwd
+		fields = [field for field in pwd.split(',') if field and not field.startswith('d=')]
+		fields.append('d=%s' % self.difficulty_controller.suggested)
+		return ','.join(fields)
+
+	def suggest_difficulty(self, difficulty):
+		if self.options.suggest_difficulty == 'password':
+			self.reconnect()
+		else:
+			self.send_message({'id': 'd', 'method': 'mining.suggest_difficulty', 'params': [difficulty]})
+
+	def set_version_mask(self, mask):
+		self.version_mask = long(mask, 16) & VERSION_ROLLING_MASK
+		say_line('Version rolling mask: %08x', self.version_mask)
+
+	def subscription_id(self, subscriptions):
+		if subscriptions and isinstance(subscriptions[0], basestring):
+			subscriptions = [subscriptions]
+		for subscription in subscriptions or []:
+			if subscription[0] == 'mining.notify':
+				return subscription[1]
+
+	#jobs and submits of one connection that lost its extranonce1, the other links keep theirs
+	def forget(self, link):
+		with self.job_lock:
+			for key in self.jobs.keys():
+				if key[0] is link:
+					del self.jobs[key]
+			if self.current_job and self.current_job.link is link:
+				self.current_job = None
+		for id_, submit in self.submits.items():
+			if submit[4][0] is link:
+				del self.submits[id_]
+
+	#submits the old connection never answered are still valid in a resumed session
+	def resubmit(self):
+		for id_, (miner, nonce, sent, message, key) in self.submits.items():
+			if key[0] is not self:
+				continue
+			if key in self.jobs:
+				self.send_message(message)
+			else:
+				del self.submits[id_]
+
+	#work carries the (link, job_id) key of the job it was made from
 	def send_internal(self, result, nonce):
-		job_id = result.job_id
-		if not job_id in self.jobs:
+		key = result.job_id
+		with self.job_lock:
+			job = self.jobs.get(key)
+		if not job:
+			self.switch.stats(self.server()).discard()
 			return True
-		extranonce2 = result.extranonce2
+		job_id = job.job_id
+		extranonce2 = job.extranonce2_prefix + result.extranonce2
 		ntime = pack('I', long(result.time)).encode('hex')
 		hex_nonce = pack('I', long(nonce)).encode('hex')
 		id_ = job_id + hex_nonce
-		self.submits[id_] = (result.miner, nonce, time())
-		return self.send_message({'params': [self.server().user, job_id, extranonce2, ntime, hex_nonce], 'id': id_, 'method': u'mining.submit'})
-
-	def send_message(self, message):
+		params = [self.server().user, job_id, extranonce2, ntime, hex_nonce]
+		if job.version_mask:
+			version_bits = '%08x' % (long(hexlify(result.header[:4]), 16) & job.version_mask)
+			params.append(version_bits)
+			id_ += version_bits
+		message = {'params': params, 'id': id_, 'method': u'mining.submit'}
+		self.submits[id_] = (result.miner, nonce, time(), message, key)
+		#block candidates go out at once, shares may wait for others to share a write
+		delay = if_else(self.switch.sent[nonce][0], 0, self.options.submit_delay / 1000000.0)
+		return self.submit(job, message, delay)
+
+	#the fastest healthy link with the job's extranonce1 carries the submit
+	def submit(self, job, message, delay):
+		for link in self.routes(job):
+			if link.send_message(message, delay):
+				return True
+		if job.link is self:
+			return self.send_message(message, delay)
+		#the link the job came from is gone and no other link shares its extranonce1
+		return True
+
+	def forward_submit(self, params, callback, job=None):
+		id_ = 'f%d' % self.forward_ids.next()
+		self.forwarded[id_] = (callback, time())
+		params = [self.server().user] + list(params[1:])
+		message = {'params': params, 'id': id_, 'method': u'mining.submit'}
+		delay = self.options.submit_delay / 1000000.0
+		if job:
+			sent = self.submit(job, message, delay)
+		else:
+			sent = self.send_message(message, delay)
+		if not sent:
+			del self.forwarded[id_]
+			return False
+		return True
+
+	def send_message(self, message, delay=0):
 		data = dumps(message) + '\n'
 		try:
-			#self.handler.push(data)
-
-			#there is some bug with asyncore's send mechanism
-			#so we send data 'manually'
-			#note that this is not thread safe
-			if not self.handler:
+			handler = self.handler
+			if not handler:
+				return False
+			if not handler.send(data, delay):
+				#a closed connection is reconnected by the loop, only a stalled one is given up
+				if not handler.closing:
+					say_line('%s: send timed out', self.server().name)
+					self.stop()
 				return False
-			while data:
-				sent = self.handler.send(data)
-				data = data[sent:]
 			return True
 		except AttributeError:
 			self.stop()
@@ -304,30 +593,171 @@ class StratumSource(Source):
 			say_exception()
 			self.stop()
 
+	def target(self, server_difficulty):
+		return ''.join(list(chunks('%064x' % server_difficulty, 2))[::-1])
+
 	def queue_work(self, work, miner=None):
-		target = ''.join(list(chunks('%064x' % self.server_difficulty, 2))[::-1])
-		self.switch.queue_work(self, work.block_header, target, work.job_id, work.extranonce2, miner)
+		self.switch.queue_work(self, work.block_header, self.target(work.link.server_difficulty), (work.link, work.job_id), work.extranonce2, miner)
+
+class DifficultyController(object):
+	"""Suggests a difficulty at which the combined hash rate of all miners
+	finds between low and high shares per minute."""
+	def __init__(self, source, low, high):
+		self.source = source
+		self.low = low
+		self.high = high
+		self.suggested = None
+		self.last_suggestion = time()
+
+	def check(self, now):
+		interval = if_else(self.source.options.suggest_difficulty == 'password', PASSWORD_SUGGEST_INTERVAL, SUGGEST_INTERVAL)
+		if now - self.last_suggestion < interval:
+			return
+		self.last_suggestion = now
+
+		hashrate = self.source.switch.registry.total()['rate'] * 1000000
+		if not hashrate:
+			return
+
+		shares_per_minute = hashrate * 60 / (self.source.difficulty * 2**32)
+		if self.low <= shares_per_minute <= self.high:
+			return
+
+		difficulty = hashrate * 60 / ((self.low + self.high) / 2.0 * 2**32)
+		difficulty = if_else(difficulty >= 1, int(round(difficulty)), round(difficulty, 4)) or 0.0001
+		if difficulty == self.suggested:
+			return
+		self.suggested = difficulty
+		say_line('%.1f shares/min at difficulty %s, suggesting difficulty %s', (shares_per_minute, self.source.difficulty, difficulty))
+		self.source.suggest_difficulty(difficulty)
+
+class Link(object):
+	"""Another connection to the same pool account on a different endpoint.
+	Its jobs compete with those of the primary connection and it carries
+	submits whenever it is the fastest route for them."""
+	def __init__(self, source, server):
+		self.source = source
+		self.entry = server
+		self.handler = None
+		self.socket = None
+		self.extranonce = None
+		self.extranonce2_size = 4
+		self.extranonce2_prefix = ''
+		self.version_mask = 0
+		self.server_difficulty = BASE_DIFFICULTY
+		self.authorized = None
+		self.rtt = None
+		self.last_attempt = 0
+		self.subscribe_sent = 0
+		self.connecting = False
+
+	def server(self):
+		return self.entry
+
+	#connecting may take seconds, the source loop does not wait for it
+	def connect(self):
+		self.last_attempt = time()
+		self.extranonce = self.authorized = None
+		self.connecting = True
+		thread = Thread(target=self.connect_thread, name='stratum link')
+		thread.daemon = True
+		thread.start()
+
+	def connect_thread(self):
+		try:
+			try:
+				sock = self.source.open_connection(self.entry.host)
+			except (socket.error, socks.ProxyError):
+				say_line('Link to %s failed', self.entry.name)
+				return
+			#the source stopped or moved on meanwhile
+			if self.source.should_stop or self not in self.source.links:
+				sock.close()
+				return
+			self.socket = sock
+			self.open()
+		finally:
+			self.connecting = False
+
+	def open(self):
+		self.source.switch.stats(self.entry).connected(time() - self.last_attempt)
+		self.handler = Handler(self.socket, self)
+		self.source.reactor.add(self.handler)
+
+		self.subscribe_sent = time()
+		if self.source.options.version_rolling:
+			self.send_message({'id': 'c', 'method': 'mining.configure', 'params': [['version-rolling'], {'version-rolling.mask': '%08x' % VERSION_ROLLING_MASK, 'version-rolling.min-bit-count': 2}]})
+		self.send_message({'id': 's', 'method': 'mining.subscribe', 'params': [self.source.switch.user_agent]})
+		self.send_message({'id': self.entry.user, 'method': 'mining.authorize', 'params': [self.entry.user, self.entry.pwd]})
+
+	def healthy(self):
+		return bool(self.handler and self.authorized and self.extranonce is not None)
+
+	def sample_rtt(self, rtt):
+		if self.rtt is None:
+			self.rtt = rtt
+		else:
+			self.rtt = (self.rtt * 4 + rtt) / 5
 
-class Handler(asynchat.async_chat):
-	def __init__(self, socket, map_, parent):
-		asynchat.async_chat.__init__(self, socket, map_)
+	def stop(self):
+		if self.handler:
+			self.handler.close()
+			self.handler = None
+
+	def send_message(self, message, delay=0):
+		handler = self.handler
+		if handler and handler.send(dumps(message) + '\n', delay):
+			return True
+		self.stop()
+		return False
+
+	def handle_message(self, message):
+		if 'method' in message:
+			if message['method'] == 'mining.notify':
+				if self.extranonce is not None:
+					self.source.notify(self, message['params'])
+			elif message['method'] == 'mining.set_difficulty':
+				self.server_difficulty = BASE_DIFFICULTY / message['params'][0]
+			elif message['method'] == 'mining.set_version_mask':
+				self.version_mask = long(message['params'][0], 16) & VERSION_ROLLING_MASK
+
+		elif 'result' in message:
+			id_ = message['id']
+			if id_ == 'c':
+				result = message['result'] or {}
+				if result.get('version-rolling'):
+					self.version_mask = long(result.get('version-rolling.mask', '0'), 16) & VERSION_ROLLING_MASK
+			elif id_ == 's':
+				self.sample_rtt(time() - self.subscribe_sent)
+				self.source.forget(self)
+				self.extranonce = message['result'][1]
+				self.extranonce2_size = message['result'][2]
+				say_line('Linked %s (%d ms)', (self.entry.name, self.rtt * 1000))
+			elif id_ in self.source.submits:
+				self.sample_rtt(time() - self.source.submits[id_][2])
+				self.source.handle_reply(message, self)
+			elif id_ in self.source.forwarded:
+				self.source.handle_reply(message, self)
+			elif id_ == self.entry.user:
+				self.authorized = bool(message['result'])
+				if not self.authorized:
+					say_line('Link authorization failed with %s', self.entry.name)
+					self.stop()
+
+class Handler(LineChannel):
+	def __init__(self, socket, parent):
+		super(Handler, self).__init__(socket)
 		self.parent = parent
-		self.data = ''
-		self.set_terminator('\n')
 
 	def handle_close(self):
-		self.close()
-		self.parent.handler = None
-		self.parent.socket = None
+		if self.parent.handler is self:
+			self.parent.handler = None
+			self.parent.socket = None
 
 	def handle_error(self):
 		say_exception()
 		self.parent.stop()
 
-	def collect_incoming_data(self, data):
-		self.data += data
-
-	def found_terminator(self):
-		message = loads(self.data)
+	def handle_line(self, line):
+		message = loads(line)
 		self.parent.handle_message(message)
-		self.data = ''
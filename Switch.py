@@ -3,13 +3,19 @@ from copy import copy
 from log import say_exception, say_line, say_quiet
 from sha256 import sha256, STATE, partial, calculateF, hash
 from struct import pack, unpack
-from threading import RLock
+from threading import RLock, Thread
 from time import time, sleep
 from util import if_else, Object, chunks, bytereverse, belowOrEquals
 import GetworkSource
 import StratumSource
 import log
+import netutil
 import numpy as np
+import stats
+
+
+#how often verbose output lists the per server statistics
+STATS_INTERVAL = 300
 
 
 class Switch(object):
@@ -27,6 +33,7 @@ class Switch(object):
 		self.server_index = -1
 		self.last_server = None
 		self.server_map = {}
+		self.pool_switch = False
 
 		self.user_agent = 'poclbm/' + options.version
 
@@ -36,8 +43,37 @@ class Switch(object):
 
 		self.sent = {}
 
+		self.registry = stats.Registry()
+		self.decode_time = stats.SharedHistogram(stats.CPU_BUCKETS)
+		self.verify_time = stats.SharedHistogram(stats.CPU_BUCKETS)
+		self.pool_stats_map = {}
+		self.block_time = None
+		self.last_stats = time()
+
+		self.stratum_server = None
+		if self.options.serve_stratum:
+			import StratumServer
+			self.stratum_server = StratumServer.StratumServer(self, self.options.serve_stratum)
+
+		self.getwork_server = None
+		if self.options.serve_getwork:
+			import GetworkServer
+			self.getwork_server = GetworkServer.GetworkServer(self, self.options.serve_getwork)
+
+		self.metrics_server = None
+		if self.options.metrics:
+			import metrics
+			self.metrics_server = metrics.MetricsServer(self, self.options.metrics)
+
+		self.api_server = None
+		if self.options.api:
+			import APIServer
+			self.api_server = APIServer.APIServer(self, self.options.api, self.options.api_allow.split(','))
+
+		self.standby = None
 		if self.options.proxy:
 			self.options.proxy = self.parse_server(self.options.proxy, False)
+			self.standby = netutil.StandbyPool(self.options.proxy)
 
 		self.servers = []
 		for server in self.options.servers:
@@ -48,6 +84,7 @@ class Switch(object):
 					say_exception()
 				say_line("Ignored invalid server entry: %s", server)
 				continue
+		self.prefetch(self.servers)
 
 	def parse_server(self, server, mailAsUser=True):
 		s = Object()
@@ -92,6 +129,11 @@ class Switch(object):
 		self.should_stop = False
 		self.set_server_index(0)
 
+		if self.miners:
+			display = Thread(target=self.display_loop, name='display')
+			display.daemon = True
+			display.start()
+
 		while True:
 			if self.should_stop: return
 
@@ -99,6 +141,15 @@ class Switch(object):
 
 			sleep(1)
 
+			if self.pool_switch:
+				self.pool_switch = False
+				self.errors = 0
+				self.backup_server_index = 1
+				self.failback_attempt_count = 0
+				self.last_server = None
+				self.set_server_index(0)
+				continue
+
 			if failback:
 				say_line("Attempting to fail back to primary server")
 				self.last_server = self.server_index
@@ -122,20 +173,81 @@ class Switch(object):
 					new_server_index = 0
 					self.backup_server_index = 1
 				else:
-					new_server_index = self.backup_server_index
+					new_server_index = self.fastest_backup()
 					self.backup_server_index += 1
 				self.set_server_index(new_server_index)
 
+	def switch_pool(self, index):
+		"""Makes the server at index the primary one and moves mining to it,
+		the failover order of the others is kept."""
+		with self.lock:
+			if not 0 <= index < len(self.servers):
+				raise ValueError('no pool %d' % index)
+			if index == 0 and self.server_index == 0:
+				return
+			current = self.server() if self.server_index != -1 else None
+			self.servers.insert(0, self.servers.pop(index))
+			if current:
+				self.server_index = self.servers.index(current)
+				self.pool_switch = True
+				if getattr(current, 'source', None):
+					current.source.stop()
+
+	#consecutive backups of the same account are equals, the one with the fastest acks goes first
+	def fastest_backup(self):
+		index = self.backup_server_index
+		if not self.options.prefer_latency:
+			return index
+		first = self.servers[index]
+		best, best_latency = index, None
+		for i in xrange(index, len(self.servers)):
+			server = self.servers[i]
+			if (server.user, server.proto) != (first.user, first.proto):
+				break
+			pool_stats = self.stats(server)
+			latency = pool_stats.latency()
+			if latency is not None and pool_stats.healthy() and (best_latency is None or latency < best_latency):
+				best, best_latency = i, latency
+		self.servers[index], self.servers[best] = self.servers[best], self.servers[index]
+		return index
+
+	def stats(self, server):
+		key = (server.user, server.host)
+		if key not in self.pool_stats_map:
+			self.pool_stats_map[key] = stats.PoolStats(server.name)
+		return self.pool_stats_map[key]
+
+	def pool_stats(self):
+		result = []
+		for i, server in enumerate(self.servers):
+			summary = self.stats(server).summary()
+			summary['active'] = i == self.server_index
+			summary['user'] = server.user
+			summary['host'] = server.host
+			result.append(summary)
+		return result
+
+	#called by miners whenever they pick up work, measures how long a new block takes to reach the kernels
+	def work_started(self, work):
+		block_time = self.block_time
+		if block_time and work and work.header[25:29] == self.last_block:
+			self.block_time = None
+			self.stats(work.server.server()).block_latency.add(time() - block_time)
+
 	def connection_ok(self):
 		self.errors = 0
 		if self.server_index == 0:
-			self.backup_server_index = 1
+			if self.backup_server_index != 1:
+				self.backup_server_index = 1
+				self.keep_standby()
 			self.failback_attempt_count = 0
 
 	def stop(self):
 		self.should_stop = True
 		if self.server_index != -1:
 			self.server_source().stop()
+		if self.standby:
+			self.standby.keep([])
 
 	#callers must provide hex encoded block header and target
 	def decode(self, server, block_header, target, job_id = None, extranonce2 = None):
@@ -161,8 +273,10 @@ class Switch(object):
 	
 			calculateF(job.state, job.merkle_end, job.time, job.difficulty, job.f, job.state2)
 
-			if job.difficulty != self.difficulty:
-				self.set_difficulty(job.difficulty)
+			#several sources and servers decode at once, difficulty and true_target change together
+			with self.lock:
+				if job.difficulty != self.difficulty:
+					self.set_difficulty(job.difficulty)
 	
 			return job
 
@@ -175,10 +289,14 @@ class Switch(object):
 
 	def send(self, result, send_callback):
 		for nonce in result.miner.nonce_generator(result.nonces):
+			started = time()
 			h = hash(result.state, result.merkle_end, result.time, result.difficulty, nonce)
+			self.verify_time.add(time() - started)
 			if h[7] != 0:
 				hash6 = pack('I', long(h[6])).encode('hex')
-				say_line('Verification failed, check hardware! (%s, %s)', (result.miner.id(), hash6))
+				say_line('Verification failed, check hardware! (%s, %s)', (result.miner.id(), hash6), 'verification')
+				result.miner.hw_errors += 1
+				self.registry.add(result.miner, 'hw_errors')
 				return True # consume this particular result
 			else:
 				self.diff1_found(bytereverse(h[6]), result.target[6])
@@ -192,23 +310,44 @@ class Switch(object):
 		return True
 
 	def diff1_found(self, hash_, target):
-		if self.options.verbose and target < 0xFFFF0000L:
-			say_line('checking %s <= %s', (hash_, target))
-
-	def status_updated(self, miner):
-		verbose = self.options.verbose
-		rate = if_else(verbose, miner.rate, sum([m.rate for m in self.miners]))
-		estimated_rate = if_else(verbose, miner.estimated_rate, sum([m.estimated_rate for m in self.miners]))
-		rejected_shares = if_else(verbose, miner.share_count[0], sum([m.share_count[0] for m in self.miners]))
-		total_shares = rejected_shares + if_else(verbose, miner.share_count[1], sum([m.share_count[1] for m in self.miners]))
+		if log.json_events and target < 0xFFFF0000L:
+			log.event('checking', hash=hash_, target=target)
+		elif self.options.verbose and target < 0xFFFF0000L:
+			say_line('checking %s <= %s', (hash_, target), 'checking')
+
+	#reads the registry every --rate seconds, miners only write to it
+	def display_loop(self):
+		while not self.should_stop:
+			sleep(self.options.rate)
+			if log.json_events:
+				for miner in self.miners:
+					log.event('rate', device=miner.id(), **self.registry.get(miner))
+			elif self.options.verbose:
+				for miner in self.miners:
+					self.status_updated(self.registry.get(miner), miner.id() + ' ')
+				if time() - self.last_stats > STATS_INTERVAL:
+					self.last_stats = time()
+					for server in self.servers:
+						pool_stats = self.stats(server)
+						if pool_stats.connections:
+							say_line('%s', pool_stats)
+			else:
+				self.status_updated(self.registry.total())
+
+	def status_updated(self, figures, prefix=''):
+		rejected_shares = figures['rejected']
+		total_shares = rejected_shares + figures['accepted']
 		total_shares_estimator = max(total_shares, 1)
-		say_quiet('%s[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]', (if_else(verbose, miner.id()+' ', '') , rate, round(estimated_rate), rejected_shares, total_shares, float(rejected_shares) * 100 / total_shares_estimator))
+		say_quiet('%s[%.03f MH/s (~%d MH/s)] [Rej: %d/%d (%.02f%%)]', (prefix, figures['rate'], round(figures['estimated_rate']), rejected_shares, total_shares, float(rejected_shares) * 100 / total_shares_estimator))
 
 	def report(self, miner, nonce, accepted):
 		is_block, hash6, hash5 = self.sent[nonce]
 		miner.share_count[if_else(accepted, 1, 0)] += 1
+		self.registry.add(miner, if_else(accepted, 'accepted', 'rejected'))
 		hash_ = if_else(is_block, hash6 + hash5, hash6)
-		if self.options.verbose or is_block:
+		if log.json_events:
+			log.event(if_else(is_block, 'block', 'share'), device=miner.id(), hash=hash_, accepted=accepted)
+		elif self.options.verbose or is_block:
 			say_line('%s %s%s, %s', (miner.id(), if_else(is_block, 'block ', ''), hash_, if_else(accepted, 'accepted', '_rejected_')))
 		del self.sent[nonce]
 
@@ -219,6 +358,7 @@ class Switch(object):
 		#say_line('Setting server %s (%s @ %s)', (name, user, host))
 		say_line('Setting server (%s @ %s)', (user, name))
 		log.server = name
+		self.keep_standby()
 		
 
 	def add_servers(self, hosts):
@@ -229,6 +369,29 @@ class Switch(object):
 				server.host = ''.join([host['host'], ':', port])
 				server.source = None
 				self.servers.insert(self.backup_server_index, server)
+				self.prefetch([server])
+		self.keep_standby()
+
+	#warm the DNS cache so failing over does not wait for the resolver
+	def prefetch(self, servers):
+		if not self.options.proxy:
+			netutil.resolver.prefetch([(server.host, if_else(server.proto == 'https', 443, 80)) for server in servers])
+
+	#proxied connections to the servers a failover or a failback would pick
+	def keep_standby(self):
+		if not self.standby:
+			return
+		candidates = [self.servers[0]]
+		if self.backup_server_index < len(self.servers):
+			candidates.append(self.servers[self.backup_server_index])
+		hosts = []
+		for server in candidates:
+			if server is not self.server():
+				try:
+					hosts.append(netutil.split_host(server.host, if_else(server.proto == 'https', 443, 80)))
+				except ValueError:
+					pass
+		self.standby.keep(hosts)
 
 	def has_server(self, user, host, port):
 		for server in self.servers:
@@ -238,7 +401,11 @@ class Switch(object):
 		return False
 
 	def queue_work(self, server, block_header, target = None, job_id = None, extranonce2 = None, miner=None):
+		if not self.miners:
+			return
+		started = time()
 		work = self.decode(server, block_header, target, job_id, extranonce2)
+		self.decode_time.add(time() - started)
 		with self.lock:
 			if not miner:
 				miner = self.miners[0]
@@ -249,11 +416,13 @@ class Switch(object):
 				miner.update = False; self.last_work = time()
 				if self.last_block != work.header[25:29]:
 					self.last_block = work.header[25:29]
+					self.block_time = time()
 					self.clear_result_queue(server)
 
 	def clear_result_queue(self, server):
 		while not server.result_queue.empty():
 			server.result_queue.get(False)
+			self.stats(server.server()).discard()
 
 	def server_source(self):
 		if not hasattr(self.server(), 'source'):
@@ -10,7 +10,8 @@ Currently supports:
 Copyright 2011-2012 Chris MacLeod
 This program is released under the GNU GPL. See LICENSE.txt for details.
 """
-import sys, os, subprocess, errno, re, threading, logging, time, httplib, urllib
+import sys, os, subprocess, errno, re, threading, logging, time, httplib, urllib, socket
+import Queue
 print sys.path
 import wx
 import json
@@ -135,10 +136,14 @@ SUPPORTED_BACKENDS = [
 ]
 
 USER_AGENT = "guiminer/" + __version__
+BALANCE_CACHE_SECS = 60 # balance replies are shared by tabs for this long
+BALANCE_TIMEOUT_SECS = 15
 
 # Time constants
 SAMPLE_TIME_SECS = 3600
 REFRESH_RATE_MILLIS = 2000
+CONSOLE_REFRESH_MILLIS = 250
+CONSOLE_LINE_WIDTH = 2000 # pixels, long lines scroll horizontally
 
 # Layout constants
 LBL_STYLE = wx.ALIGN_RIGHT | wx.ALIGN_CENTER_VERTICAL
@@ -149,6 +154,7 @@ BTN_STYLE = wx.ALIGN_CENTER_HORIZONTAL | wx.ALL
 (UpdateAcceptedEvent, EVT_UPDATE_ACCEPTED) = NewEvent()
 (UpdateSoloCheckEvent, EVT_UPDATE_SOLOCHECK) = NewEvent()
 (UpdateStatusEvent, EVT_UPDATE_STATUS) = NewEvent()
+(BalanceResponseEvent, EVT_BALANCE_RESPONSE) = NewEvent()
 
 # Utility functions
 def merge_whitespace(s):
@@ -228,20 +234,101 @@ def init_logger():
 
 logger, formatter = init_logger()
 
-def http_request(hostname, *args, **kwargs):
-    """Do a HTTP request and return the response data."""
-    conn_cls = httplib.HTTPSConnection if kwargs.get('use_https') else httplib.HTTPConnection        
-    conn = conn_cls(hostname) 
-    try:        
-        logger.debug(_("Requesting balance: %(request)s"), dict(request=args))
-        conn.request(*args)
-        response = conn.getresponse()
-        data = response.read()
-        logger.debug(_("Server replied: %(status)s, %(data)s"),
-                     dict(status=str(response.status), data=data))
-        return response, data
-    finally:
-        conn.close()
+class BalanceService(threading.Thread):
+    """Does the balance and payout HTTP requests of all tabs on one
+    background thread.
+
+    Connections are kept alive per host and have a timeout. Balance replies
+    are cached for BALANCE_CACHE_SECS and a request for a reply that is
+    already on its way waits for it instead of being sent again, so tabs on
+    the same pool and account cost one request. Payouts are never cached
+    or coalesced. Results are posted to the tabs as BalanceResponseEvents
+    that carry the handler to call with the response and data; response
+    is None if the server could not be reached.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name='balance')
+        self.daemon = True
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.waiting = {} # request key -> [(tab, handler)]
+        self.cache = {} # request key -> (time, response, data)
+        self.connections = {} # (hostname, use_https) -> connection, only used by our thread
+
+    def request(self, tab, handler, hostname, method, url, body=None,
+                headers={}, use_https=False, cache=True):
+        key = (hostname, use_https, method, url, body)
+        if not cache:
+            key += (object(),) # never equal to another request
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+            cached = self.cache.get(key)
+            if cached and time.time() - cached[0] < BALANCE_CACHE_SECS:
+                wx.PostEvent(tab, BalanceResponseEvent(handler=handler, response=cached[1], data=cached[2]))
+                return
+            if key in self.waiting:
+                self.waiting[key].append((tab, handler))
+                return
+            self.waiting[key] = [(tab, handler)]
+        self.requests.put((key, headers, cache))
+
+    def run(self):
+        while True:
+            key, headers, cache = self.requests.get()
+            try:
+                response, data = self.fetch(key, headers, cache)
+            except Exception:
+                # The thread can not be started again, it must outlive any failure
+                logger.exception(_("Balance request failed"))
+                response, data = None, ''
+            with self.lock:
+                waiting = self.waiting.pop(key, [])
+                if cache and response is not None and response.status == 200:
+                    self.cache[key] = (time.time(), response, data)
+            for tab, handler in waiting:
+                if tab: # the tab may have been closed meanwhile
+                    wx.PostEvent(tab, BalanceResponseEvent(handler=handler, response=response, data=data))
+
+    def fetch(self, key, headers, cache):
+        """Do the request on the kept connection, return (response, data).
+
+        A kept connection may have been closed by the server. Balance
+        requests that fail on one before any reply arrived are sent again
+        on a new connection. Payouts go out on a new connection and are
+        never sent twice, the server may have acted on the first one.
+        """
+        hostname, use_https, method, url, body = key[:5]
+        if not cache and (hostname, use_https) in self.connections:
+            # so that a payout does not fail on a connection the server dropped
+            self.connections.pop((hostname, use_https)).close()
+        while True:
+            conn = self.connections.get((hostname, use_https))
+            reused = conn is not None
+            if conn is None:
+                conn_cls = httplib.HTTPSConnection if use_https else httplib.HTTPConnection
+                conn = self.connections[(hostname, use_https)] = conn_cls(hostname, timeout=BALANCE_TIMEOUT_SECS)
+            replied = False
+            try:
+                logger.debug(_("Requesting balance: %(request)s"), dict(request=(method, url)))
+                conn.request(method, url, body, headers)
+                response = conn.getresponse()
+                replied = True
+                data = response.read()
+                logger.debug(_("Server replied: %(status)s, %(data)s"),
+                             dict(status=str(response.status), data=data))
+                return response, data
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                del self.connections[(hostname, use_https)]
+                logger.debug(_("Balance request to %(host)s failed: %(error)s"),
+                             dict(host=hostname, error=str(e)))
+                closed = isinstance(e, httplib.BadStatusLine) or \
+                    (isinstance(e, socket.error) and not isinstance(e, socket.timeout))
+                if not (cache and reused and closed and not replied):
+                    return None, ''
+
+balance_service = BalanceService()
 
 def get_process_affinity(pid):
     """Return the affinity mask for the specified process."""
@@ -255,30 +342,70 @@ def set_process_affinity(pid, mask):
     handle = win32api.OpenProcess(flags, 0, pid)
     win32process.SetProcessAffinityMask(handle, mask)
 
-def find_nth(haystack, needle, n):
-    """Return the index of the nth occurrence of needle in haystack."""
-    start = haystack.find(needle)
-    while start >= 0 and n > 1:
-        start = haystack.find(needle, start + len(needle))
-        n -= 1
-    return start
+class RingBuffer(object):
+    """The last maxlen lines, appending drops the oldest when full.
+
+    Lines are indexed from the oldest kept, appends and lookups are O(1).
+    """
+    def __init__(self, maxlen):
+        self.maxlen = max(maxlen, 1)
+        self.lines = []
+        self.start = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        return self.lines[(self.start + index) % len(self.lines)]
+
+    def append(self, line):
+        if len(self.lines) < self.maxlen:
+            self.lines.append(line)
+        else:
+            self.lines[self.start] = line
+            self.start = (self.start + 1) % self.maxlen
+
+
+class ConsoleView(wx.ListCtrl):
+    """Virtual list showing the lines of a RingBuffer, only the visible
+    rows are ever asked for."""
+    def __init__(self, parent, lines):
+        style = wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_NO_HEADER | wx.LC_SINGLE_SEL
+        wx.ListCtrl.__init__(self, parent, -1, style=style)
+        self.lines = lines
+        self.InsertColumn(0, "", width=CONSOLE_LINE_WIDTH)
+
+    def OnGetItemText(self, item, column):
+        if item < len(self.lines):
+            return self.lines[item]
+        return ""
+
 
 class ConsolePanel(wx.Panel):
     """Panel that displays logging events.
 
-    Uses with a StreamHandler to log events to a TextCtrl. Thread-safe.
+    Uses with a StreamHandler to log events to a ring buffer of the last
+    n_max_lines lines. Thread-safe: writers only append under a lock, a
+    timer shows what was added since the last tick.
     """
     def __init__(self, parent, n_max_lines):
         wx.Panel.__init__(self, parent, -1)
         self.parent = parent
         self.n_max_lines = n_max_lines
+        self.lines = RingBuffer(n_max_lines)
+        self.lock = threading.Lock()
+        self.partial = '' # text written after the last newline
+        self.changed = False
 
         vbox = wx.BoxSizer(wx.VERTICAL)
-        style = wx.TE_MULTILINE | wx.TE_READONLY | wx.HSCROLL
-        self.text = wx.TextCtrl(self, -1, "", style=style)
-        vbox.Add(self.text, 1, wx.EXPAND)
+        self.view = ConsoleView(self, self.lines)
+        vbox.Add(self.view, 1, wx.EXPAND)
         self.SetSizer(vbox)
 
+        self.timer = wx.Timer(self)
+        self.timer.Start(CONSOLE_REFRESH_MILLIS)
+        self.Bind(wx.EVT_TIMER, self.on_timer)
+
         self.handler = logging.StreamHandler(self)
 
         formatter = logging.Formatter("%(asctime)s: %(message)s",
@@ -294,18 +421,35 @@ class ConsolePanel(wx.Panel):
     def on_close(self):
         """On closing, stop handling logging events."""
         logger.removeHandler(self.handler)
+        self.timer.Stop()
 
-    def append_text(self, text):
-        self.text.AppendText(text)
-        lines_to_cut = self.text.GetNumberOfLines() - self.n_max_lines 
-        if lines_to_cut > 0:
-            contents = self.text.GetValue()
-            position = find_nth(contents, '\n', lines_to_cut)
-            self.text.ChangeValue(contents[position + 1:])                        
+    def on_timer(self, event=None):
+        """Show the lines added since the last tick, following the end of
+        the log unless the user scrolled up."""
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            count = len(self.lines)
+        view = self.view
+        at_end = view.GetTopItem() + view.GetCountPerPage() >= view.GetItemCount()
+        view.SetItemCount(count)
+        view.RefreshItems(0, max(count - 1, 0))
+        if at_end and count:
+            view.EnsureVisible(count - 1)
 
     def write(self, text):
-        """Forward logging events to our TextCtrl."""
-        wx.CallAfter(self.append_text, text)
+        """Add logging output to the buffer, called from any thread."""
+        with self.lock:
+            text = self.partial + text
+            lines = text.split('\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self.lines.append(line)
+            self.changed = self.changed or bool(lines)
+
+    def flush(self):
+        pass
 
 
 class SummaryPanel(wx.Panel):
@@ -491,6 +635,285 @@ class MinerListenerThread(threading.Thread):
                 wx.PostEvent(self.parent, event)
         logger.info(_('Listener for "%s" shutting down'), self.parent_name)
 
+class JsonListenerThread(MinerListenerThread):
+    """Listener for poclbm started with --json-events.
+
+    Every line is one JSON event, so it is decoded once instead of being
+    tested against the LINES regexes. Lines that are not JSON, such as
+    startup errors printed before logging begins, are shown as status.
+    """
+    STATES = {
+        'paused': _("Paused"),
+        'overheated': _("Overheated, waiting"),
+        'idle': _("Idle, waiting for work"),
+    }
+
+    def __init__(self, parent, miner):
+        MinerListenerThread.__init__(self, parent, miner)
+        self.rates = {} # MH/s by device
+
+    def run(self):
+        logger.info(_('Listener for "%s" started') % self.parent_name)
+        while not self.shutdown_event.is_set():
+            line = self.miner.stdout.readline()
+            if not line:
+                if self.miner.poll() is not None: break
+                continue
+            line = line.strip()
+            if not line: continue
+            try:
+                event = json.loads(line)
+                type_ = event['event']
+            except (ValueError, TypeError, KeyError):
+                logger.info(_('Listener for "%(name)s": %(line)s'),
+                            dict(name=self.parent_name, line=line))
+                self.dispatch_text(line)
+                continue
+            self.dispatch(type_, event)
+        logger.info(_('Listener for "%s" shutting down'), self.parent_name)
+
+    def dispatch_text(self, line):
+        """Show a line that is not an event as the status of our tab."""
+        wx.PostEvent(self.parent, UpdateStatusEvent(text=line))
+
+    def dispatch(self, type_, event):
+        """Post the GUI event for a poclbm event to our tab."""
+        event = self.translate(type_, event)
+        if event is not None:
+            wx.PostEvent(self.parent, event)
+
+    def translate(self, type_, event):
+        """Return the GUI event for a poclbm event, or None."""
+        if type_ == 'rate':
+            self.rates[event['device']] = event['rate']
+            return UpdateHashRateEvent(rate=sum(self.rates.values()) * 1000)
+        if type_ in ('share', 'block'):
+            return UpdateAcceptedEvent(accepted=event['accepted'])
+        if type_ == 'checking':
+            return UpdateSoloCheckEvent()
+        if type_ == 'device':
+            if event['state'] == 'stopped':
+                self.rates.pop(event['device'], None)
+            if event['state'] in self.STATES:
+                return UpdateStatusEvent(text='%s: %s' % (event['device'], self.STATES[event['state']]))
+            return None
+        if type_ == 'error':
+            logger.info(_('Listener for "%(name)s": %(line)s'),
+                        dict(name=self.parent_name, line=event['text']))
+            return UpdateStatusEvent(text=event['text'])
+        if type_ == 'message':
+            logger.debug(_('Listener for "%(name)s": %(line)s'),
+                         dict(name=self.parent_name, line=event['text']))
+        return None
+
+class SharedListenerThread(JsonListenerThread):
+    """Listener for a SharedWorker, routes each event to the tab of its device."""
+    def dispatch(self, type_, event):
+        if type_ == 'listening' and event.get('service') == 'api':
+            self.parent.api_ready(event['port'])
+            return
+        tab = self.parent.tabs.get(
+            device_index(event.get('device'), self.parent.platform))
+        if tab is None:
+            # Errors without a device concern every tab of the worker
+            if type_ == 'error':
+                self.dispatch_text(event['text'])
+            else:
+                self.translate(type_, event)
+            return
+        if type_ == 'rate':
+            wx.PostEvent(tab, UpdateHashRateEvent(rate=event['rate'] * 1000))
+            return
+        event = self.translate(type_, event)
+        if event is not None:
+            wx.PostEvent(tab, event)
+
+    def dispatch_text(self, line):
+        """Show a line that is not about one device on every tab."""
+        for tab in self.parent.tabs.values():
+            wx.PostEvent(tab, UpdateStatusEvent(text=line))
+
+def device_index(device, platform):
+    """Return the device index of a poclbm OpenCL device id on platform,
+    or None for other ids such as those of BFL devices."""
+    try:
+        device_platform, index, name = device.split(':', 2)
+        if int(device_platform) != platform:
+            return None
+        return int(index)
+    except (AttributeError, ValueError):
+        return None
+
+class SharedWorker(object):
+    """One poclbm process mining on every device of the tabs that share
+    its pool settings.
+
+    The tabs are views onto the process. Stopping a tab pauses its device
+    through the poclbm API and starting it again resumes it. Only a device
+    the process was not started with makes it restart, once for all the
+    tabs that start or stop together.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.platform = key[4]
+        self.name = _("Shared worker")
+        self.tabs = {} # MinerTab by device index
+        self.devices = [] # device indexes the process was started with
+        self.process = None
+        self.listener = None
+        self.api_port = None
+        self.resumes = set() # devices to resume once the API is up
+        self.restart_pending = False
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def join(self, tab):
+        device = tab.device_index
+        self.tabs[device] = tab
+        if self.is_running() and device in self.devices:
+            if self.api_port is None:
+                self.resumes.add(device)
+                return
+            if self.command('resume', device):
+                return
+        self.schedule_restart()
+
+    def leave(self, tab):
+        device = tab.device_index
+        self.tabs.pop(device, None)
+        self.resumes.discard(device)
+        if not self.tabs:
+            self.stop()
+        elif not self.command('pause', device):
+            self.schedule_restart()
+
+    def api_ready(self, port):
+        """Called by the listener once the API of the process is up."""
+        self.api_port = port
+        for device in list(self.resumes):
+            self.resumes.discard(device)
+            if not self.command('resume', device):
+                wx.CallAfter(self.schedule_restart)
+
+    def schedule_restart(self):
+        """Restart after the current batch of joins and leaves is done."""
+        if not self.restart_pending:
+            self.restart_pending = True
+            wx.CallAfter(self.scheduled_restart)
+
+    def scheduled_restart(self):
+        self.restart_pending = False
+        if self.tabs:
+            self.restart()
+
+    def restart(self):
+        """Start the process again with the devices of the current tabs."""
+        self.stop()
+        self.devices = sorted(self.tabs)
+        cmd, cwd = self.tabs.values()[0].configure_subprocess_poclbm(
+            ','.join(str(device) for device in self.devices))
+        # BFL devices belong to no tab
+        cmd += " --api=127.0.0.1:0 --no-bfl"
+        try: import win32process
+        except ImportError: flags = 0
+        else: flags = win32process.CREATE_NO_WINDOW
+        logger.debug(_('Running command: ') + cmd)
+        self.process = subprocess.Popen(cmd, cwd=cwd,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        universal_newlines=True,
+                                        creationflags=flags,
+                                        shell=(sys.platform != 'win32'))
+        self.listener = SharedListenerThread(self, self.process)
+        self.listener.daemon = True
+        self.listener.start()
+
+    def stop(self):
+        if self.is_running():
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+        self.process = None
+        if self.listener is not None:
+            self.listener.shutdown_event.set()
+            self.listener = None
+        self.api_port = None
+        self.resumes.clear()
+
+    def request(self, command, parameter=None):
+        """Send a JSON request to the poclbm API, return the reply or None."""
+        port = self.api_port
+        if port is None:
+            return None
+        request = {'command': command}
+        if parameter is not None:
+            request['parameter'] = parameter
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 2)
+            try:
+                sock.sendall(json.dumps(request))
+                reply = ''
+                while True:
+                    data = sock.recv(4096)
+                    if not data: break
+                    reply += data
+            finally:
+                sock.close()
+            return json.loads(reply.rstrip('\0'))
+        except (socket.error, ValueError):
+            logger.info(_('Shared worker did not answer %s'), command)
+            return None
+
+    def api_index(self, device):
+        """Return the API index of the miner on an OpenCL device, or None.
+        poclbm numbers its miners itself, so look it up by their ids."""
+        reply = self.request('devs')
+        if reply is None:
+            return None
+        for item in reply.get('DEVS', []):
+            if device_index(item.get('Name'), self.platform) == device:
+                return item['ID']
+        return None
+
+    def command(self, command, device):
+        """Send command|N for a device to the poclbm API, return True if
+        it succeeded."""
+        if device not in self.devices:
+            return False
+        index = self.api_index(device)
+        if index is None:
+            return False
+        reply = self.request(command, index)
+        if reply is None:
+            return False
+        status = reply['STATUS'][0]
+        # Resuming a device that is not paused is fine too
+        return status['STATUS'] == 'S' or 'not paused' in status['Msg']
+
+class SharedWorkers(object):
+    """The shared workers by pool settings, used when the option to share
+    one poclbm process per pool is on."""
+    def __init__(self):
+        self.enabled = False
+        self.workers = {}
+
+    def join(self, tab):
+        key = tab.get_shared_worker_key()
+        worker = self.workers.get(key)
+        if worker is None:
+            worker = self.workers[key] = SharedWorker(key)
+        worker.join(tab)
+        return worker
+
+    def leave(self, tab, worker):
+        worker.leave(tab)
+        if not worker.tabs:
+            self.workers.pop(worker.key, None)
+
+shared_workers = SharedWorkers()
+
 class PhoenixListenerThread(MinerListenerThread):
     LINES = [
         (r"Result: .* accepted",
@@ -539,6 +962,7 @@ class MinerTab(wx.Panel):
         self.is_possible_error = False
         self.miner = None # subprocess.Popen instance when mining
         self.miner_listener = None # MinerListenerThread when mining
+        self.shared_worker = None # SharedWorker when mining in one
         self.solo_blocks_found = 0
         self.accepted_shares = 0 # shares for pool, diff1 hashes for solo
         self.accepted_times = collections.deque()
@@ -620,6 +1044,7 @@ class MinerTab(wx.Panel):
         self.Bind(EVT_UPDATE_HASHRATE, lambda event: self.update_khash(event.rate))
         self.Bind(EVT_UPDATE_ACCEPTED, lambda event: self.update_shares(event.accepted))
         self.Bind(EVT_UPDATE_STATUS, lambda event: self.update_status(event.text))
+        self.Bind(EVT_BALANCE_RESPONSE, lambda event: event.handler(event.response, event.data))
         self.Bind(EVT_UPDATE_SOLOCHECK, lambda event: self.update_solo())
         self.update_statusbar()
         self.clear_summary_widgets()
@@ -862,8 +1287,12 @@ class MinerTab(wx.Panel):
 
     #############################
     # Begin backend specific code
-    def configure_subprocess_poclbm(self):
-        """Set up the command line for poclbm."""
+    def configure_subprocess_poclbm(self, devices=None):
+        """Set up the command line for poclbm.
+
+        devices is a comma separated list of device indexes, our own device
+        by default.
+        """
         folder = get_module_path()
         if USE_MOCK:
             executable = "python mockBitcoinMiner.py"
@@ -872,13 +1301,16 @@ class MinerTab(wx.Panel):
                 executable = "poclbm.exe"
             else:
                 executable = "python poclbm.py"
-        cmd = "%s %s:%s@%s:%s --device=%d --platform=%d --verbose -r1 %s" % (
+            executable += " --json-events"
+        if devices is None:
+            devices = str(self.device_index)
+        cmd = "%s %s:%s@%s:%s --device=%s --platform=%d --verbose -r1 %s" % (
                 executable,
                 self.txt_username.GetValue(),
                 self.txt_pass.GetValue(),
                 self.txt_host.GetValue(),
                 self.txt_port.GetValue(),
-                self.device_index,
+                devices,
                 self.platform_index,
                 self.txt_flags.GetValue()
         )
@@ -956,10 +1388,23 @@ class MinerTab(wx.Panel):
     # End backend specific code
     ###########################
 
+    def get_shared_worker_key(self):
+        """Tabs with equal keys can mine in the same poclbm process."""
+        return (self.txt_username.GetValue(), self.txt_pass.GetValue(),
+                self.txt_host.GetValue(), self.txt_port.GetValue(),
+                self.platform_index, self.txt_flags.GetValue())
+
     def start_mining(self):
         """Launch a miner subprocess and attach a MinerListenerThread."""
         self.is_paused = False
 
+        if shared_workers.enabled and not self.is_external_miner and not USE_MOCK:
+            self.shared_worker = shared_workers.join(self)
+            self.is_mining = True
+            self.set_status(STR_STARTING, 1)
+            self.start.SetLabel(self.get_start_label())
+            return
+
         # Avoid showing a console window when frozen
         try: import win32process
         except ImportError: flags = 0
@@ -970,6 +1415,8 @@ class MinerTab(wx.Panel):
         listener_cls = MinerListenerThread
         if not self.is_external_miner:
             conf_func = self.configure_subprocess_poclbm
+            if not USE_MOCK:
+                listener_cls = JsonListenerThread
         elif "rpcminer" in self.external_path:
             conf_func = self.configure_subprocess_rpcminer
         elif "bitcoin-miner" in self.external_path:
@@ -1028,6 +1475,9 @@ class MinerTab(wx.Panel):
 
     def stop_mining(self):
         """Terminate the poclbm process if able and its associated listener."""
+        if self.shared_worker is not None:
+            shared_workers.leave(self, self.shared_worker)
+            self.shared_worker = None
         if self.miner is not None:
             if self.miner.returncode is None:
                 # It didn't return yet so it's still running.
@@ -1255,7 +1705,7 @@ For cgminer use -I 8 or -I 9. Without any params for desktop usage."""))
 
         Otherwise, return False.
         """
-        if response.status in [401, 403]: # 401 Unauthorized or 403 Forbidden
+        if response is not None and response.status in [401, 403]: # 401 Unauthorized or 403 Forbidden
             # Token rejected by the server - reset their token so they'll be
             # prompted again
             self.balance_auth_token = ""
@@ -1263,16 +1713,17 @@ For cgminer use -I 8 or -I 9. Without any params for desktop usage."""))
         return False
 
     def request_balance_get(self, balance_auth_token, use_https=False):
-        """Request our balance from the server via HTTP GET and auth token.
-
-        This method should be run in its own thread.
-        """
-        response, data = http_request(
+        """Request our balance from the server via HTTP GET and auth token."""
+        balance_service.request(
+            self, self.on_balance_get_response,
             self.server_config['balance_host'],
             "GET",
             self.server_config["balance_url"] % balance_auth_token,
             use_https=use_https
         )
+
+    def on_balance_get_response(self, response, data):
+        """Show the balance returned for request_balance_get."""
         if self.is_auth_token_rejected(response):
             data = _("Auth token rejected by server.")
         elif not data:
@@ -1303,7 +1754,7 @@ For cgminer use -I 8 or -I 9. Without any params for desktop usage."""))
             except: # TODO: what exception here?
                 data = _("Bad response from server.")
 
-        wx.CallAfter(self.balance_amt.SetLabel, data)
+        self.balance_amt.SetLabel(data)
 
     def on_withdraw(self, event):
         self.withdraw.Disable()
@@ -1346,20 +1797,12 @@ For cgminer use -I 8 or -I 9. Without any params for desktop usage."""))
                 self.balance_auth_token.decode('ascii')
             except UnicodeDecodeError:
                 return # Invalid characters in auth token
-            self.http_thread = threading.Thread(
-                target=self.request_balance_get,
-                args=(self.balance_auth_token,),
-                kwargs=dict(use_https=self.requires_https(host)))
-            self.http_thread.start()
+            self.request_balance_get(self.balance_auth_token,
+                                     use_https=self.requires_https(host))
         elif host == 'bitpenny.dyndns.biz':
-            self.http_thread = threading.Thread(
-            target=self.request_payout_bitpenny, args=(False,))
-            self.http_thread.start()
+            self.request_payout_bitpenny(False)
         elif 'eligius.st' in host:
-            self.http_thread = threading.Thread(
-                target=self.request_balance_eligius
-            )
-            self.http_thread.start()
+            self.request_balance_eligius()
 
         self.balance_refresh.Disable()
         self.balance_cooldown_seconds = 10
@@ -1373,62 +1816,53 @@ For cgminer use -I 8 or -I 9. Without any params for desktop usage."""))
         self.require_auth_token()
         if not self.balance_auth_token: # User refused to provide token
             return
-        self.http_thread = threading.Thread(
-                target=self.request_payout_btcmp,
-                args=(self.balance_auth_token,))
-        self.http_thread.start()
+        self.request_payout_btcmp(self.balance_auth_token)
 
     def withdraw_deepbit(self):
         """Launch a thread to withdraw from deepbit."""
         self.require_auth_token()
         if not self.balance_auth_token: # User refused to provide token
             return
-        self.http_thread = threading.Thread(
-                target=self.request_payout_deepbit,
-                args=(self.balance_auth_token,))
-        self.http_thread.start()
+        self.request_payout_deepbit(self.balance_auth_token)
 
     def withdraw_bitpenny(self):
-        self.http_thread = threading.Thread(
-            target=self.request_payout_bitpenny, args=(True,))
-        self.http_thread.start() # TODO: look at aliasing of this variable
+        self.request_payout_bitpenny(True)
 
     def request_payout_btcmp(self, balance_auth_token):
         """Request payout from btcmp's server via HTTP POST."""        
-        response, data = http_request(
+        balance_service.request(
+            self, self.on_payout_response,
             self.server_config['balance_host'],
             "GET",
             self.server_config["payout_url"] % balance_auth_token,
-            use_https=False
+            use_https=False,
+            cache=False
         )
-        
+
+    def on_payout_response(self, response, data):
+        """Show the result of a payout request."""
         if self.is_auth_token_rejected(response):
             data = _("Auth token rejected by server.")
         elif not data:
             data = STR_CONNECTION_ERROR
         else:
             data = _("Withdraw OK")
-        wx.CallAfter(self.on_balance_received, data)
+        self.on_balance_received(data)
 
     def request_payout_deepbit(self, balance_auth_token):
         """Request payout from deepbit's server via HTTP POST."""
         post_params = dict(id=1,
                            method="request_payout")
-        response, data = http_request(
+        balance_service.request(
+             self, self.on_payout_response,
              self.server_config['balance_host'],
              "POST",
              self.server_config['balance_url'] % balance_auth_token,
              json.dumps(post_params),
              {"Content-type": "application/json; charset=utf-8",
-              "User-Agent": USER_AGENT}
+              "User-Agent": USER_AGENT},
+             cache=False
         )
-        if self.is_auth_token_rejected(response):
-            data = _("Auth token rejected by server.")
-        elif not data:
-            data = STR_CONNECTION_ERROR
-        else:
-            data = _("Withdraw OK")
-        wx.CallAfter(self.on_balance_received, data)
 
     def request_payout_bitpenny(self, withdraw):
         """Request our balance from BitPenny via HTTP POST.
@@ -1436,29 +1870,38 @@ For cgminer use -I 8 or -I 9. Without any params for desktop usage."""))
         If withdraw is True, also request a withdrawal.
         """
         post_params = dict(a=self.txt_username.GetValue(), w=int(withdraw))
-        response, data = http_request(
+        balance_service.request(
+             self, lambda response, data: self.on_bitpenny_response(response, data, withdraw),
              self.server_config['balance_host'],
              "POST",
              self.server_config['balance_url'],
              urllib.urlencode(post_params),
-             {"Content-type": "application/x-www-form-urlencoded"}
+             {"Content-type": "application/x-www-form-urlencoded"},
+             cache=not withdraw
         )
+
+    def on_bitpenny_response(self, response, data, withdraw):
+        """Show the balance or withdrawal result from BitPenny."""
         if self.is_auth_token_rejected(response):
             data = _("Auth token rejected by server.")
         elif not data:
             data = STR_CONNECTION_ERROR
         elif withdraw:
             data = _("Withdraw OK")
-        wx.CallAfter(self.on_balance_received, data)
+        self.on_balance_received(data)
 
     def request_balance_eligius(self):
         """Request our balance from Eligius
         """
-        response, data = http_request(
+        balance_service.request(
+             self, self.on_eligius_response,
              self.server_config['balance_host'],
              "POST",
              self.server_config['balance_url'] % (self.txt_username.GetValue(),),
         )
+
+    def on_eligius_response(self, response, data):
+        """Show the balance returned by Eligius."""
         if not data:
             data = STR_CONNECTION_ERROR
         try:
@@ -1466,7 +1909,7 @@ For cgminer use -I 8 or -I 9. Without any params for desktop usage."""))
             data = data['expected'] / 1e8
         except BaseException as e:
             data = str(e)
-        wx.CallAfter(self.on_balance_received, data)
+        self.on_balance_received(data)
 
     def on_balance_received(self, balance):
         """Set the balance in the GUI."""
@@ -1817,6 +2260,10 @@ class GUIMiner(wx.Frame):
         self.options_menu = wx.Menu()
         self.start_minimized_chk = self.options_menu.Append(ID_START_MINIMIZED, _("Start &minimized"), _("Start the GUI minimized to the tray."), wx.ITEM_CHECK)
         self.options_menu.Check(ID_START_MINIMIZED, self.config_data.get('start_minimized', False))
+        ID_SHARED_WORKERS = wx.NewId()
+        self.shared_workers_chk = self.options_menu.Append(ID_SHARED_WORKERS, _("&Share one poclbm process per pool"), _("Mine on all devices with the same pool settings in a single poclbm process, applies to miners started afterwards."), wx.ITEM_CHECK)
+        self.options_menu.Check(ID_SHARED_WORKERS, self.config_data.get('shared_workers', False))
+        shared_workers.enabled = self.shared_workers_chk.IsChecked()
         self.menubar.Append(self.options_menu, _("&Options"))
 
         ID_CHANGE_LANGUAGE = wx.NewId()
@@ -1884,6 +2331,7 @@ class GUIMiner(wx.Frame):
         self.Bind(wx.EVT_MENU, self.launch_solo_server, id=ID_LAUNCH)
         self.Bind(wx.EVT_MENU, self.on_change_language, id=ID_CHANGE_LANGUAGE)
         self.Bind(wx.EVT_MENU, self.on_donate, id=ID_DONATE_SMALL)
+        self.Bind(wx.EVT_MENU, self.on_shared_workers, id=ID_SHARED_WORKERS)
         self.Bind(wx.EVT_CLOSE, self.on_close)        
         self.Bind(wx.EVT_ICONIZE, self.on_iconize)
         self.Bind(fnb.EVT_FLATNOTEBOOK_PAGE_CLOSING, self.on_page_closing)
@@ -1896,6 +2344,9 @@ class GUIMiner(wx.Frame):
         if not self.start_minimized_chk.IsChecked():
             self.Show()
             
+    def on_shared_workers(self, event):
+        shared_workers.enabled = event.IsChecked()
+
     def on_iconize(self, event):
         if event.Iconized() and sys.platform == 'win32':
             self.Hide() # On minimize, hide from taskbar.
@@ -2051,6 +2502,7 @@ class GUIMiner(wx.Frame):
                            blockchain_directory=self.blockchain_directory,
                            show_opencl_warning=self.do_show_opencl_warning,
                            start_minimized=self.start_minimized_chk.IsChecked(),
+                           shared_workers=self.shared_workers_chk.IsChecked(),
                            console_max_lines=self.console_max_lines,
                            window_position=list(self.GetRect()))
         logger.debug(_('Saving: ') + json.dumps(config_data))
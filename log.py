@@ -1,35 +1,164 @@
+from Queue import Queue, Empty, Full
 from datetime import datetime
-from threading import RLock
+from json import dumps
+from threading import Lock, Thread
+from time import time, sleep
 import sys
 import traceback
 
 quiet = False
 verbose = False
+json_events = False
 server = ''
-lock = RLock()
 
 TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
 
-def say(format_, args=(), say_quiet=False):
+#marks event records in place of a format, their args are the fields
+EVENT = object()
+
+#records waiting for the writer, anything beyond is dropped rather than blocking the caller
+MAX_QUEUED = 10000
+
+#messages per second allowed for each kind, a burst of up to one second is let through
+RATE_LIMITS = {'checking': 5, 'verification': 1}
+
+#how often the number of suppressed messages is reported
+NOTICE_INTERVAL = 10
+
+records = Queue(MAX_QUEUED)
+writer = None
+writer_lock = Lock()
+
+limits_lock = Lock()
+buckets = {}
+suppressed = {}
+dropped = [0]
+last_notice = [0]
+
+
+def allowed(kind, now):
+	rate = RATE_LIMITS.get(kind)
+	if not rate: return True
+	with limits_lock:
+		tokens, last = buckets.get(kind, (rate, now))
+		tokens = min(rate, tokens + (now - last) * rate)
+		if tokens < 1:
+			buckets[kind] = (tokens, now)
+			suppressed[kind] = suppressed.get(kind, 0) + 1
+			return False
+		buckets[kind] = (tokens - 1, now)
+		return True
+
+def enqueue(record):
+	global writer
+	if not writer:
+		with writer_lock:
+			if not writer:
+				writer = Thread(target=write_loop, name='log')
+				writer.daemon = True
+				writer.start()
+	try:
+		records.put_nowait(record)
+	except Full:
+		dropped[0] += 1
+
+#runs on the writer thread, callers only pay for the enqueue
+def format_record(record):
+	now, server_, line, format_, args = record
+	if format_ is None:
+		return args
+	if format_ is EVENT:
+		return format_event(now, server_, args)
+	p = format_ % args
+	if json_events:
+		return format_event(now, server_, {'event': 'message', 'text': p})
+	timestamp = datetime.fromtimestamp(now).strftime(TIME_FORMAT)
+	if verbose:
+		return '%s %s, %s\n' % (server_, timestamp, p)
+	if line:
+		p = '%s, %s\n' % (timestamp, p)
+	return '\r%s\r%s %s' % (' '*80, server_, p)
+
+def format_event(now, server_, fields):
+	fields = dict(fields, time=round(now, 3))
+	if server_:
+		fields['server'] = server_
+	return dumps(fields, separators=(',', ':')) + '\n'
+
+def write_loop():
+	while True:
+		batch = [records.get()]
+		try:
+			while True:
+				batch.append(records.get_nowait())
+		except Empty:
+			pass
+
+		output = []
+		for i, record in enumerate(batch):
+			#a status line is overwritten by the next one, only the last of a batch is shown
+			if not verbose and record[3] is not None and not record[2] and i + 1 < len(batch) and batch[i + 1][3] is not None and not batch[i + 1][2]:
+				continue
+			try:
+				output.append(format_record(record))
+			except Exception:
+				output.append('log: bad record %r\n' % (record[3:],))
+		if time() - last_notice[0] > NOTICE_INTERVAL:
+			last_notice[0] = time()
+			notices = []
+			with limits_lock:
+				for kind, count in suppressed.items():
+					notices.append('%d %s messages suppressed' % (count, kind))
+				suppressed.clear()
+			if dropped[0]:
+				notices.append('%d messages dropped' % dropped[0])
+				dropped[0] = 0
+			for notice in notices:
+				output.append(format_record((time(), server, True, '%s', notice)))
+
+		try:
+			sys.stdout.write(''.join(output))
+			sys.stdout.flush()
+		except IOError:
+			pass
+		for record in batch:
+			records.task_done()
+
+def flush(timeout=1):
+	"""Waits until the writer has caught up, for use before exiting."""
+	deadline = time() + timeout
+	while records.unfinished_tasks and time() < deadline:
+		sleep(0.01)
+
+def say(format_, args=(), say_quiet=False, line=False, kind=None):
 	if quiet and not say_quiet: return
-	with lock:
-		p = format_ % args
-		if verbose:
-			print '%s %s,' % (server, datetime.now().strftime(TIME_FORMAT)), p
-		else:
-			sys.stdout.write('\r%s\r%s %s' % (' '*80, server, p))
-		sys.stdout.flush()
+	now = time()
+	if kind and not allowed(kind, now): return
+	enqueue((now, server, line, format_, args))
 
-def say_line(format_, args=()):
-	if not verbose:
-		format_ = '%s, %s\n' % (datetime.now().strftime(TIME_FORMAT), format_)
-	say(format_, args)
+def say_line(format_, args=(), kind=None):
+	say(format_, args, line=True, kind=kind)
 
 def say_exception(message=''):
 	type_, value, tb = sys.exc_info()
+	if json_events:
+		fields = {'text': (message + ' %s') % str(value)}
+		if verbose:
+			fields['traceback'] = ''.join(traceback.format_exception(type_, value, tb))
+		event('error', **fields)
+		return
 	say_line(message + ' %s', str(value))
 	if verbose:
-		traceback.print_exception(type_, value, tb)
+		enqueue((time(), server, True, None, ''.join(traceback.format_exception(type_, value, tb))))
+
+def event(type_, **fields):
+	"""One line JSON event for --json-events, nothing otherwise. Types that
+	have a rate limit are limited like messages of the same kind."""
+	if not json_events: return
+	now = time()
+	if not allowed(type_, now): return
+	fields['event'] = type_
+	enqueue((now, server, True, EVENT, fields))
 
 def say_quiet(format_, args=()):
 	say(format_, args, True)
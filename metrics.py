@@ -0,0 +1,133 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StratumServer import parse_address
+from log import say_line
+from threading import Thread
+
+
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class MetricsServer(object):
+	"""Prometheus text exposition of the miners and pools. Everything is read
+	from figures the miners and sources keep anyway. The only lock a scrape
+	shares with the device threads is the registry's, which they take once
+	per rate interval."""
+	def __init__(self, switch, address):
+		self.switch = switch
+		self.httpd = ThreadedHTTPServer(parse_address(address), Handler)
+		self.httpd.metrics_server = self
+		thread = Thread(target=self.httpd.serve_forever, name='metrics server')
+		thread.daemon = True
+		thread.start()
+		say_line('Serving metrics on http://%s:%d' + METRICS_PATH, self.httpd.server_address)
+
+	def render(self):
+		switch = self.switch
+		out = Exposition()
+
+		out.family('poclbm_hashrate', 'gauge', 'Hash rate over the last --rate interval, in hashes per second')
+		out.family('poclbm_estimated_hashrate', 'gauge', 'Hash rate estimated from accepted shares, in hashes per second')
+		out.family('poclbm_shares_total', 'counter', 'Shares answered by the pool')
+		out.family('poclbm_hardware_errors_total', 'counter', 'Results that failed verification')
+		out.family('poclbm_work_queue_depth', 'gauge', 'Work waiting for the miner')
+		out.family('poclbm_kernel_seconds', 'histogram', 'Duration of a kernel run, or a job on BFL devices')
+		out.family('poclbm_device_idle_seconds_total', 'counter', 'Time BFL devices spent without a job to work on')
+		for miner in switch.miners:
+			labels = {'miner': miner.id()}
+			figures = switch.registry.get(miner)
+			out.sample('poclbm_hashrate', labels, figures['rate'] * 1e6)
+			out.sample('poclbm_estimated_hashrate', labels, figures['estimated_rate'] * 1e6)
+			out.sample('poclbm_shares_total', dict(labels, result='accepted'), figures['accepted'])
+			out.sample('poclbm_shares_total', dict(labels, result='rejected'), figures['rejected'])
+			out.sample('poclbm_hardware_errors_total', labels, figures['hw_errors'])
+			out.sample('poclbm_work_queue_depth', labels, miner.work_queue.qsize())
+			out.histogram('poclbm_kernel_seconds', labels, miner.kernel_time)
+			if hasattr(miner, 'idle_seconds'):
+				out.sample('poclbm_device_idle_seconds_total', labels, miner.idle_seconds())
+
+		out.family('poclbm_decode_seconds', 'histogram', 'Time to turn a block header into work')
+		out.histogram('poclbm_decode_seconds', {}, switch.decode_time)
+		out.family('poclbm_verify_seconds', 'histogram', 'Time to verify a nonce on the CPU')
+		out.histogram('poclbm_verify_seconds', {}, switch.verify_time)
+
+		out.family('poclbm_pool_active', 'gauge', 'Whether the pool is the one mined on')
+		out.family('poclbm_pool_up', 'gauge', 'Whether the connection to the pool is working')
+		out.family('poclbm_pool_connections_total', 'counter', 'Connections made to the pool')
+		out.family('poclbm_result_queue_depth', 'gauge', 'Results waiting to be submitted')
+		out.family('poclbm_submit_seconds', 'histogram', 'Time from submitting a share to its acknowledgement')
+		for i, server in enumerate(list(switch.servers)):
+			#failback hosts the pool announced share the name and user of the entry they came from
+			labels = {'pool': server.name, 'user': server.user, 'host': server.host}
+			source = getattr(server, 'source', None)
+			pool_stats = switch.stats(server)
+			out.sample('poclbm_pool_active', labels, int(i == switch.server_index))
+			out.sample('poclbm_pool_up', labels, int(bool(source and source.healthy())))
+			out.sample('poclbm_pool_connections_total', labels, pool_stats.connections)
+			if source:
+				out.sample('poclbm_result_queue_depth', labels, source.result_queue.qsize())
+			out.histogram('poclbm_submit_seconds', labels, pool_stats.submit_histogram)
+
+		return out.text()
+
+class Exposition(object):
+	"""Collects samples grouped by metric family, as the format requires."""
+	def __init__(self):
+		self.families = []
+		self.samples = {}
+
+	def family(self, name, type_, help_):
+		self.families.append((name, type_, help_))
+		self.samples[name] = []
+
+	def sample(self, name, labels, value, suffix=''):
+		self.samples[name].append('%s%s%s %s' % (name, suffix, format_labels(labels), format_value(value)))
+
+	def histogram(self, name, labels, histogram):
+		buckets, total, count = histogram.snapshot()
+		for bound, seen in buckets:
+			self.sample(name, dict(labels, le=format_value(bound)), seen, '_bucket')
+		self.sample(name, labels, total, '_sum')
+		self.sample(name, labels, count, '_count')
+
+	def text(self):
+		lines = []
+		for name, type_, help_ in self.families:
+			lines.append('# HELP %s %s' % (name, help_))
+			lines.append('# TYPE %s %s' % (name, type_))
+			lines.extend(self.samples[name])
+		return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+	if not labels:
+		return ''
+	def escape(value):
+		return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	return '{%s}' % ','.join('%s="%s"' % (key, escape(value)) for key, value in sorted(labels.items()))
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value))
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class Handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		if self.path.split('?')[0] != METRICS_PATH:
+			self.send_error(404)
+			return
+		body = self.server.metrics_server.render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', CONTENT_TYPE)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format_, *args):
+		pass
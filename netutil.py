@@ -0,0 +1,299 @@
+from reactor import Channel, Reactor
+from threading import Lock, Thread
+from time import time
+from util import if_else
+import errno
+import os
+import select
+import socket
+import socks
+
+
+#the system resolver does not tell us record TTLs, these are conservative
+DNS_TTL = 300
+DNS_NEGATIVE_TTL = 30
+
+CONNECT_TIMEOUT = 5
+
+#head start of each address over the next one, as recommended by RFC 8305
+STAGGER = 0.25
+
+#idle proxied connections are replaced well before the usual idle timeouts
+STANDBY_TTL = 60
+STANDBY_RETRY = 10
+
+IN_PROGRESS = (0, errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+def split_host(host, default_port=None):
+	if host.startswith('['):
+		address, _, port = host[1:].partition(']')
+		port = port.lstrip(':')
+	elif host.count(':') == 1:
+		address, port = host.split(':')
+	else:
+		address, port = host, ''
+	return address, int(port or default_port)
+
+def interleave(addresses):
+	"""Alternates address families, IPv6 first, so one broken family costs at
+	most one stagger step."""
+	v6 = [a for a in addresses if a[0] == socket.AF_INET6]
+	other = [a for a in addresses if a[0] != socket.AF_INET6]
+	result = []
+	while v6 or other:
+		if v6: result.append(v6.pop(0))
+		if other: result.append(other.pop(0))
+	return result
+
+
+class Resolver(object):
+	"""getaddrinfo with a cache. An expired entry is still used when a fresh
+	lookup fails, a failed lookup is remembered for a short while."""
+	def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.cache = {}
+		self.lock = Lock()
+
+	def resolve(self, host, port):
+		key = (host, port)
+		with self.lock:
+			entry = self.cache.get(key)
+		if entry and entry[0] > time():
+			if isinstance(entry[1], socket.error):
+				raise entry[1]
+			return list(entry[1])
+
+		try:
+			infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+		except socket.error as e:
+			if entry and not isinstance(entry[1], socket.error):
+				return list(entry[1])
+			with self.lock:
+				self.cache[key] = (time() + self.negative_ttl, e)
+			raise
+
+		addresses = []
+		for family, socktype, proto, _, address in infos:
+			if (family, socktype, proto, address) not in addresses:
+				addresses.append((family, socktype, proto, address))
+		addresses = interleave(addresses)
+		with self.lock:
+			self.cache[key] = (time() + self.ttl, addresses)
+		return list(addresses)
+
+	def prefetch(self, hosts):
+		"""Resolves (host, default port) pairs in the background so failing over
+		to them does not wait for DNS."""
+		def run():
+			for host, default_port in hosts:
+				try:
+					self.resolve(*split_host(host, default_port))
+				except (socket.error, ValueError):
+					pass
+		thread = Thread(target=run, name='dns prefetch')
+		thread.daemon = True
+		thread.start()
+
+resolver = Resolver()
+
+
+def connect(host, port, timeout=CONNECT_TIMEOUT):
+	"""Happy eyeballs: starts a connection to the next resolved address of host
+	every STAGGER seconds, or as soon as the previous attempt fails, and returns
+	the first socket that connects. The others are closed."""
+	addresses = resolver.resolve(host, port)
+	pending = {}
+	error = None
+	deadline = time() + timeout
+	next_start = 0
+	try:
+		while addresses or pending:
+			now = time()
+			if now >= deadline:
+				break
+			if addresses and (now >= next_start or not pending):
+				family, socktype, proto, address = addresses.pop(0)
+				sock = None
+				try:
+					sock = socket.socket(family, socktype, proto)
+					blocking_timeout = sock.gettimeout()
+					sock.setblocking(0)
+					code = sock.connect_ex(address)
+					if code not in IN_PROGRESS:
+						raise socket.error(code, os.strerror(code))
+					pending[sock] = blocking_timeout
+					next_start = now + STAGGER
+				except socket.error as e:
+					error = e
+					if sock: sock.close()
+				continue
+
+			wait = deadline - now
+			if addresses:
+				wait = min(wait, max(next_start - now, 0))
+			_, writable, failed = select.select([], pending.keys(), pending.keys(), wait)
+			for sock in set(writable + failed):
+				code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if not code and sock not in failed:
+					sock.settimeout(pending.pop(sock))
+					return sock
+				code = code or errno.ECONNREFUSED
+				error = socket.error(code, os.strerror(code))
+				del pending[sock]
+				sock.close()
+	finally:
+		for sock in pending:
+			sock.close()
+	raise error or socket.timeout('timed out connecting to %s:%d' % (host, port))
+
+
+def proxy_settings(proxy):
+	"""socks.setproxy arguments for a parsed --proxy entry."""
+	proxy_type = socks.PROXY_TYPE_SOCKS5
+	if proxy.proto == 'http':
+		proxy_type = socks.PROXY_TYPE_HTTP
+	elif proxy.proto == 'socks4':
+		proxy_type = socks.PROXY_TYPE_SOCKS4
+	host, port = split_host(proxy.host, 9050)
+	return (proxy_type, host, port, True, proxy.user, proxy.pwd)
+
+def proxy_connect(proxy, host, port):
+	sock = socks.socksocket()
+	sock.setproxy(*proxy_settings(proxy))
+	sock.connect((str(host), int(port)))
+	return sock
+
+
+class Standby(Channel):
+	"""A connection through the proxy that is negotiated before it is needed."""
+	def __init__(self, pool, key, start_at, proxy):
+		super(Standby, self).__init__()
+		self.pool = pool
+		self.key = key
+		self.start_at = start_at
+		self.ready_at = None
+		self.connected = False
+		self.negotiation = None
+		self.proxy = proxy
+		family, socktype, proto, self.address = proxy
+		self.sock = socket.socket(family, socktype, proto)
+		self.timeout = self.sock.gettimeout()
+		self.sock.setblocking(0)
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def readable(self):
+		return self.connected
+
+	def writable(self):
+		return self.negotiation is not None and (not self.connected or bool(self.negotiation.output))
+
+	def deadline(self):
+		if self.negotiation is None:
+			return self.start_at
+		if self.ready_at:
+			return self.ready_at + STANDBY_TTL
+		return self.start_at + CONNECT_TIMEOUT
+
+	def handle_timeout(self):
+		with self.pool.lock:
+			if not self.reactor: return
+			if self.negotiation is not None:
+				self.close()
+				return
+			self.negotiation = socks.Negotiation(self.pool.settings, *self.key)
+			self.start_at = time()
+			code = self.sock.connect_ex(self.address)
+			if code not in IN_PROGRESS:
+				raise socket.error(code, os.strerror(code))
+
+	def handle_write(self):
+		with self.pool.lock:
+			if not self.reactor: return
+			if not self.connected:
+				code = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if code:
+					raise socket.error(code, os.strerror(code))
+				self.connected = True
+			if self.negotiation.output:
+				data = self.negotiation.take()
+				sent = self.sock.send(data)
+				self.negotiation.output[:0] = data[sent:]
+
+	def handle_read(self):
+		with self.pool.lock:
+			if not self.reactor: return
+			#neither proxies nor pools talk first, anything else means the tunnel is gone
+			if self.ready_at:
+				self.close()
+			elif self.negotiation.feed(self.sock.recv(self.negotiation.wanted())):
+				self.ready_at = time()
+
+	#a standby that fails is just retried later
+	def handle_error(self):
+		self.close()
+
+	def handle_close(self):
+		self.pool.closed(self)
+
+class StandbyPool(object):
+	"""Keeps proxied connections to the servers a failover or failback would
+	go to, so switching does not wait for the proxy handshake. Each one is
+	replaced after STANDBY_TTL, before pools or proxies drop it as idle."""
+	def __init__(self, proxy):
+		self.settings = proxy_settings(proxy)
+		self.reactor = Reactor('proxy standby')
+		self.lock = Lock()
+		self.wanted = set()
+		self.connections = {}
+
+	def keep(self, hosts):
+		"""Sets the (host, port) pairs to keep connections to."""
+		#DNS may take seconds, the lock is taken by the reactor and the switch
+		try:
+			proxy = resolver.resolve(*self.settings[1:3])[0]
+		except socket.error:
+			proxy = None
+		with self.lock:
+			self.wanted = set(hosts)
+			for key, standby in self.connections.items():
+				if key not in self.wanted:
+					del self.connections[key]
+					standby.close()
+			for key in self.wanted:
+				if key not in self.connections:
+					self.prepare(key, time(), proxy)
+
+	#proxy is the resolved address of the proxy, None if it did not resolve
+	def prepare(self, key, start_at, proxy):
+		if not proxy:
+			return
+		try:
+			standby = Standby(self, key, start_at, proxy)
+		except socket.error:
+			return
+		self.connections[key] = standby
+		self.reactor.add(standby)
+
+	def take(self, host, port):
+		"""Returns a negotiated blocking socket to host, if there is one."""
+		key = (host, port)
+		with self.lock:
+			standby = self.connections.get(key)
+			if not standby or not standby.ready_at or standby.closing:
+				return None
+			del self.connections[key]
+			self.reactor.remove(standby)
+		standby.sock.settimeout(standby.timeout)
+		return standby.sock
+
+	def closed(self, standby):
+		with self.lock:
+			if self.connections.get(standby.key) is not standby:
+				return
+			del self.connections[standby.key]
+			if standby.key in self.wanted:
+				self.prepare(standby.key, time() + if_else(standby.ready_at, 0, STANDBY_RETRY), standby.proxy)
@@ -25,10 +25,23 @@ usage = "usage: %prog [OPTION]... SERVER[#tag]...\nSERVER is one or more [http[s
 parser = OptionParser(version=VERSION, usage=usage)
 parser.add_option('--verbose',        dest='verbose',        action='store_true', help='verbose output, suitable for redirection to log file')
 parser.add_option('-q', '--quiet',    dest='quiet',          action='store_true', help='suppress all output except hash rate display')
+parser.add_option('--json-events',    dest='json_events',    action='store_true', help='write one JSON event per line (rate, share, block, checking, device, error, message) instead of text output')
 parser.add_option('--proxy',          dest='proxy',          default='',          help='specify as [[socks4|socks5|http://]user:pass@]host:port (default proto is socks5)')
 parser.add_option('--no-ocl',         dest='no_ocl',         action='store_true', help="don't use OpenCL")
 parser.add_option('--no-bfl',         dest='no_bfl',         action='store_true', help="don't use Butterfly Labs")
+parser.add_option('--bfl-ports',      dest='bfl_ports',      default='',          help='comma separated serial ports of Butterfly Labs devices, instead of searching for them')
+parser.add_option('--no-bfl-queue',   dest='no_bfl_queue',   action='store_true', help="send Butterfly Labs devices one job at a time even if their firmware can queue work")
 parser.add_option('--stratum-proxies',dest='stratum_proxies',action='store_true', help="search for and use stratum proxies in subnet")
+parser.add_option('--submit-delay',   dest='submit_delay',   default=1000,        help='coalesce stratum share submits for up to N microseconds, block candidates are sent at once, default 1000', type='int')
+parser.add_option('--version-rolling',dest='version_rolling',action='store_true', help='negotiate stratum version rolling (BIP310) to vary the block version instead of the merkle root')
+parser.add_option('--share-rate',     dest='share_rate',     default='',          help='suggest stratum difficulties that keep the share rate within MIN,MAX shares per minute')
+parser.add_option('--suggest-difficulty',dest='suggest_difficulty',default='method',help='how to suggest difficulty: method (mining.suggest_difficulty) or password (d=N), default method', choices=['method', 'password'])
+parser.add_option('--serve-stratum',  dest='serve_stratum',  default='',          help='share the stratum pool connection with other miners, listen on [host:]port and answer proxy discovery')
+parser.add_option('--serve-getwork',  dest='serve_getwork',  default='',          help='serve getwork with long polling on [host:]port, backed by the stratum pool connection')
+parser.add_option('--stratum-links',  dest='stratum_links',  default=1,           help='keep up to N connections to different endpoints of the same stratum pool account, jobs from the first to announce a block are used, default 1', type='int')
+parser.add_option('--metrics',        dest='metrics',        default='',          help='export Prometheus metrics over HTTP on [host:]port/metrics')
+parser.add_option('--api',            dest='api',            default='',          help='serve a cgminer compatible JSON API on [host:]port')
+parser.add_option('--api-allow',      dest='api_allow',      default='127.0.0.1', help='comma separated addresses or networks (address/bits) allowed to use the API commands that change settings, default 127.0.0.1')
 parser.add_option('-d', '--device',   dest='device',         default=[],          help='comma separated device IDs, by default will use all (for OpenCL - only GPU devices)')
 
 group = OptionGroup(parser, "Miner Options")
@@ -39,6 +52,7 @@ group.add_option('-b', '--failback',      dest='failback',   default=60,      he
 group.add_option('--cutoff-temp',         dest='cutoff_temp',default=[],      help='AMD GPUs, BFL only. For GPUs requires github.com/mjmvisser/adl3. Comma separated temperatures at which to skip kernel execution, in C, default=95')
 group.add_option('--cutoff-interval',     dest='cutoff_interval',default=[],  help='how long to not execute calculations if CUTOFF_TEMP is reached, in seconds, default=0.01')
 group.add_option('--no-server-failbacks', dest='nsf',        action='store_true', help='disable using failback hosts provided by server')
+group.add_option('--prefer-latency',      dest='prefer_latency', action='store_true', help='when failing over, try the backup of the same account with the fastest share acknowledgements first')
 parser.add_option_group(group)
 
 group = OptionGroup(parser,
@@ -59,6 +73,7 @@ parser.add_option_group(group)
 
 log.verbose = options.verbose
 log.quiet = options.quiet
+log.json_events = options.json_events
 
 options.rate = if_else(options.verbose, options.rate, max(options.rate, 0.1))
 
@@ -67,10 +82,15 @@ options.version = VERSION
 options.max_update_time = 60
 
 options.device = tokenize(options.device, 'device', [])
+options.bfl_ports = tokenize(options.bfl_ports, 'bfl_ports', [], str)
 
 options.cutoff_temp = tokenize(options.cutoff_temp, 'cutoff_temp', [95], float)
 options.cutoff_interval = tokenize(options.cutoff_interval, 'cutoff_interval', [0.01], float)
 
+options.share_rate = tokenize(options.share_rate, 'share_rate', [], float)
+if len(options.share_rate) == 1:
+	options.share_rate *= 2
+
 switch = None
 try:
 	switch = Switch(options)
@@ -87,7 +107,7 @@ try:
 
 	if not switch.servers:
 		print '\nAt least one server is required\n'
-	elif not switch.miners:
+	elif not switch.miners and not options.serve_stratum and not options.serve_getwork:
 		print '\nNothing to mine on, exiting\n'
 	else:
 		for miner in switch.miners:
@@ -102,4 +122,5 @@ finally:
 
 	if not options.no_ocl:
 		OpenCLMiner.shutdown()
+	log.flush()
 sleep(1.1)
\ No newline at end of file
@@ -0,0 +1,285 @@
+from log import say_exception
+from threading import Condition, Lock, Thread, current_thread
+from time import time
+import errno
+import select
+import socket
+
+
+RECEIVE_SIZE = 0x10000
+MAX_LINE = 0x100000
+MAX_BUFFER = 0x100000
+SEND_TIMEOUT = 5
+
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Channel(object):
+	"""Something the Reactor can select on, in the spirit of asyncore.dispatcher."""
+	def __init__(self):
+		self.reactor = None
+		self.closing = False
+
+	def readable(self):
+		return True
+
+	def writable(self):
+		return False
+
+	#time at which handle_timeout is due
+	def deadline(self):
+		return None
+
+	def handle_timeout(self):
+		pass
+
+	def handle_read(self):
+		pass
+
+	def handle_write(self):
+		pass
+
+	def handle_error(self):
+		say_exception()
+		self.close()
+
+	def handle_close(self):
+		pass
+
+	def close(self):
+		self.closing = True
+		if self.reactor:
+			self.reactor.wake()
+
+
+class Waker(object):
+	"""Loopback datagram socket used to interrupt select from other threads.
+	A socketpair would do, but it is not available on Windows."""
+	def __init__(self):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(('127.0.0.1', 0))
+		self.sock.setblocking(0)
+		self.address = self.sock.getsockname()
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def wake(self):
+		try:
+			self.sock.sendto('\0', self.address)
+		except socket.error:
+			pass
+
+	def drain(self):
+		try:
+			while True:
+				self.sock.recv(64)
+		except socket.error:
+			pass
+
+
+class Reactor(object):
+	"""Drives any number of channels from a single select() thread. All socket
+	I/O of registered channels happens on that thread. The thread ends once
+	the last channel is finished and the next add() starts a new one."""
+	def __init__(self, name='reactor'):
+		self.name = name
+		self.channels = set()
+		self.lock = Lock()
+		self.waker = Waker()
+		self.thread = None
+
+	def add(self, channel):
+		with self.lock:
+			channel.reactor = self
+			self.channels.add(channel)
+			if not self.thread:
+				self.thread = Thread(target=self.loop, name=self.name)
+				self.thread.daemon = True
+				self.thread.start()
+		self.wake()
+
+	#stop driving a channel without closing its socket, for handing it over
+	def remove(self, channel):
+		with self.lock:
+			self.channels.discard(channel)
+			channel.reactor = None
+		self.wake()
+
+	#closes every channel, the thread ends when they are finished
+	def stop(self):
+		with self.lock:
+			channels = list(self.channels)
+		for channel in channels:
+			channel.close()
+
+	def wake(self):
+		if self.thread is not None:
+			self.waker.wake()
+
+	def finish(self, channel):
+		with self.lock:
+			self.channels.discard(channel)
+		try:
+			if channel.sock is not None:
+				channel.sock.close()
+		except EnvironmentError:
+			pass
+		try:
+			channel.handle_close()
+		except Exception:
+			say_exception()
+
+	def loop(self):
+		while True:
+			with self.lock:
+				if not self.channels:
+					self.thread = None
+					return
+				channels = list(self.channels)
+
+			readers = [self.waker]; writers = []
+			deadline = None
+			finished = False
+			for channel in channels:
+				if channel.closing:
+					self.finish(channel)
+					finished = True
+					continue
+				if channel.readable(): readers.append(channel)
+				if channel.writable(): writers.append(channel)
+				due = channel.deadline()
+				if due is not None and (deadline is None or due < deadline):
+					deadline = due
+
+			#the last channel may be gone
+			if finished:
+				continue
+
+			timeout = None
+			if deadline is not None:
+				timeout = max(deadline - time(), 0)
+
+			try:
+				readable, writable = select.select(readers, writers, [], timeout)[:2]
+			except (select.error, socket.error, ValueError):
+				# a channel was closed under us, rebuild the lists
+				continue
+
+			now = time()
+			for channel in channels:
+				due = channel.deadline()
+				if due is not None and due <= now:
+					self.dispatch(channel, channel.handle_timeout)
+
+			for channel in writable:
+				self.dispatch(channel, channel.handle_write)
+			for channel in readable:
+				if channel is self.waker:
+					self.waker.drain()
+				else:
+					self.dispatch(channel, channel.handle_read)
+
+	def dispatch(self, channel, handler):
+		if channel.closing: return
+		try:
+			handler()
+		except Exception:
+			channel.handle_error()
+
+
+class LineChannel(Channel):
+	"""Newline delimited stream with a bytearray receive buffer. Any thread may
+	send(), the reactor thread is the only writer. Other threads block once more
+	than max_buffer bytes are pending, which keeps a stalled peer from growing
+	the buffer without bound. The reactor thread itself never waits, it is the
+	one that drains the buffer. A send() with a delay may sit in the buffer for that
+	long so that further messages go out in the same write."""
+	def __init__(self, sock, max_buffer=MAX_BUFFER):
+		super(LineChannel, self).__init__()
+		sock.setblocking(0)
+		self.sock = sock
+		self.max_buffer = max_buffer
+		self.in_buffer = bytearray()
+		self.out_buffer = bytearray()
+		self.out_lock = Lock()
+		self.drained = Condition(self.out_lock)
+		self.flush_at = None
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def handle_line(self, line):
+		pass
+
+	def handle_read(self):
+		try:
+			data = self.sock.recv(RECEIVE_SIZE)
+		except socket.error as e:
+			if e.args[0] in WOULD_BLOCK: return
+			raise
+		if not data:
+			self.close()
+			return
+
+		self.in_buffer.extend(data)
+		end = data.rfind('\n')
+		if end == -1:
+			if len(self.in_buffer) > MAX_LINE:
+				raise IOError('line exceeds %d bytes' % MAX_LINE)
+			return
+		end += len(self.in_buffer) - len(data)
+		lines = str(self.in_buffer[:end]).split('\n')
+		del self.in_buffer[:end + 1]
+		for line in lines:
+			if line.strip():
+				self.handle_line(line)
+			if self.closing: return
+
+	def writable(self):
+		return bool(self.out_buffer) and self.flush_at <= time()
+
+	def deadline(self):
+		if self.out_buffer and self.flush_at > time():
+			return self.flush_at
+
+	def handle_write(self):
+		with self.out_lock:
+			try:
+				sent = self.sock.send(self.out_buffer)
+			except socket.error as e:
+				if e.args[0] in WOULD_BLOCK: return
+				raise
+			del self.out_buffer[:sent]
+			if not self.out_buffer:
+				self.flush_at = None
+			self.drained.notify_all()
+
+	def send(self, data, delay=0, timeout=SEND_TIMEOUT):
+		reactor = self.reactor
+		on_reactor = reactor is not None and current_thread() is reactor.thread
+		with self.out_lock:
+			now = time()
+			deadline = now + timeout
+			while len(self.out_buffer) >= self.max_buffer and not self.closing and not on_reactor:
+				remaining = deadline - time()
+				if remaining <= 0:
+					return False
+				self.drained.wait(remaining)
+			if self.closing:
+				return False
+			self.out_buffer.extend(data)
+			flush_at = now + delay
+			if self.flush_at is not None and self.flush_at <= flush_at:
+				return True
+			self.flush_at = flush_at
+		if self.reactor:
+			self.reactor.wake()
+		return True
+
+	def close(self):
+		with self.out_lock:
+			self.closing = True
+			self.drained.notify_all()
+		if self.reactor:
+			self.reactor.wake()
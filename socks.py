@@ -114,71 +114,110 @@ def setdefaultproxy(proxytype=None,addr=None,port=None,rdns=True,username=None,p
 	global _defaultproxy
 	_defaultproxy = (proxytype,addr,port,rdns,username,password)
 	
-class socksocket(socket.socket):
-	"""socksocket([family[, type[, proto]]]) -> socket object
-	
-	Open a SOCKS enabled socket. The parameters are the same as
-	those of the standard socket init. In order for SOCKS to work,
-	you must specify family=AF_INET, type=SOCK_STREAM and proto=0.
+# Marks a read up to and including the blank line ending an HTTP response header
+HEADER = -1
+
+def proxyport(proxy):
+	"""proxyport(proxy) -> port
+	Returns the port of the proxy server, or the default for its type.
 	"""
-	
-	def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0, _sock=None):
-		_orgsocket.__init__(self,family,type,proto,_sock)
-		if _defaultproxy != None:
-			self.__proxy = _defaultproxy
+	if proxy[2] != None:
+		return proxy[2]
+	if proxy[0] == PROXY_TYPE_HTTP:
+		return 8080
+	return 1080
+
+class Negotiation(object):
+	"""Negotiation(proxy, destaddr, destport) -> negotiation
+
+	The proxy handshake without any I/O, so it can be driven by a
+	blocking socket as well as by an event loop. The owner of the
+	socket sends take(), receives at most wanted() bytes and passes
+	them to feed() until done is set. wanted() never reaches past the
+	proxy's reply, no data of the tunneled connection is consumed.
+	Failures raise the same errors as socksocket.connect.
+	"""
+
+	def __init__(self, proxy, destaddr, destport):
+		self.proxy = proxy
+		self.output = bytearray()
+		self.buffer = bytearray()
+		self.done = False
+		self.proxysockname = None
+		self.proxypeername = None
+		if proxy[0] == PROXY_TYPE_SOCKS5:
+			self.steps = self.__negotiatesocks5(destaddr, destport)
+		elif proxy[0] == PROXY_TYPE_SOCKS4:
+			self.steps = self.__negotiatesocks4(destaddr, destport)
+		elif proxy[0] == PROXY_TYPE_HTTP:
+			self.steps = self.__negotiatehttp(destaddr, destport)
 		else:
-			self.__proxy = (None, None, None, None, None, None)
-		self.__proxysockname = None
-		self.__proxypeername = None
-	
-	def __recvall(self, bytes):
-		"""__recvall(bytes) -> data
-		Receive EXACTLY the number of bytes requested from the socket.
-		Blocks until the required number of bytes have been received.
+			raise GeneralProxyError((4,_generalerrors[4]))
+		self.needed = self.steps.next()
+
+	def take(self):
+		"""take() -> data
+		Returns and forgets the bytes that have to be sent to the proxy.
 		"""
-		data = ""
-		while len(data) < bytes:
-			data = data + self.recv(bytes-len(data))
+		data = str(self.output)
+		del self.output[:]
 		return data
-	
-	def setproxy(self,proxytype=None,addr=None,port=None,rdns=True,username=None,password=None):
-		"""setproxy(proxytype, addr[, port[, rdns[, username[, password]]]])
-		Sets the proxy to be used.
-		proxytype -	The type of the proxy to be used. Three types
-				are supported: PROXY_TYPE_SOCKS4 (including socks4a),
-				PROXY_TYPE_SOCKS5 and PROXY_TYPE_HTTP
-		addr -		The address of the server (IP or DNS).
-		port -		The port of the server. Defaults to 1080 for SOCKS
-				servers and 8080 for HTTP proxy servers.
-		rdns -		Should DNS queries be preformed on the remote side
-				(rather than the local side). The default is True.
-				Note: This has no effect with SOCKS4 servers.
-		username -	Username to authenticate with to the server.
-				The default is no authentication.
-		password -	Password to authenticate with to the server.
-				Only relevant when username is also provided.
+
+	def wanted(self):
+		"""wanted() -> count
+		The number of bytes that can be received without reading past
+		the proxy's reply.
 		"""
-		self.__proxy = (proxytype,addr,port,rdns,username,password)
-	
+		if self.needed != HEADER:
+			return self.needed - len(self.buffer)
+		for wanted, tail in ((1, "\r\n\r"), (2, "\r\n"), (3, "\r")):
+			if self.buffer.endswith(tail):
+				return wanted
+		return 4
+
+	def feed(self, data):
+		"""feed(data) -> done
+		Processes bytes received from the proxy.
+		"""
+		if not data:
+			raise GeneralProxyError((1,_generalerrors[1]))
+		self.buffer.extend(data)
+		while not self.done:
+			if self.needed == HEADER:
+				end = self.buffer.find("\r\n\r\n")
+				if end == -1:
+					break
+				end += 4
+			elif len(self.buffer) >= self.needed:
+				end = self.needed
+			else:
+				break
+			chunk = str(self.buffer[:end])
+			del self.buffer[:end]
+			try:
+				self.needed = self.steps.send(chunk)
+			except StopIteration:
+				self.done = True
+		return self.done
+
 	def __negotiatesocks5(self,destaddr,destport):
 		"""__negotiatesocks5(self,destaddr,destport)
 		Negotiates a connection through a SOCKS5 server.
 		"""
 		# First we'll send the authentication packages we support.
-		if (self.__proxy[4]!=None) and (self.__proxy[5]!=None):
+		if (self.proxy[4]!=None) and (self.proxy[5]!=None):
 			# The username/password details were supplied to the
 			# setproxy method so we support the USERNAME/PASSWORD
 			# authentication (in addition to the standard none).
-			self.sendall("\x05\x02\x00\x02")
+			self.output.extend("\x05\x02\x00\x02")
 		else:
 			# No username/password were entered, therefore we
 			# only support connections with no authentication.
-			self.sendall("\x05\x01\x00")
+			self.output.extend("\x05\x01\x00")
 		# We'll receive the server's response to determine which
 		# method was selected
-		chosenauth = self.__recvall(2)
+		chosenauth = yield 2
 		if chosenauth[0] != "\x05":
-			self.close()
 			raise GeneralProxyError((1,_generalerrors[1]))
 		# Check the chosen authentication method
 		if chosenauth[1] == "\x00":
@@ -187,20 +226,17 @@ class socksocket(socket.socket):
 		elif chosenauth[1] == "\x02":
 			# Okay, we need to perform a basic username/password
 			# authentication.
-			self.sendall("\x01" + chr(len(self.__proxy[4])) + self.__proxy[4] + chr(len(self.__proxy[5])) + self.__proxy[5])
-			authstat = self.__recvall(2)
+			self.output.extend("\x01" + chr(len(self.proxy[4])) + self.proxy[4] + chr(len(self.proxy[5])) + self.proxy[5])
+			authstat = yield 2
 			if authstat[0] != "\x01":
 				# Bad response
-				self.close()
 				raise GeneralProxyError((1,_generalerrors[1]))
 			if authstat[1] != "\x00":
 				# Authentication failed
-				self.close()
 				raise Socks5AuthError((3,_socks5autherrors[3]))
 			# Authentication succeeded
 		else:
 			# Reaching here is always bad
-			self.close()
 			if chosenauth[1] == "\xFF":
 				raise Socks5AuthError((2,_socks5autherrors[2]))
 			else:
@@ -214,7 +250,7 @@ class socksocket(socket.socket):
 			req = req + "\x01" + ipaddr
 		except socket.error:
 			# Well it's not an IP number,  so it's probably a DNS name.
-			if self.__proxy[3]==True:
+			if self.proxy[3]==True:
 				# Resolve remotely
 				ipaddr = None
 				req = req + "\x03" + chr(len(destaddr)) + destaddr
@@ -223,54 +259,32 @@ class socksocket(socket.socket):
 				ipaddr = socket.inet_aton(socket.gethostbyname(destaddr))
 				req = req + "\x01" + ipaddr
 		req = req + struct.pack(">H",destport)
-		self.sendall(req)
+		self.output.extend(req)
 		# Get the response
-		resp = self.__recvall(4)
+		resp = yield 4
 		if resp[0] != "\x05":
-			self.close()
 			raise GeneralProxyError((1,_generalerrors[1]))
 		elif resp[1] != "\x00":
 			# Connection failed
-			self.close()
 			if ord(resp[1])<=8:
-				raise Socks5Error(ord(resp[1]),_socks5errors[ord(resp[1])])
+				raise Socks5Error((ord(resp[1]),_socks5errors[ord(resp[1])]))
 			else:
-				raise Socks5Error(9,_socks5errors[9])
+				raise Socks5Error((9,_socks5errors[9]))
 		# Get the bound address/port
 		elif resp[3] == "\x01":
-			boundaddr = self.__recvall(4)
+			boundaddr = yield 4
 		elif resp[3] == "\x03":
-			resp = resp + self.recv(1)
-			boundaddr = self.__recvall(resp[4])
+			length = yield 1
+			boundaddr = yield ord(length)
 		else:
-			self.close()
 			raise GeneralProxyError((1,_generalerrors[1]))
-		boundport = struct.unpack(">H",self.__recvall(2))[0]
-		self.__proxysockname = (boundaddr,boundport)
+		boundport = struct.unpack(">H",(yield 2))[0]
+		self.proxysockname = (boundaddr,boundport)
 		if ipaddr != None:
-			self.__proxypeername = (socket.inet_ntoa(ipaddr),destport)
+			self.proxypeername = (socket.inet_ntoa(ipaddr),destport)
 		else:
-			self.__proxypeername = (destaddr,destport)
-	
-	def getproxysockname(self):
-		"""getsockname() -> address info
-		Returns the bound IP address and port number at the proxy.
-		"""
-		return self.__proxysockname
-	
-	def getproxypeername(self):
-		"""getproxypeername() -> address info
-		Returns the IP and port number of the proxy.
-		"""
-		return _orgsocket.getpeername(self)
-	
-	def getpeername(self):
-		"""getpeername() -> address info
-		Returns the IP address and port number of the destination
-		machine (note: getproxypeername returns the proxy)
-		"""
-		return self.__proxypeername
-	
+			self.proxypeername = (destaddr,destport)
+
 	def __negotiatesocks4(self,destaddr,destport):
 		"""__negotiatesocks4(self,destaddr,destport)
 		Negotiates a connection through a SOCKS4 server.
@@ -281,7 +295,7 @@ class socksocket(socket.socket):
 			ipaddr = socket.inet_aton(destaddr)
 		except socket.error:
 			# It's a DNS name. Check where it should be resolved.
-			if self.__proxy[3]==True:
+			if self.proxy[3]==True:
 				ipaddr = "\x00\x00\x00\x01"
 				rmtrslv = True
 			else:
@@ -289,66 +303,128 @@ class socksocket(socket.socket):
 		# Construct the request packet
 		req = "\x04\x01" + struct.pack(">H",destport) + ipaddr
 		# The username parameter is considered userid for SOCKS4
-		if self.__proxy[4] != None:
-			req = req + self.__proxy[4]
+		if self.proxy[4] != None:
+			req = req + self.proxy[4]
 		req = req + "\x00"
 		# DNS name if remote resolving is required
 		# NOTE: This is actually an extension to the SOCKS4 protocol
 		# called SOCKS4A and may not be supported in all cases.
 		if rmtrslv==True:
 			req = req + destaddr + "\x00"
-		self.sendall(req)
+		self.output.extend(req)
 		# Get the response from the server
-		resp = self.__recvall(8)
+		resp = yield 8
 		if resp[0] != "\x00":
 			# Bad data
-			self.close()
 			raise GeneralProxyError((1,_generalerrors[1]))
 		if resp[1] != "\x5A":
 			# Server returned an error
-			self.close()
 			if ord(resp[1]) in (91,92,93):
-				self.close()
 				raise Socks4Error((ord(resp[1]),_socks4errors[ord(resp[1])-90]))
 			else:
 				raise Socks4Error((94,_socks4errors[4]))
 		# Get the bound address/port
-		self.__proxysockname = (socket.inet_ntoa(resp[4:]),struct.unpack(">H",resp[2:4])[0])
-		if rmtrslv != None:
-			self.__proxypeername = (socket.inet_ntoa(ipaddr),destport)
+		self.proxysockname = (socket.inet_ntoa(resp[4:]),struct.unpack(">H",resp[2:4])[0])
+		if rmtrslv:
+			self.proxypeername = (destaddr,destport)
 		else:
-			self.__proxypeername = (destaddr,destport)
-	
+			self.proxypeername = (socket.inet_ntoa(ipaddr),destport)
+
 	def __negotiatehttp(self,destaddr,destport):
 		"""__negotiatehttp(self,destaddr,destport)
 		Negotiates a connection through an HTTP server.
 		"""
 		# If we need to resolve locally, we do this now
-		if self.__proxy[3] == False:
+		if self.proxy[3] == False:
 			addr = socket.gethostbyname(destaddr)
 		else:
 			addr = destaddr
-		self.sendall("CONNECT " + addr + ":" + str(destport) + " HTTP/1.1\r\n" + "Host: " + destaddr + "\r\n\r\n")
+		self.output.extend("CONNECT " + addr + ":" + str(destport) + " HTTP/1.1\r\n" + "Host: " + destaddr + "\r\n\r\n")
 		# We read the response until we get the string "\r\n\r\n"
-		resp = self.recv(1)
-		while resp.find("\r\n\r\n")==-1:
-			resp = resp + self.recv(1)
+		resp = yield HEADER
 		# We just need the first line to check if the connection
 		# was successful
 		statusline = resp.splitlines()[0].split(" ",2)
 		if statusline[0] not in ("HTTP/1.0","HTTP/1.1"):
-			self.close()
 			raise GeneralProxyError((1,_generalerrors[1]))
 		try:
 			statuscode = int(statusline[1])
 		except ValueError:
-			self.close()
 			raise GeneralProxyError((1,_generalerrors[1]))
 		if statuscode != 200:
-			self.close()
 			raise HTTPError((statuscode,statusline[2]))
-		self.__proxysockname = ("0.0.0.0",0)
-		self.__proxypeername = (addr,destport)
+		self.proxysockname = ("0.0.0.0",0)
+		self.proxypeername = (addr,destport)
+
+class socksocket(socket.socket):
+	"""socksocket([family[, type[, proto]]]) -> socket object
+	
+	Open a SOCKS enabled socket. The parameters are the same as
+	those of the standard socket init. In order for SOCKS to work,
+	you must specify family=AF_INET, type=SOCK_STREAM and proto=0.
+	"""
+	
+	def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0, _sock=None):
+		_orgsocket.__init__(self,family,type,proto,_sock)
+		if _defaultproxy != None:
+			self.__proxy = _defaultproxy
+		else:
+			self.__proxy = (None, None, None, None, None, None)
+		self.__proxysockname = None
+		self.__proxypeername = None
+	
+	def setproxy(self,proxytype=None,addr=None,port=None,rdns=True,username=None,password=None):
+		"""setproxy(proxytype, addr[, port[, rdns[, username[, password]]]])
+		Sets the proxy to be used.
+		proxytype -	The type of the proxy to be used. Three types
+				are supported: PROXY_TYPE_SOCKS4 (including socks4a),
+				PROXY_TYPE_SOCKS5 and PROXY_TYPE_HTTP
+		addr -		The address of the server (IP or DNS).
+		port -		The port of the server. Defaults to 1080 for SOCKS
+				servers and 8080 for HTTP proxy servers.
+		rdns -		Should DNS queries be preformed on the remote side
+				(rather than the local side). The default is True.
+				Note: This has no effect with SOCKS4 servers.
+		username -	Username to authenticate with to the server.
+				The default is no authentication.
+		password -	Password to authenticate with to the server.
+				Only relevant when username is also provided.
+		"""
+		self.__proxy = (proxytype,addr,port,rdns,username,password)
+	
+	def __negotiate(self,negotiation):
+		"""__negotiate(self,negotiation)
+		Runs a proxy handshake over the connected socket.
+		"""
+		try:
+			while not negotiation.done:
+				if negotiation.output:
+					self.sendall(negotiation.take())
+				negotiation.feed(self.recv(negotiation.wanted()))
+		except ProxyError:
+			self.close()
+			raise
+		self.__proxysockname = negotiation.proxysockname
+		self.__proxypeername = negotiation.proxypeername
+	
+	def getproxysockname(self):
+		"""getsockname() -> address info
+		Returns the bound IP address and port number at the proxy.
+		"""
+		return self.__proxysockname
+	
+	def getproxypeername(self):
+		"""getproxypeername() -> address info
+		Returns the IP and port number of the proxy.
+		"""
+		return _orgsocket.getpeername(self)
+	
+	def getpeername(self):
+		"""getpeername() -> address info
+		Returns the IP address and port number of the destination
+		machine (note: getproxypeername returns the proxy)
+		"""
+		return self.__proxypeername
 	
 	def connect(self,destpair):
 		"""connect(self,despair)
@@ -360,28 +436,9 @@ class socksocket(socket.socket):
 		# Do a minimal input check first
 		if (type(destpair) in (list,tuple)==False) or (len(destpair)<2) or (type(destpair[0])!=str) or (type(destpair[1])!=int):
 			raise GeneralProxyError((5,_generalerrors[5]))
-		if self.__proxy[0] == PROXY_TYPE_SOCKS5:
-			if self.__proxy[2] != None:
-				portnum = self.__proxy[2]
-			else:
-				portnum = 1080
-			_orgsocket.connect(self,(self.__proxy[1],portnum))
-			self.__negotiatesocks5(destpair[0],destpair[1])
-		elif self.__proxy[0] == PROXY_TYPE_SOCKS4:
-			if self.__proxy[2] != None:
-				portnum = self.__proxy[2]
-			else:
-				portnum = 1080
-			_orgsocket.connect(self,(self.__proxy[1],portnum))
-			self.__negotiatesocks4(destpair[0],destpair[1])
-		elif self.__proxy[0] == PROXY_TYPE_HTTP:
-			if self.__proxy[2] != None:
-				portnum = self.__proxy[2]
-			else:
-				portnum = 8080
-			_orgsocket.connect(self,(self.__proxy[1],portnum))
-			self.__negotiatehttp(destpair[0],destpair[1])
-		elif self.__proxy[0] == None:
+		if self.__proxy[0] == None:
 			_orgsocket.connect(self,(destpair[0],destpair[1]))
-		else:
-			raise GeneralProxyError((4,_generalerrors[4]))
+			return
+		negotiation = Negotiation(self.__proxy,destpair[0],destpair[1])
+		_orgsocket.connect(self,(self.__proxy[1],proxyport(self.__proxy)))
+		self.__negotiate(negotiation)
@@ -0,0 +1,317 @@
+from bisect import bisect_left
+from collections import deque
+from math import exp
+from threading import Lock
+from time import time
+
+
+#upper bounds of the latency buckets in seconds, anything slower lands in the last one
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+WINDOW = 900
+SLOTS = 15
+
+#kernel runs and BFL jobs, in seconds
+KERNEL_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+#work decoding and share verification, in seconds
+CPU_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05)
+
+#samples per horizon of a RateWindows
+RESOLUTION = 300
+
+#a server that reconnected this often within the window is not considered for its latency
+MAX_RECONNECTS = 3
+
+
+class RollingHistogram(object):
+	"""Bucketed samples of the last `window` seconds. The window is split into
+	`slots` sub-histograms that expire one at a time, so adding a sample is
+	O(1) and nothing is kept per sample. Miners, sources and their reactors
+	all add samples, so slots change under a lock."""
+	def __init__(self, bounds=LATENCY_BUCKETS, window=WINDOW, slots=SLOTS):
+		self.bounds = bounds
+		self.span = float(window) / slots
+		self.slots = [None] * slots
+		self.lock = Lock()
+
+	def slot(self, now):
+		index = int(now // self.span)
+		slot = self.slots[index % len(self.slots)]
+		if not slot or slot[0] != index:
+			slot = [index, [0] * (len(self.bounds) + 1), 0.0]
+			self.slots[index % len(self.slots)] = slot
+		return slot
+
+	def add(self, value=0, now=None):
+		index = bisect_left(self.bounds, value)
+		with self.lock:
+			slot = self.slot(now or time())
+			slot[1][index] += 1
+			slot[2] += value
+
+	def merged(self, now=None):
+		oldest = int((now or time()) // self.span) - len(self.slots)
+		counts = [0] * (len(self.bounds) + 1)
+		total = 0.0
+		with self.lock:
+			for slot in self.slots:
+				if slot and slot[0] > oldest:
+					for i, count in enumerate(slot[1]):
+						counts[i] += count
+					total += slot[2]
+		return counts, total
+
+	def count(self, now=None):
+		return sum(self.merged(now)[0])
+
+	def mean(self, now=None):
+		counts, total = self.merged(now)
+		if sum(counts):
+			return total / sum(counts)
+
+	def percentile(self, p, now=None):
+		"""Upper bound of the bucket the p-th percentile falls into."""
+		counts = self.merged(now)[0]
+		rank = sum(counts) * p / 100.0
+		seen = 0
+		for i, count in enumerate(counts):
+			seen += count
+			if count and seen >= rank:
+				return self.bounds[min(i, len(self.bounds) - 1)]
+
+class Histogram(object):
+	"""Cumulative histogram for export. It has a single writer that adds
+	without locking, so a scrape never stalls a device loop. Readers may see
+	the count of a sample before its sum."""
+	def __init__(self, bounds=LATENCY_BUCKETS):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0.0
+
+	def add(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.sum += value
+
+	def snapshot(self):
+		"""(buckets, sum, count), buckets are (upper bound, count of samples
+		up to it) pairs and the last bound is inf."""
+		return self.cumulate(list(self.counts), self.sum)
+
+	def cumulate(self, counts, total):
+		buckets = []
+		seen = 0
+		for bound, count in zip(self.bounds + (float('inf'),), counts):
+			seen += count
+			buckets.append((bound, seen))
+		return buckets, total, seen
+
+class SharedHistogram(Histogram):
+	"""Histogram that several threads add to, samples and snapshots are
+	taken under a lock."""
+	def __init__(self, bounds=LATENCY_BUCKETS):
+		super(SharedHistogram, self).__init__(bounds)
+		self.lock = Lock()
+
+	def add(self, value):
+		index = bisect_left(self.bounds, value)
+		with self.lock:
+			self.counts[index] += 1
+			self.sum += value
+
+	def snapshot(self):
+		with self.lock:
+			counts = list(self.counts)
+			total = self.sum
+		return self.cumulate(counts, total)
+
+class DurationModel(object):
+	"""Exponentially weighted mean and variance of how long something takes,
+	so a single outlier fades out instead of skewing predictions forever."""
+	def __init__(self, alpha=0.1):
+		self.alpha = alpha
+		self.mean = None
+		self.variance = 0.0
+
+	def add(self, duration):
+		if self.mean is None:
+			self.mean = duration
+			return
+		difference = duration - self.mean
+		increment = self.alpha * difference
+		self.mean += increment
+		self.variance = (1 - self.alpha) * (self.variance + difference * increment)
+
+	def deviation(self):
+		return self.variance ** 0.5
+
+	def early(self, deviations=2):
+		"""A duration that all but the fastest runs exceed, 0 before the
+		first sample."""
+		if self.mean is None:
+			return 0
+		return max(self.mean - deviations * self.deviation(), 0)
+
+class RollingCounter(RollingHistogram):
+	def __init__(self, window=WINDOW, slots=SLOTS):
+		super(RollingCounter, self).__init__((), window, slots)
+
+class Registry(object):
+	"""Current figures of every miner with running totals. Writers replace or
+	increment their own entry and the totals move by the difference, readers
+	copy an entry or the totals. Nothing iterates over all miners."""
+	FIELDS = ('rate', 'estimated_rate', 'accepted', 'rejected', 'hw_errors')
+
+	def __init__(self):
+		self.lock = Lock()
+		self.entries = {}
+		self.totals = dict.fromkeys(self.FIELDS, 0)
+
+	def entry(self, miner):
+		if miner not in self.entries:
+			self.entries[miner] = dict.fromkeys(self.FIELDS, 0)
+		return self.entries[miner]
+
+	def set(self, miner, **values):
+		with self.lock:
+			entry = self.entry(miner)
+			for key, value in values.iteritems():
+				self.totals[key] += value - entry[key]
+				entry[key] = value
+
+	def add(self, miner, key, amount=1):
+		with self.lock:
+			self.entry(miner)[key] += amount
+			self.totals[key] += amount
+
+	def get(self, miner):
+		with self.lock:
+			return dict(self.entry(miner))
+
+	def total(self):
+		with self.lock:
+			return dict(self.totals)
+
+class RateWindows(object):
+	"""Rate of a growing count over several horizons plus an exponentially
+	weighted moving average. Each horizon keeps a deque of (time, total)
+	samples that is trimmed from the left, samples closer than 1/RESOLUTION of
+	the horizon are merged. An update is amortized O(1) and the memory is
+	bounded no matter how short the update interval or how long the session."""
+	def __init__(self, horizons, tau=60):
+		self.total = 0.0
+		self.samples = dict((horizon, deque()) for horizon in horizons)
+		self.tau = float(tau)
+		self.ewma = None
+		self.last = None
+
+	def add(self, amount, now):
+		if self.last is not None and now > self.last:
+			rate = amount / (now - self.last)
+			if self.ewma is None:
+				self.ewma = rate
+			else:
+				self.ewma += (1 - exp(-(now - self.last) / self.tau)) * (rate - self.ewma)
+		self.last = now
+		self.total += amount
+		for horizon, samples in self.samples.iteritems():
+			if len(samples) > 1 and now - samples[-2][0] < float(horizon) / RESOLUTION:
+				samples[-1] = (now, self.total)
+			else:
+				samples.append((now, self.total))
+			#the newest sample at or before the start of the window is its base
+			while len(samples) > 1 and samples[1][0] <= now - horizon:
+				samples.popleft()
+
+	def rate(self, horizon):
+		"""Per second over the horizon, or over the time since the first
+		sample if that is shorter."""
+		samples = self.samples[horizon]
+		if len(samples) < 2 or self.last <= samples[0][0]:
+			return 0.0
+		return (self.total - samples[0][1]) / (self.last - samples[0][0])
+
+class PoolStats(object):
+	"""What a server entry costs us: how fast it acknowledges submits and
+	connects, how fast new blocks reach the kernels, how many shares go stale
+	and how often the connection drops."""
+	def __init__(self, name):
+		self.name = name
+		self.submit_latency = RollingHistogram()
+		self.connect_latency = RollingHistogram()
+		self.block_latency = RollingHistogram()
+		self.accepted = RollingCounter()
+		self.rejected = RollingCounter()
+		self.stale = RollingCounter()
+		self.discarded = RollingCounter()
+		self.reconnects = RollingCounter()
+		self.connections = 0
+		self.connections_lock = Lock()
+		self.submit_histogram = SharedHistogram()
+
+	def submitted(self, latency, accepted, stale=False):
+		if latency is not None:
+			self.submit_latency.add(latency)
+			self.submit_histogram.add(latency)
+		if accepted:
+			self.accepted.add()
+		else:
+			self.rejected.add()
+			if stale:
+				self.stale.add()
+
+	#shares found on a block that was already superseded never reach the pool
+	def discard(self):
+		self.discarded.add()
+
+	#the source loop and the connect threads of its links may connect at once
+	def connected(self, latency=None):
+		with self.connections_lock:
+			reconnect = bool(self.connections)
+			self.connections += 1
+		if reconnect:
+			self.reconnects.add()
+		if latency is not None:
+			self.connect_latency.add(latency)
+
+	#rejected as stale by the pool or discarded before submitting
+	def stale_ratio(self):
+		discarded = self.discarded.count()
+		total = self.accepted.count() + self.rejected.count() + discarded
+		if total:
+			return float(self.stale.count() + discarded) / total
+
+	def healthy(self):
+		return self.reconnects.count() < MAX_RECONNECTS
+
+	def latency(self):
+		"""Median submit latency, or connect latency for servers we never
+		submitted to."""
+		return self.submit_latency.percentile(50) or self.connect_latency.percentile(50)
+
+	def summary(self):
+		def ms(value):
+			if value is not None:
+				return value * 1000
+		return {
+			'name': self.name,
+			'submit_ms': {'p50': ms(self.submit_latency.percentile(50)), 'p90': ms(self.submit_latency.percentile(90)), 'mean': ms(self.submit_latency.mean()), 'count': self.submit_latency.count()},
+			'connect_ms': {'p50': ms(self.connect_latency.percentile(50)), 'count': self.connect_latency.count()},
+			'block_to_kernel_ms': {'p50': ms(self.block_latency.percentile(50)), 'p90': ms(self.block_latency.percentile(90)), 'count': self.block_latency.count()},
+			'accepted': self.accepted.count(),
+			'rejected': self.rejected.count(),
+			'stale': self.stale.count(),
+			'discarded': self.discarded.count(),
+			'stale_ratio': self.stale_ratio(),
+			'reconnects': self.reconnects.count(),
+			'window': WINDOW
+		}
+
+	def __str__(self):
+		def ms(value):
+			if value is None:
+				return '-'
+			return '%d' % (value * 1000)
+		return '%s: submit %s/%s ms, block to kernel %s ms, %d/%d accepted, %.02f%% stale, %d reconnects' % (
+			self.name, ms(self.submit_latency.percentile(50)), ms(self.submit_latency.percentile(90)), ms(self.block_latency.percentile(50)),
+			self.accepted.count(), self.accepted.count() + self.rejected.count(), (self.stale_ratio() or 0) * 100, self.reconnects.count())